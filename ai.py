@@ -4,28 +4,63 @@ It utilizes environment variables for configuration and includes logging for err
 the OpenAI GPT-4 model and requires an API key to function.
 
 Modules:
-- langchain_core.output_parsers: Provides output parsers for processing AI responses.
 - langchain_core.runnables: Contains runnable components for building processing chains.
 - langchain_openai: Interfaces with OpenAI's language models.
 - sys, os: Standard Python modules for system operations and environment management.
 - logging: Standard Python module for logging error messages.
+- time: Standard Python module to measure the latency of the calls.
+- json: Standard Python module to read the routing rules.
+- textwrap: Standard Python module to normalize the indentation of the instructions.
+- radon: Measures the cyclomatic complexity of Python code for the routing.
+- telemetry: Records the telemetry of the calls.
 - dotenv: Loads environment variables from a .env file.
 
 Classes:
 - None
 
 Functions:
+- add_arguments: Adds the model routing option to an argument parser.
+- configure_routing: Sets the rules to route units of work to models.
+- set_token_budget: Sets a hard limit on the number of tokens of the run.
 - create_connection: Establishes a connection to the OpenAI API using the specified model.
+- get_connection: Returns a shared connection to the OpenAI API for a model.
+- instruction_prompt: Builds a prompt of fixed instructions followed by the variable input.
 - run_chain: Executes a chain of runnables to process input data and generate an AI response.
+- normalize_input: Normalizes input data for de-duplication.
+- run_chain_coalesced: Executes a chain, sharing the response between identical requests within a run.
+- complexity: Returns the cyclomatic complexity of a unit of code.
+- route: Returns the models to try for a unit of work.
+- run_chain_routed: Executes a chain with the model picked by the routing rules, escalating when validation fails.
+
+Every call is recorded in the telemetry (see telemetry.py): tokens, time to first token, latency, retries, model and stage.
+
+Model routing: small and simple units (e.g. getters, tiny modules and short reports) do not need the flagship model. The
+routing rules pick a model per unit from its estimated number of tokens and its cyclomatic complexity. When the output of
+the routed model fails the validation of the caller (e.g. it is not valid Python), the unit is sent to the requested model.
+
+Prompt layout: the instructions of a stage are sent as a system message that is byte-identical in every request, followed
+by the variable input, so the provider's automatic prompt caching applies to the instructions. The cached input tokens
+are reported in the telemetry.
 """
 
-from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import SystemMessage
 from langchain_openai import ChatOpenAI
 import sys
 import os
+import re
+import time
+import json
+import textwrap
 import logging
+import threading
+from concurrent.futures import Future
 from dotenv import load_dotenv
+from radon.complexity import cc_visit
+import telemetry
+import profiling
+import cache
 
 load_dotenv()
 
@@ -37,6 +72,114 @@ if not OPENAI_API_KEY:
     logger.error("OpenAI API key not found. Please set the OPENAI_API_KEY environment variable.")
     sys.exit(1)
 
+# Number of times a failed call is retried before giving up
+MAX_RETRIES = int(os.getenv("CODEBASEAI_MAX_RETRIES", "2"))
+
+# Requests that are in flight or completed during this run, by normalized input hash (see run_chain_coalesced)
+_flights = {}
+_flights_lock = threading.Lock()
+
+# Rules to route units of work to models, in order; the first rule whose conditions all hold picks the model. Units that
+# match no rule use the requested model. Conditions: max_tokens (estimated tokens of the unit), max_complexity (cyclomatic
+# complexity, ignored when unknown) and stages (list of calling stages).
+DEFAULT_ROUTING_RULES = [
+    {"max_tokens": 1500, "max_complexity": 5, "model": "gpt-4o-mini"},
+]
+_routing_rules = DEFAULT_ROUTING_RULES
+
+# Branches in Java code, for the cyclomatic complexity of a method
+JAVA_BRANCH_PATTERN = re.compile(r'\b(?:if|for|while|case|catch)\b|&&|\|\||\?')
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+# Maximum output tokens of a call under a token budget, which are reserved before the call
+MAX_OUTPUT_TOKENS = 16384
+
+# Hard limit on the tokens of the run (see set_token_budget), the tokens used or reserved by calls in flight, and the
+# number of calls in flight
+_token_budget = None
+_tokens_used = 0
+_calls_in_flight = 0
+_budget_condition = threading.Condition()
+
+def add_arguments(parser):
+    """
+    Adds the model routing option to an argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser of the script.
+    """
+    parser.add_argument("--routing", default="default",
+                        help="Model routing: 'default' (built-in rules), 'off' (always use the model name) or a JSON rules file.")
+
+def configure_routing(routing):
+    """
+    Sets the rules to route units of work to models.
+
+    Args:
+        routing (str): "default" for the built-in rules, "off" to disable routing, or the path of a JSON file with a list
+            of rules (see DEFAULT_ROUTING_RULES).
+
+    Side Effects:
+        Exits the program if the rules file cannot be read.
+    """
+    global _routing_rules
+    if routing == "default":
+        _routing_rules = DEFAULT_ROUTING_RULES
+    elif routing == "off":
+        _routing_rules = []
+    else:
+        try:
+            with open(routing, "r") as rules_file:
+                _routing_rules = json.load(rules_file)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error: Unable to read the routing rules from {routing}: {e}")
+            sys.exit(1)
+    logger.info(f"Model routing rules: {_routing_rules}")
+
+def set_token_budget(token_budget):
+    """
+    Sets a hard limit on the number of tokens (input and output) of the run. Before a call, its estimated input and its
+    maximum output are reserved, and the output of the call is limited to the reserved tokens. A call waits for the calls
+    in flight when the remaining budget does not allow it; when no call is in flight, it is not made and the program
+    exits. With a work queue, the budget applies to each process.
+
+    Args:
+        token_budget (int): The budget, or None for no limit.
+    """
+    global _token_budget
+    _token_budget = token_budget
+    if token_budget is not None:
+        logger.info(f"Token budget of the run: {token_budget}")
+
+def _reserve_tokens(input_tokens):
+    """
+    Reserves the input tokens and the maximum output tokens of a call; returns the maximum output tokens, or None if the
+    budget does not allow the call. Waits for the calls in flight as long as they may leave room for a full output.
+    """
+    global _tokens_used, _calls_in_flight
+    with _budget_condition:
+        while True:
+            max_output = min(MAX_OUTPUT_TOKENS, _token_budget - _tokens_used - input_tokens)
+            if max_output >= MAX_OUTPUT_TOKENS or (max_output > 0 and _calls_in_flight == 0):
+                _tokens_used += input_tokens + max_output
+                _calls_in_flight += 1
+                return max_output
+            if _calls_in_flight == 0:
+                return None
+            _budget_condition.wait()
+
+def _settle_tokens(reserved, used):
+    """
+    Replaces the tokens reserved for a call by the tokens it used.
+    """
+    global _tokens_used, _calls_in_flight
+    with _budget_condition:
+        _tokens_used += used - reserved
+        _calls_in_flight -= 1
+        _budget_condition.notify_all()
+
 def create_connection(model_name="gpt-4o"):
     """
     Establishes a connection to the OpenAI API using the specified model.
@@ -56,9 +199,45 @@ def create_connection(model_name="gpt-4o"):
     Future Work:
         - Consider allowing more configuration options for the connection.
     """
-    return ChatOpenAI(temperature=0.1, model_name=model_name, streaming=True, api_key=OPENAI_API_KEY)
+    return ChatOpenAI(temperature=0.1, model_name=model_name, streaming=True, stream_usage=True, api_key=OPENAI_API_KEY)
+
+def get_connection(model_name="gpt-4o"):
+    """
+    Returns a shared connection to the OpenAI API for a model, so the connection pool is reused between calls.
+
+    Args:
+        model_name (str): The name of the OpenAI model to use.
+
+    Returns:
+        ChatOpenAI: The connection.
+    """
+    with _connections_lock:
+        if model_name not in _connections:
+            _connections[model_name] = create_connection(model_name)
+        return _connections[model_name]
+
+def instruction_prompt(instructions, input_label=None):
+    """
+    Builds a prompt of fixed instructions followed by the variable input. The instructions are a system message that is
+    the same for every request of a stage, and the input is the only part that differs, so the provider can cache the
+    instructions as a prompt prefix once they reach its minimum length (1024 tokens for OpenAI, more than the built-in
+    instructions). The instructions are taken literally: braces are not template variables.
 
-def run_chain(prompt, input_data, model_name="gpt-4o", connection=None):
+    Args:
+        instructions (str or list): The instructions, or several parts of them (e.g. the instructions of the stage and
+            packing.PACKED_INSTRUCTIONS); the common indentation and surrounding whitespace of each part are removed.
+        input_label (str, optional): A label put before the input, e.g. "Python".
+
+    Returns:
+        ChatPromptTemplate: The prompt, with the variable "input".
+    """
+    parts = [instructions] if isinstance(instructions, str) else instructions
+    return ChatPromptTemplate.from_messages([
+        SystemMessage(content="\n\n".join(textwrap.dedent(part).strip() for part in parts)),
+        ("human", f"{input_label}:\n{{input}}" if input_label else "{input}"),
+    ])
+
+def run_chain(prompt, input_data, model_name="gpt-4o", connection=None, stage="unknown", unit=None, output_file=None):
     """
     Executes a chain of runnables to process input data and generate an AI response.
 
@@ -67,6 +246,9 @@ def run_chain(prompt, input_data, model_name="gpt-4o", connection=None):
         input_data (str): The input data to be processed by the chain.
         model_name (str): The name of the OpenAI model to use. Defaults to "gpt-4o".
         connection (ChatOpenAI, optional): An existing connection to the OpenAI API. If not provided, a new connection is created.
+        stage (str): The calling stage (docstrings/report/readme/refactor), used for telemetry.
+        unit (str, optional): The unit of work (e.g. the file being processed), used for telemetry.
+        output_file (file, optional): An open file to stream the response to while it is generated.
 
     Returns:
         str: The response generated by the AI.
@@ -75,28 +257,221 @@ def run_chain(prompt, input_data, model_name="gpt-4o", connection=None):
         Exception: If there is an error during the chain execution.
 
     Side Effects:
-        - Logs an error message if the OpenAI API key is not found.
-        - Exits the program if the API key is missing.
+        - Records the call in the telemetry.
+        - Retries a failed call up to MAX_RETRIES times.
+        - Reserves the input and maximum output tokens of the call in the token budget, limits the output to them, and
+          exits the program when the budget does not allow the call.
+        - Writes the response to the output file, if given. The file is truncated when the call is retried.
+        - Logs an error message and exits the program if the call keeps failing.
 
     Future Work:
         - Implement error handling for specific exceptions during chain execution.
-        - Consider adding more detailed logging for debugging purposes.
     """
-    response = ""
+    if connection:
+        llmOpenAI = connection
+    else:
+        llmOpenAI = get_connection(model_name)
+    model = getattr(llmOpenAI, "model_name", model_name)
+
+    reserved = 0
+    if _token_budget is not None:
+        estimated_input = telemetry.estimate_tokens(prompt.format(input=input_data))
+        max_output = _reserve_tokens(estimated_input)
+        if max_output is None:
+            logger.error(f"Error: The token budget of {_token_budget} tokens is exhausted ({_tokens_used} used), "
+                         f"not starting the call for {unit}.")
+            sys.exit(1)
+        reserved = estimated_input + max_output
+        llmOpenAI = llmOpenAI.bind(max_tokens=max_output)
+
+    # The chain is streamed (without output parser) to measure the time to the first token and to get the token usage
+    chain = (
+        {"input": RunnablePassthrough()}
+        | prompt
+        | llmOpenAI
+    )
+    start = time.perf_counter()
+    retries = 0
+    while True:
+        response = ""
+        first_token = None
+        usage = None
+        # The time to the first token is measured per attempt, the latency over all attempts
+        attempt_start = time.perf_counter()
+        if output_file:
+            output_file.seek(0)
+            output_file.truncate()
+        try:
+            with profiling.span("llm", "llm", stage=stage, unit=unit, model=model, attempt=retries + 1):
+                for chunk in chain.stream(input_data):
+                    if first_token is None:
+                        first_token = time.perf_counter() - attempt_start
+                    response += chunk.content
+                    if output_file:
+                        output_file.write(chunk.content)
+                        output_file.flush()
+                    if chunk.usage_metadata:
+                        usage = chunk.usage_metadata
+            break
+        except Exception as e:
+            if retries < MAX_RETRIES:
+                retries += 1
+                logger.warning(f"Error during large language model execution (retry {retries}/{MAX_RETRIES}): {e}")
+                continue
+            telemetry.record_call(stage, model, 0, 0, first_token, time.perf_counter() - start, retries, "error", unit)
+            logger.error(f"Error during large language model execution: {e}")
+            if _token_budget is not None:
+                # The tokens of the failed attempts are not known; their estimated input is counted
+                _settle_tokens(reserved, estimated_input * (retries + 1))
+            sys.exit(1)
+
+    cached_tokens = 0
+    if usage:
+        input_tokens, output_tokens, estimated = usage["input_tokens"], usage["output_tokens"], False
+        cached_tokens = (usage.get("input_token_details") or {}).get("cache_read") or 0
+    else:
+        # Estimate when the API does not report the usage
+        input_tokens = telemetry.estimate_tokens(prompt.format(input=input_data))
+        input_tokens, output_tokens, estimated = input_tokens, telemetry.estimate_tokens(response), True
+    telemetry.record_call(stage, model, input_tokens, output_tokens, first_token, time.perf_counter() - start, retries,
+                          "ok", unit, estimated, cached_tokens)
+    if _token_budget is not None:
+        _settle_tokens(reserved, input_tokens + output_tokens)
+    return response
+
+def normalize_input(input_data):
+    """
+    Normalizes input data for de-duplication: line endings, trailing whitespace and surrounding blank lines are ignored.
+
+    Args:
+        input_data (str): The input data.
+
+    Returns:
+        str: The normalized input data.
+    """
+    lines = [line.rstrip() for line in str(input_data).replace("\r\n", "\n").split("\n")]
+    return re.sub(r"^\n+|\n+$", "", "\n".join(lines))
+
+def run_chain_coalesced(prompt, input_data, model_name="gpt-4o", connection=None, stage="unknown", unit=None):
+    """
+    Executes a chain like run_chain, but sends identical requests only once per run (single flight).
+
+    Requests are identical when the model, the prompt and the normalized input are the same. A request that is identical to
+    one in flight waits for that call and shares its response; a later identical request gets the memoized response.
+
+    Args:
+        prompt (ChatPromptTemplate): The prompt template to use for generating the AI response.
+        input_data (str): The input data to be processed by the chain.
+        model_name (str): The name of the OpenAI model to use. Defaults to "gpt-4o".
+        connection (ChatOpenAI, optional): An existing connection to the OpenAI API.
+        stage (str): The calling stage, used for telemetry.
+        unit (str, optional): The unit of work, used for telemetry.
+
+    Returns:
+        str: The response generated by the AI.
+
+    Side Effects:
+        - Records a hit of the "single_flight" cache for every coalesced request.
+        - Memoizes the responses for the duration of the run.
+    """
+    model = getattr(connection, "model_name", model_name) if connection else model_name
+    key = cache.make_key(model, prompt.format(input=normalize_input(input_data)))
+    with _flights_lock:
+        future = _flights.get(key)
+        leader = future is None
+        if leader:
+            future = _flights[key] = Future()
+    telemetry.record_cache("single_flight", not leader)
+    if not leader:
+        logger.debug(f"Coalesced identical request for {unit}")
+        return future.result()
     try:
-        if connection:
-            llmOpenAI = connection
+        response = run_chain(prompt, input_data, model_name, connection, stage, unit)
+    except BaseException as e:
+        # Let the waiting requests fail as well, but allow a later request to try again
+        with _flights_lock:
+            del _flights[key]
+        future.set_exception(e)
+        raise
+    future.set_result(response)
+    return response
+
+def complexity(code, language="python"):
+    """
+    Returns the cyclomatic complexity of a unit of code.
+
+    Args:
+        code (str): The code.
+        language (str): "python" (measured with radon) or "java" (1 plus the number of branches).
+
+    Returns:
+        int: The highest complexity of the functions in the code, or None if it cannot be determined (e.g. invalid Python).
+    """
+    if language == "java":
+        return 1 + len(JAVA_BRANCH_PATTERN.findall(code))
+    try:
+        blocks = cc_visit(code)
+    except Exception:
+        return None
+    return max([block.complexity for block in blocks], default=1)
+
+def route(input_data, model_name="gpt-4o", stage="unknown", unit_complexity=None, input_tokens=None):
+    """
+    Returns the models to try for a unit of work: the model picked by the routing rules and, when that is a different
+    model, the requested model to escalate to.
+
+    Args:
+        input_data (str): The input data of the unit.
+        model_name (str): The requested model.
+        stage (str): The calling stage.
+        unit_complexity (int, optional): The cyclomatic complexity of the unit (see complexity), if known.
+        input_tokens (int, optional): The estimated number of tokens of the input data, when it is already known (e.g.
+            when planning).
+
+    Returns:
+        list: The names of the models, in order.
+    """
+    tokens = input_tokens if input_tokens is not None else telemetry.estimate_tokens(str(input_data))
+    for rule in _routing_rules:
+        if "max_tokens" in rule and tokens > rule["max_tokens"]:
+            continue
+        if "max_complexity" in rule and unit_complexity is not None and unit_complexity > rule["max_complexity"]:
+            continue
+        if "stages" in rule and stage not in rule["stages"]:
+            continue
+        if rule["model"] != model_name:
+            return [rule["model"], model_name]
+        break
+    return [model_name]
+
+def run_chain_routed(prompt, input_data, model_name="gpt-4o", connection=None, stage="unknown", unit=None,
+                     validate=None, unit_complexity=None, output_file=None):
+    """
+    Executes a chain with the model picked by the routing rules, escalating to the requested model when the output fails
+    validation. Without output file, identical requests are coalesced (see run_chain_coalesced).
+
+    Args:
+        prompt (ChatPromptTemplate): The prompt template to use for generating the AI response.
+        input_data (str): The input data to be processed by the chain.
+        model_name (str): The requested model, used for units that match no rule and for escalation.
+        connection (ChatOpenAI, optional): An existing connection for the requested model.
+        stage (str): The calling stage, used for routing and telemetry.
+        unit (str, optional): The unit of work, used for telemetry.
+        validate (function, optional): Checks a response; returns False when the response is not acceptable.
+        unit_complexity (int, optional): The cyclomatic complexity of the unit (see complexity), if known.
+        output_file (file, optional): An open file to stream the response to; it is rewritten on escalation.
+
+    Returns:
+        str: The response of the first model whose output passes validation, or the response of the requested model.
+    """
+    models = route(input_data, model_name, stage, unit_complexity)
+    for model in models:
+        model_connection = connection if getattr(connection, "model_name", None) == model else None
+        if output_file:
+            response = run_chain(prompt, input_data, model, model_connection, stage, unit, output_file)
         else:
-            llmOpenAI = create_connection()
-
-        chain = (
-            {"input": RunnablePassthrough()}
-            | prompt  
-            | llmOpenAI
-            | StrOutputParser()
-        )
-        response = chain.invoke(input_data)
-    except Exception as e:
-        logger.error(f"Error during large language model execution: {e}")
-        sys.exit(1)
-    return response
\ No newline at end of file
+            response = run_chain_coalesced(prompt, input_data, model, model_connection, stage, unit)
+        if model == models[-1] or validate is None or validate(response):
+            return response
+        logger.info(f"Output of {model} for {unit} failed validation, escalating to {models[-1]}.")
+    return response
@@ -2,20 +2,41 @@
 This script analyzes a codebase using various tools to assess code quality, complexity, and maintainability.
 It utilizes tools such as Vulture, Pylint, and Radon to generate reports on unused code, code quality, and
 code complexity. The results are saved in specified output directories for further review.
+
+In watch mode the reports are kept up to date after the first run: only the changed files are analyzed again by Pylint
+and Radon, and their sections in the reports are replaced. Vulture is run on the whole codebase again, as unused code
+is found across files.
+
+With a work queue (see work_queue.py), the files are analyzed by Pylint and Radon on several worker processes, and the
+results are merged into the reports by the process that enqueued them. The checks of Pylint across files (duplicate code,
+cyclic imports) are run on the whole codebase by that process, while the workers analyze the files.
 """
 
 import os
+import re
 import sys
+import shlex
 import argparse
 import logging
-from commands import run_command
+from concurrent.futures import ThreadPoolExecutor
+import profiling
+import watch
+import work_queue
+from radon.complexity import cc_rank
+from commands import run_command, capture_command
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(description="Analyze a codebase using various tools.")
 parser.add_argument("-c", "--codebase_dir", required=True, help="The directory of the codebase to analyze.")
 parser.add_argument("-o", "--output_dir", required=True, help="The directory to save the analysis reports.")
 parser.add_argument("-l", "--log_file", default='./analysis.log', help="The file to save the log.")
+profiling.add_arguments(parser)
+parser.add_argument("-w", "--workers", type=int, default=4, help="The number of files to analyze concurrently (with --queue).")
+watch.add_arguments(parser)
+work_queue.add_arguments(parser)
 args = parser.parse_args()
+if args.worker and not args.queue:
+    parser.error("--worker requires --queue")
 
 # Define the codebase directory to analyze and the output directory
 CODEBASE_DIR = args.codebase_dir
@@ -36,6 +57,8 @@ logging.basicConfig(
 # Create a logger object
 logger = logging.getLogger(__name__)
 
+profiling.configure(args.profile, args.profile_cpu)
+
 def analyze_with_vulture():
     """
     Finds unused code using Vulture.
@@ -81,6 +104,238 @@ def analyze_with_radon():
     command_mi = f"radon mi {CODEBASE_DIR} -s"
     run_command(command_mi, mi_output, logger)
 
+PYLINT_HEADER = "************* Module "
+PYLINT_FOOTER_PATTERN = re.compile(r"^-{5,}$|^Your code has been rated at ")
+RADON_CC_FOOTER_PATTERN = re.compile(r"^\d+ blocks \(classes, functions, methods\) analyzed\.$|^Average complexity: ")
+RADON_CC_PATTERN = re.compile(r"\((\d+)\)$")
+
+# The Pylint checks that need all files, which are lost when the files are analyzed one by one
+PYLINT_CROSS_FILE_CHECKS = "duplicate-code,cyclic-import"
+
+def read_report(name):
+    """
+    Reads the lines of a report in the output directory.
+
+    Args:
+        name (str): The file name of the report.
+
+    Returns:
+        list: The lines of the report, or an empty list if it does not exist.
+    """
+    path = os.path.join(OUTPUT_DIR, name)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as report:
+        return report.read().splitlines()
+
+def write_report(name, lines):
+    """
+    Writes the lines of a report to the output directory.
+
+    Args:
+        name (str): The file name of the report.
+        lines (list): The lines of the report.
+    """
+    path = os.path.join(OUTPUT_DIR, name)
+    with open(path, "w") as report:
+        report.write("\n".join(lines) + "\n")
+    logger.info(f"Report updated: {path}")
+
+def split_sections(lines, key):
+    """
+    Splits the lines of a report into sections, e.g. one section per analyzed file.
+
+    Args:
+        lines (list): The lines of the report.
+        key (function): Returns the key of the section a line starts, or None if the line continues the current section.
+
+    Returns:
+        dict: The lines by section key, in the order of the report. Lines before the first section have the key "". A
+        section that is started again (e.g. by output merged from several runs) is continued without its first line.
+    """
+    sections = {}
+    current = ""
+    for line in lines:
+        started = key(line)
+        if started is not None and started in sections:
+            current = started
+            continue
+        current = started or current
+        sections.setdefault(current, []).append(line)
+    return sections
+
+def merge_sections(sections, updated, stale):
+    """
+    Replaces the sections of the changed files in a report, keeping the order of the other sections.
+
+    Args:
+        sections (dict): The sections of the report (see split_sections).
+        updated (dict): The new sections of the changed files.
+        stale (set): The keys of the sections of the changed files, which are removed when they are not updated.
+
+    Returns:
+        dict: The merged sections; new sections are added at the end.
+    """
+    merged = {}
+    for key, lines in sections.items():
+        if key in updated:
+            merged[key] = updated[key]
+        elif key not in stale:
+            merged[key] = lines
+    for key, lines in updated.items():
+        merged.setdefault(key, lines)
+    return merged
+
+def analyze_changed(command, paths):
+    """
+    Runs an analysis tool on the changed files that still exist.
+
+    Args:
+        command (str): The command of the tool, to which the files are added.
+        paths (list): The changed paths.
+
+    Returns:
+        list: The lines of the output of the tool.
+    """
+    existing = [path for path in paths if os.path.exists(path)]
+    if not existing:
+        return []
+    output = capture_command(f"{command} " + " ".join(shlex.quote(path) for path in existing), logger, check=False)
+    return (output or "").splitlines()
+
+def pylint_module(path):
+    """
+    Returns the module name under which Pylint reports a file: the dotted path within its package.
+
+    Args:
+        path (str): The path to the Python file.
+
+    Returns:
+        str: The module name.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    parts = [] if name == "__init__" else [name]
+    directory = os.path.dirname(os.path.abspath(path))
+    while os.path.exists(os.path.join(directory, "__init__.py")):
+        parts.insert(0, os.path.basename(directory))
+        directory = os.path.dirname(directory)
+    return ".".join(parts)
+
+def update_pylint(paths, output=None):
+    """
+    Replaces the sections of the changed files in the Pylint report. The overall rating is removed, as it can only be
+    computed by analyzing the whole codebase again.
+
+    Args:
+        paths (list): The changed paths.
+        output (list, optional): The output of Pylint for the changed files; Pylint is run when it is not given.
+    """
+    if output is None:
+        output = analyze_changed("pylint --output-format=text", paths)
+    without_footer = lambda lines: [line for line in lines if line and not PYLINT_FOOTER_PATTERN.match(line)]
+    key = lambda line: line[len(PYLINT_HEADER):] if line.startswith(PYLINT_HEADER) else None
+    sections = split_sections(without_footer(read_report("pylint_report.txt")), key)
+    updated = split_sections(without_footer(output), key)
+    updated.pop("", None)
+    sections = merge_sections(sections, updated, set(pylint_module(path) for path in paths))
+    write_report("pylint_report.txt", [line for lines in sections.values() for line in lines])
+
+def update_radon(paths, cc_output=None, mi_output=None):
+    """
+    Replaces the sections of the changed files in the Radon reports, and recomputes the average complexity.
+
+    Args:
+        paths (list): The changed paths.
+        cc_output (list, optional): The output of `radon cc` for the changed files; Radon is run when it is not given.
+        mi_output (list, optional): The output of `radon mi` for the changed files; Radon is run when it is not given.
+    """
+    if cc_output is None:
+        cc_output = analyze_changed("radon cc -s", paths)
+    if mi_output is None:
+        mi_output = analyze_changed("radon mi -s", paths)
+    stale = set(os.path.normpath(path) for path in paths)
+
+    cc_key = lambda line: os.path.normpath(line) if not line.startswith(" ") else None
+    cc_lines = lambda lines: [line for line in lines if line and not RADON_CC_FOOTER_PATTERN.match(line)]
+    sections = split_sections(cc_lines(read_report("radon_cc_report.txt")), cc_key)
+    updated = split_sections(cc_lines(cc_output), cc_key)
+    sections = merge_sections(sections, updated, stale)
+    lines = [line for lines in sections.values() for line in lines]
+    complexities = []
+    for line in lines:
+        match = RADON_CC_PATTERN.search(line)
+        if line.startswith(" ") and match:
+            complexities.append(int(match.group(1)))
+    if complexities:
+        average = sum(complexities) / len(complexities)
+        lines += ["", f"{len(complexities)} blocks (classes, functions, methods) analyzed.",
+                  f"Average complexity: {cc_rank(average)} ({average})"]
+    write_report("radon_cc_report.txt", lines)
+
+    mi_key = lambda line: os.path.normpath(line.rsplit(" - ", 1)[0])
+    sections = split_sections(read_report("radon_mi_report.txt"), mi_key)
+    updated = split_sections(mi_output, mi_key)
+    sections = merge_sections(sections, updated, stale)
+    write_report("radon_mi_report.txt", [line for lines in sections.values() for line in lines])
+
+def update_reports(paths):
+    """
+    Updates the reports for the files that changed in watch mode.
+
+    Args:
+        paths (list): The changed paths; a path that no longer exists was deleted.
+
+    Side Effects:
+        Rewrites the reports in the output directory.
+    """
+    analyze_with_vulture()
+    with profiling.span("update_pylint", "stage"):
+        update_pylint(paths)
+    with profiling.span("update_radon", "stage"):
+        update_radon(paths)
+
+def analyze_file(path, payload):
+    """
+    Runs Pylint and Radon on one file leased from the work queue.
+
+    Args:
+        path (str): The path to the Python file.
+        payload: Not used.
+
+    Returns:
+        dict: The output lines of Pylint ("pylint"), Radon cc ("radon_cc") and Radon mi ("radon_mi").
+    """
+    return {"pylint": analyze_changed("pylint --output-format=text", [path]),
+            "radon_cc": analyze_changed("radon cc -s", [path]),
+            "radon_mi": analyze_changed("radon mi -s", [path])}
+
+def analyze_with_queue():
+    """
+    Analyzes the files with Pylint and Radon on the worker processes of the work queue (this process is one of them),
+    and merges their results into the reports.
+
+    Side Effects:
+        Writes the Pylint and Radon reports to the output directory.
+    """
+    paths = [os.path.join(root, file) for root, dirs, files in os.walk(CODEBASE_DIR) for file in files
+             if file.endswith(".py")]
+    work_queue.enqueue(args.queue, "analysis", {path: None for path in paths})
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        cross_file = executor.submit(capture_command, f"pylint {CODEBASE_DIR} --output-format=text --disable=all "
+                                     f"--enable={PYLINT_CROSS_FILE_CHECKS}", logger, False)
+        work_queue.run_worker(args.queue, "analysis", analyze_file, logger, args.workers, args.lease)
+    if not work_queue.check_done(args.queue, "analysis", paths, logger):
+        logger.error("Not all files were analyzed, not writing the Pylint and Radon reports")
+        sys.exit(1)
+    outputs = work_queue.results(args.queue, "analysis", paths)
+    merged = lambda tool: [line for path in paths for line in outputs.get(path, {}).get(tool, [])]
+    for report in ("pylint_report.txt", "radon_cc_report.txt", "radon_mi_report.txt"):
+        if os.path.exists(os.path.join(OUTPUT_DIR, report)):
+            os.remove(os.path.join(OUTPUT_DIR, report))
+    # The messages across files are added to the sections of the modules they are reported for
+    update_pylint(paths, merged("pylint") + (cross_file.result() or "").splitlines())
+    update_radon(paths, merged("radon_cc"), merged("radon_mi"))
+
 def main():
     """
     Main function to run all analysis tools.
@@ -98,12 +353,22 @@ def main():
     logger.info(f"Analyzing codebase at: {CODEBASE_DIR}")
     logger.info(f"Reports will be saved to: {OUTPUT_DIR}")
 
+    if args.worker:
+        # The files are enqueued, and the results merged, by the process started without --worker
+        work_queue.run_worker(args.queue, "analysis", analyze_file, logger, args.workers, args.lease, wait=True)
+        return
+
     # Run analysis tools
     analyze_with_vulture()
-    analyze_with_pylint()
-    analyze_with_radon()
+    if args.queue:
+        analyze_with_queue()
+    else:
+        analyze_with_pylint()
+        analyze_with_radon()
 
     logger.info(f"Code analysis completed. Check the reports in the '{OUTPUT_DIR}' folder.")
+    if args.watch:
+        watch.watch(CODEBASE_DIR, (".py",), update_reports, logger, args.debounce, args.poll_interval)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
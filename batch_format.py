@@ -0,0 +1,128 @@
+"""
+This script formats the refactored Java files with astyle in the background. Instead of one astyle process per file on
+the thread that refactors it, the output paths are collected and formatted in batches (astyle accepts many files) on a
+small worker pool, while the refactoring of other files continues.
+
+Files whose content did not change since they were last formatted are skipped: after a successful batch, the hash of the
+unformatted content and the hash of the formatted file are cached per output path. Only the last formatted version of a
+path is kept, so a content that changes back to an earlier version is written and formatted again.
+
+Functions:
+- start: Starts the background formatting.
+- is_formatted: Checks whether an output file already holds the formatted version of the content.
+- submit: Queues a file for formatting.
+- finish: Formats the remaining files and waits for all batches.
+"""
+
+import os
+import shlex
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cache
+from commands import capture_command
+
+# Create a logger object
+logger = logging.getLogger(__name__)
+
+ASTYLE_COMMAND = "astyle -n --style=java"
+
+_lock = threading.Lock()
+_pending = []
+_futures = []
+_executor = None
+_batch_size = 100
+_cache_dir = None
+
+def start(workers=2, batch_size=100, cache_dir=None):
+    """
+    Starts the background formatting.
+
+    Args:
+        workers (int): The number of astyle processes that may run at the same time.
+        batch_size (int): The number of files per astyle process.
+        cache_dir (str, optional): The cache directory, to skip files whose content did not change.
+    """
+    global _executor, _batch_size, _cache_dir
+    _executor = ThreadPoolExecutor(max_workers=workers)
+    _batch_size = batch_size
+    _cache_dir = cache_dir
+
+def _key(path):
+    """
+    Returns the cache key of an output path.
+    """
+    return cache.make_key(os.path.abspath(path))
+
+def _hash(content):
+    """
+    Returns the hash of a content.
+    """
+    return cache.make_key(content)
+
+def _file_hash(path):
+    """
+    Returns the hash of the content of a file, or None if it cannot be read.
+    """
+    try:
+        with open(path, "r") as formatted_file:
+            return _hash(formatted_file.read())
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def is_formatted(path, content):
+    """
+    Checks whether an output file already holds the formatted version of the content, so it does not need to be written
+    and formatted again.
+
+    Args:
+        path (str): The path of the output file.
+        content (str): The unformatted content.
+
+    Returns:
+        bool: True if the content is the last one formatted into the file, and the file was not changed since.
+    """
+    if not _cache_dir or not os.path.exists(path):
+        return False
+    formatted = cache.load(_cache_dir, "astyle", _key(path))
+    return (isinstance(formatted, dict) and formatted.get("content") == _hash(content)
+            and formatted.get("formatted") == _file_hash(path))
+
+def _format(batch):
+    """
+    Formats a batch of files with one astyle process, and remembers their content and formatted file when it succeeded.
+    """
+    output = capture_command(f"{ASTYLE_COMMAND} " + " ".join(shlex.quote(path) for path, _ in batch), logger)
+    if output is None:
+        return
+    logger.info(f"Formatted {len(batch)} files with astyle")
+    if _cache_dir:
+        for path, content_hash in batch:
+            cache.store(_cache_dir, "astyle", _key(path), {"content": content_hash, "formatted": _file_hash(path)})
+
+def submit(path, content):
+    """
+    Queues a file for formatting. A full batch is handed to the worker pool right away.
+
+    Args:
+        path (str): The path of the output file, already written.
+        content (str): The unformatted content of the file.
+    """
+    with _lock:
+        _pending.append((path, _hash(content)))
+        if len(_pending) >= _batch_size:
+            _futures.append(_executor.submit(_format, _pending[:]))
+            _pending.clear()
+
+def finish():
+    """
+    Formats the remaining files and waits for all batches.
+    """
+    with _lock:
+        if _pending:
+            _futures.append(_executor.submit(_format, _pending[:]))
+            _pending.clear()
+    for future in _futures:
+        future.result()
+    _futures.clear()
+    _executor.shutdown()
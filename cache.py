@@ -0,0 +1,91 @@
+"""
+This script provides a simple content-addressed disk cache for AI responses. Entries are stored as JSON files under a
+namespace directory and are keyed by a hash of everything that determines the response (model, prompt and input), so a
+changed input automatically results in a cache miss. Hits and misses are recorded in the telemetry.
+
+Functions:
+- make_key: Creates a cache key from the parts that determine a response.
+- load: Loads a cached value.
+- store: Stores a value in the cache.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import telemetry
+
+# Create a logger object
+logger = logging.getLogger(__name__)
+
+# Name of the cache directory that is created in the output directory of the scripts
+CACHE_DIRNAME = ".codebaseai_cache"
+
+def make_key(*parts):
+    """
+    Creates a cache key from the parts that determine a response.
+
+    Args:
+        *parts (str): The parts, e.g. the model name and the formatted prompt.
+
+    Returns:
+        str: The SHA-256 hex digest of the parts.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _path(cache_dir, namespace, key):
+    """
+    Returns the path of the cache entry, sharded by the first two characters of the key.
+    """
+    return os.path.join(cache_dir, namespace, key[:2], key + ".json")
+
+def load(cache_dir, namespace, key):
+    """
+    Loads a cached value.
+
+    Args:
+        cache_dir (str): The cache directory.
+        namespace (str): The namespace of the entry, e.g. "report".
+        key (str): The key of the entry.
+
+    Returns:
+        The cached value, or None on a miss.
+
+    Side Effects:
+        Records the hit or miss in the telemetry.
+    """
+    path = _path(cache_dir, namespace, key)
+    value = None
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as cache_file:
+                value = json.load(cache_file)["value"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+    telemetry.record_cache(namespace, value is not None)
+    return value
+
+def store(cache_dir, namespace, key, value):
+    """
+    Stores a value in the cache.
+
+    Args:
+        cache_dir (str): The cache directory.
+        namespace (str): The namespace of the entry.
+        key (str): The key of the entry.
+        value: The JSON-serializable value.
+
+    Side Effects:
+        Writes the entry atomically, so concurrent readers never see a partial entry.
+    """
+    path = _path(cache_dir, namespace, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as cache_file:
+        json.dump({"value": value}, cache_file)
+    os.replace(temp_path, path)
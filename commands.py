@@ -3,10 +3,11 @@ This script provides a utility function to execute shell commands, handle their
 
 The main function, `run_command`, is designed to run a specified shell command, capture its output in a designated file, 
 and log the process using a provided logger. It includes handling for specific exit codes with warnings and logs errors 
-for other types of failures.
+for other types of failures. The function `capture_command` runs a command and returns its output instead.
 """
 
 import subprocess
+import profiling
 
 def run_command(command, output_file, logger):
     """
@@ -31,12 +32,13 @@ def run_command(command, output_file, logger):
         - Future work could include handling additional specific exit codes or improving error handling.
     """
     try:
-        if output_file:
-            with open(output_file, "w") as f:
-                subprocess.run(command, shell=True, check=True, stdout=f, stderr=subprocess.STDOUT)
-            logger.info(f"Output file generated: {output_file}")
-        else:
-            subprocess.run(command, shell=True, check=True)
+        with profiling.span("run_command", "subprocess", command=command):
+            if output_file:
+                with open(output_file, "w") as f:
+                    subprocess.run(command, shell=True, check=True, stdout=f, stderr=subprocess.STDOUT)
+                logger.info(f"Output file generated: {output_file}")
+            else:
+                subprocess.run(command, shell=True, check=True)
     except subprocess.CalledProcessError as e:
         if e.returncode == 3:
             logger.warning(f"Warning: Command '{command}' failed with exit status 3 (Invalid argument).")
@@ -44,3 +46,27 @@ def run_command(command, output_file, logger):
             logger.warning(f"Warning: Command '{command}' failed with exit status 30 (Timeout).")
         else:
             logger.error(f"Error while running command: {command}\n{e}")
+
+def capture_command(command, logger, check=True):
+    """
+    Executes a shell command and returns its output.
+
+    Args:
+        command (str): The shell command to be executed.
+        logger (logging.Logger): A logger instance used to log errors.
+        check (bool): Treat a non-zero exit status as a failure. Analysis tools such as pylint and vulture exit with a
+            non-zero status when they report messages.
+
+    Returns:
+        str: The standard output of the command, or None if the command failed.
+
+    Side Effects:
+        - Logs an error, including the error output of the command, if the command fails.
+    """
+    try:
+        with profiling.span("capture_command", "subprocess", command=command):
+            result = subprocess.run(command, shell=True, check=check, capture_output=True, text=True)
+        return result.stdout
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error while running command: {command}\n{e.stderr}")
+        return None
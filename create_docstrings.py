@@ -10,11 +10,21 @@ import os
 import sys
 import argparse
 import re
-from commands import run_command
 import logging
-from ai import run_chain
-from langchain_core.prompts import ChatPromptTemplate
-import json
+import telemetry
+import profiling
+import git_changes
+import ai
+from ai import run_chain, run_chain_routed
+import ast
+import packing
+import python_chunks
+import planner
+import doc_builder
+import cache
+import watch
+import work_queue
+from concurrent.futures import ThreadPoolExecutor
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(description="Create reports based on the analysis of a codebase using AI.")
@@ -28,8 +38,20 @@ parser.add_argument("-D", "--description", default="AI-generated documentation",
 parser.add_argument("-l", "--log_file", default='./analysis.log', help="The file to save the log.")
 parser.add_argument("-m", "--model_name", default="gpt-4o", help="OpenAI model name.")
 parser.add_argument("-P", "--python", default="T", help="Create also docstrings, not only create markdown files (T/F)")
-
+parser.add_argument("-w", "--workers", type=int, default=4, help="The number of scripts to process concurrently.")
+parser.add_argument("--pack_budget", type=int, default=3000, help="Token budget to pack small scripts into one request (0 to disable).")
+parser.add_argument("--split_tokens", type=int, default=4000, help="Scripts above this number of tokens are split at their top-level definitions.")
+git_changes.add_arguments(parser)
+parser.add_argument("-T", "--telemetry_dir", default=None, help="The directory to write the LLM telemetry (trace, summary and metrics) to.")
+
+profiling.add_arguments(parser)
+ai.add_arguments(parser)
+planner.add_arguments(parser)
+watch.add_arguments(parser)
+work_queue.add_arguments(parser)
 args = parser.parse_args()
+if args.worker and not args.queue:
+    parser.error("--worker requires --queue")
 
 # Configure logging
 logging.basicConfig(
@@ -41,6 +63,13 @@ logging.basicConfig(
 # Create a logger object
 logger = logging.getLogger(__name__)
 
+profiling.configure(args.profile, args.profile_cpu)
+ai.configure_routing(args.routing)
+ai.set_token_budget(args.token_budget)
+
+if args.telemetry_dir:
+    telemetry.configure(args.telemetry_dir)
+
 CODEBASE_DIR = args.codebase_dir
 if not os.path.exists(CODEBASE_DIR):
     logger.error(f"Error: Directory {CODEBASE_DIR} does not exist.")
@@ -63,17 +92,93 @@ MAIL = args.email
 LINK = args.url
 DESCRIPTION = args.description
 MODEL_NAME = args.model_name
+CACHE_DIR = os.path.join(OUTPUT_DIR, cache.CACHE_DIRNAME)
 
 # Ensure output directory exists
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DOCS, exist_ok=True)
 
-def create_docstrings(script):
+# Documentation sections up to this number of tokens are not condensed
+CONDENSE_TOKENS = 300
+
+# Rough ratios for the plan (see planner.py): output tokens per input token of a docstring request, and tokens of the
+# documentation section per token of a script
+DOCSTRING_OUTPUT_RATIO = 1.4
+DOCUMENTATION_RATIO = 0.3
+
+DOCSTRING_INSTRUCTIONS = """
+        This is a Python script, most likely without proper docstrings. Please add docstrings to the functions and classes in the script to 
+        improve readability and maintainability. Output should be a Python script with proper docstrings, so leave out backticks, other formatting and notes.
+                                              
+        Please:
+        - add a docstring at the beginning of the script that describes its purpose.
+        - add docstrings to all functions and classes in the script.
+        - describe the purpose, inputs, and outputs of each function/class in the docstring.
+        - follow the PEP 257 docstring conventions.
+        - describe any side effects or exceptions raised by the functions/classes.
+        - indicate (serious) issues, debug statements, or future work in the docstrings.        
+"""
+
+# Instructions for the parts of a script that is split at its top-level definitions (see python_chunks.py)
+DEFINITION_INSTRUCTIONS = """
+        This is part of a large Python script, which is processed in parts. The input starts with the module context
+        (imports, globals and the signatures of all definitions) for reference only; do not output the module context.
+        Please add docstrings to the top-level functions and classes that follow it, and to their methods, to improve
+        readability and maintainability. Output should be Python code with proper docstrings, so leave out backticks,
+        other formatting and notes. Do not change the code itself.
+
+        Please:
+        - describe the purpose, inputs, and outputs of each function/class in the docstring.
+        - follow the PEP 257 docstring conventions.
+        - describe any side effects or exceptions raised by the functions/classes.
+        - indicate (serious) issues, debug statements, or future work in the docstrings.
+"""
+
+MODULE_DOCSTRING_INSTRUCTIONS = """
+        This is the module context (imports, globals and the signatures of all definitions) of a large Python script.
+        Please write a docstring for the beginning of the script that describes its purpose, following the PEP 257
+        docstring conventions. Output only the docstring (including the triple quotes), so leave out backticks, other
+        formatting and notes.
+"""
+
+def get_output_path(script):
+    """
+    Returns the path in the output directory for a Python script.
+
+    Args:
+        script (str): The path to the Python script file.
+
+    Returns:
+        str: The path of the script with docstrings.
+    """
+    cleaned_path = re.sub(r"^(\.\./|\.\/)+", "", script)
+    return os.path.join(OUTPUT_DIR, cleaned_path)
+
+def needs_processing(script, force=False):
     """
-    Creates docstrings for a given Python script using OpenAI's language model.
+    Checks whether the docstrings of a script need to be (re)created.
 
     Args:
         script (str): The path to the Python script file.
+        force (bool): Process the script even if the existing output is newer.
+
+    Returns:
+        bool: False if the existing output is newer than the script (and force is not set), otherwise True.
+    """
+    output_file_path = get_output_path(script)
+    return force or not os.path.exists(output_file_path) or os.path.getmtime(script) >= os.path.getmtime(output_file_path)
+
+def create_docstrings(script, force=False, changed_lines=None):
+    """
+    Creates docstrings for a given Python script using OpenAI's language model. Identical scripts are sent to the
+    model only once per run. Large scripts, and scripts of which only some lines changed, are processed per top-level
+    definition (see create_docstrings_split).
+
+    Args:
+        script (str): The path to the Python script file.
+        force (bool): Process the script even if the existing output is newer (used when selecting changes with git).
+        changed_lines (list, optional): The changed line ranges of the script (when selecting changes with git), or None
+            if the whole script changed.
 
     Returns:
         str: The AI-generated script with added docstrings.
@@ -85,54 +190,305 @@ def create_docstrings(script):
     Raises:
         FileNotFoundError: If the script file does not exist.
     """
-    prompt = ChatPromptTemplate.from_template("""
-        This is a Python script, most likely without proper docstrings. Please add docstrings to the functions and classes in the script to 
-        improve readability and maintainability. Output should be a Python script with proper docstrings, so leave out backticks, other formatting and notes.
-                                              
-        Please:
-        - add a docstring at the beginning of the script that describes its purpose.
-        - add docstrings to all functions and classes in the script.
-        - describe the purpose, inputs, and outputs of each function/class in the docstring.
-        - follow the PEP 257 docstring conventions.
-        - describe any side effects or exceptions raised by the functions/classes.
-        - indicate (serious) issues, debug statements, or future work in the docstrings.        
-
-        Python:
-         {input}
-        """
-    )
+    prompt = ai.instruction_prompt(DOCSTRING_INSTRUCTIONS, "Python")
 
     cleaned_path = re.sub(r"^(\.\./|\.\/)+", "", script)
 
-    output_file_path = os.path.join(OUTPUT_DIR, cleaned_path)
-    if os.path.exists(output_file_path) and os.path.getmtime(script) < os.path.getmtime(output_file_path):
+    output_file_path = get_output_path(script)
+    if not needs_processing(script, force):
         logger.info(f"Skipping {script} as it is not newer than the existing output.")
         return ""
     else:
         logger.info(f"Processing {script} to create docstrings.")
     ai_response = ""
     os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-    with open(script, "r") as file:
-        script = file.read()
+    with profiling.span("read", "io", file=cleaned_path):
+        with open(script, "r") as file:
+            script = file.read()
+    previous = None
+    if changed_lines and os.path.exists(output_file_path):
+        with open(output_file_path, "r") as output_file:
+            previous = output_file.read()
+    if len(script.strip()) > 0 and (previous is not None or telemetry.estimate_tokens(script) > args.split_tokens):
+        try:
+            ai_response = create_docstrings_split(cleaned_path, script, previous, changed_lines)
+        except SyntaxError as e:
+            logger.warning(f"Unable to split {cleaned_path} at its definitions, processing it as a whole: {e}")
+        else:
+            with open(output_file_path, "w") as output_file:
+                output_file.write(ai_response)
+            logger.info(f"Docstrings created in {output_file_path}")
+            return ai_response
     if len(script.strip()) > 0:
+        # An output with changed or missing definitions is repaired per definition instead of escalated as a whole
+        ai_response = packing.strip_code_fences(run_chain_routed(prompt, script, MODEL_NAME, stage="docstrings",
+                                                                 unit=cleaned_path, unit_complexity=ai.complexity(script)))
+        ai_response = repair_docstrings(cleaned_path, script, ai_response)
         with open(output_file_path, "w") as output_file:
-            ai_response = run_chain(prompt, script, MODEL_NAME)
-            if ai_response.startswith("```"):
-                ai_response = ai_response[9:].strip()
-                ai_response = ai_response.rsplit("```", 1)[0].strip()
-
             output_file.write(ai_response)
         logger.info(f"Docstrings created in {output_file_path}")
     else:
         logger.info(f"Skipping empty file: {output_file_path} ")
     return ai_response
 
+def create_definition_docstrings(unit, context, batch):
+    """
+    Creates docstrings for some top-level definitions of a split script in one request.
+
+    Args:
+        unit (str): The script being processed, for logging and telemetry.
+        context (str): The module context of the script (see python_chunks.module_context).
+        batch (list): Tuples (id, text) of the definitions; the ids are "D" followed by the index of the segment.
+
+    Returns:
+        dict: The definitions with docstrings, by segment index. A definition for which no valid output can be taken from
+        the response is retried individually, and left out when that fails as well.
+    """
+    prompt = ai.instruction_prompt([DEFINITION_INSTRUCTIONS, packing.PACKED_INSTRUCTIONS], "Python")
+    names = {unit_id: python_chunks.split_module(text)[0]["name"] for unit_id, text in batch}
+    originals = dict(batch)
+    ai_response = run_chain_routed(prompt, "Module context:\n" + context + "\nDefinitions:\n" + packing.build_input(batch),
+                                   MODEL_NAME, stage="docstrings", unit=f"{unit}: {', '.join(names.values())}",
+                                   validate=lambda response: packing.is_complete(
+                                       response, batch, lambda unit_id, output: python_chunks.check_definition(
+                                           output, names[unit_id], originals[unit_id])),
+                                   unit_complexity=max(ai.complexity(text) or 0 for _, text in batch))
+    outputs, failed = packing.split_response(ai_response, batch)
+    results = {}
+    for unit_id, output in outputs.items():
+        if python_chunks.check_definition(output, names[unit_id], originals[unit_id]):
+            results[int(unit_id[1:])] = output
+        else:
+            failed.append(unit_id)
+    for unit_id in failed:
+        if len(batch) > 1:
+            results.update(create_definition_docstrings(unit, context, [item for item in batch if item[0] == unit_id]))
+        else:
+            logger.warning(f"No valid docstrings for {names[unit_id]} in {unit}, keeping the definition as it is.")
+    return results
+
+def create_module_docstring(unit, context):
+    """
+    Creates the module docstring of a split script.
+
+    Args:
+        unit (str): The script being processed, for logging and telemetry.
+        context (str): The module context of the script (see python_chunks.module_context).
+
+    Returns:
+        str: The docstring.
+    """
+    prompt = ai.instruction_prompt(MODULE_DOCSTRING_INSTRUCTIONS, "Module context")
+    return packing.strip_code_fences(run_chain_routed(prompt, context, MODEL_NAME, stage="docstrings", unit=unit,
+                                                      validate=lambda response: bool(response.strip())))
+
+def create_docstrings_split(unit, source, previous=None, changed_lines=None):
+    """
+    Creates docstrings for a script that is split at its top-level definitions (see python_chunks.py). The definitions
+    are bin-packed into requests of about half the split threshold, which are processed concurrently; the rest of the
+    script is kept byte-exact.
+
+    When the previous output is given, only the definitions that intersect the changed lines are sent to the model; the
+    other definitions (and the module docstring) are taken from the previous output, matched by name.
+
+    Args:
+        unit (str): The script being processed, for logging and telemetry.
+        source (str): The source code of the script.
+        previous (str, optional): The previous output for the script.
+        changed_lines (list, optional): The changed line ranges of the script, or None if the whole script changed.
+
+    Returns:
+        str: The script with docstrings.
+
+    Raises:
+        SyntaxError: If the script is not valid Python.
+    """
+    segments = python_chunks.split_module(source)
+    keys = python_chunks.definition_keys(segments)
+    outputs = {}
+    module_docstring = None
+    if previous is not None:
+        try:
+            previous_segments = python_chunks.split_module(previous)
+        except SyntaxError:
+            previous_segments = []
+        else:
+            previous_tree = ast.parse(previous)
+            if ast.get_docstring(previous_tree) is not None:
+                module_docstring = ast.get_source_segment(previous, previous_tree.body[0])
+        previous_definitions = dict(zip(python_chunks.definition_keys(previous_segments), previous_segments))
+        for index, (segment, key) in enumerate(zip(segments, keys)):
+            if key is not None and key in previous_definitions and not git_changes.intersects(segment["first"], segment["last"], changed_lines):
+                outputs[index] = previous_definitions[key]["text"]
+    pending = [(f"D{index}", segment["text"]) for index, segment in enumerate(segments)
+               if segment["kind"] == "definition" and index not in outputs]
+    logger.info(f"Processing {len(pending)} of {len(keys) - keys.count(None)} definitions of {unit} in parts.")
+    context = python_chunks.module_context(segments)
+    has_docstring = ast.get_docstring(ast.parse(source)) is not None
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        if not has_docstring and module_docstring is None:
+            module_docstring = executor.submit(create_module_docstring, unit, context)
+        for results in executor.map(lambda batch: create_definition_docstrings(unit, context, batch),
+                                    packing.pack(pending, max(args.split_tokens // 2, 1))):
+            outputs.update(results)
+        if hasattr(module_docstring, "result"):
+            module_docstring = module_docstring.result()
+    script = python_chunks.reassemble(segments, outputs)
+    if not has_docstring and module_docstring:
+        script = add_module_docstring(unit, script, module_docstring)
+    return script
+
+def add_module_docstring(unit, script, docstring):
+    """
+    Adds a module docstring to a reassembled script, unless the result is not valid Python.
+
+    Args:
+        unit (str): The script being processed, for logging.
+        script (str): The script without module docstring.
+        docstring (str): The module docstring, with or without quotes.
+
+    Returns:
+        str: The script with the module docstring, or the script as it was.
+    """
+    with_docstring = python_chunks.insert_module_docstring(script, docstring)
+    try:
+        ast.parse(with_docstring)
+    except SyntaxError:
+        logger.warning(f"Invalid module docstring for {unit}, leaving it out.")
+        return script
+    return with_docstring
+
+def repair_docstrings(unit, source, output):
+    """
+    Verifies the output for a script against its source, ignoring docstrings (see python_chunks.verify). When the
+    model changed the code or the output is truncated, only the definitions that differ or are missing are requested
+    again (in small requests); the other definitions are taken from the output and the code between the definitions
+    from the source.
+
+    Args:
+        unit (str): The script being processed, for logging and telemetry.
+        source (str): The source code of the script.
+        output (str): The output of the model for the whole script, without code fence.
+
+    Returns:
+        str: The verified script with docstrings.
+    """
+    try:
+        segments = python_chunks.split_module(source)
+    except SyntaxError:
+        logger.warning(f"Unable to verify the output for {unit}, as the script is not valid Python.")
+        return output
+    verification = python_chunks.verify(segments, output)
+    if verification["identical"]:
+        return output
+    differing = verification["differing"]
+    logger.warning(f"The output for {unit} does not have the original code; requesting {len(differing)} definitions again.")
+    outputs = verification["definitions"]
+    context = python_chunks.module_context(segments)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for results in executor.map(lambda batch: create_definition_docstrings(unit, context, batch),
+                                    packing.pack([(f"D{index}", segments[index]["text"]) for index in differing],
+                                                 max(args.split_tokens // 2, 1))):
+            outputs.update(results)
+    script = python_chunks.reassemble(segments, outputs)
+    if verification["module_docstring"] and ast.get_docstring(ast.parse(source)) is None:
+        script = add_module_docstring(unit, script, verification["module_docstring"])
+    return script
+
+def create_docstrings_packed(scripts, sources):
+    """
+    Creates docstrings for several small scripts in one request (see packing.py).
+
+    Args:
+        scripts (list): The paths to the Python script files.
+        sources (dict): The source code of each script, by path.
+
+    Returns:
+        list: The scripts for which no valid output could be taken from the response; these need to be processed
+        individually.
+
+    Side Effects:
+        Writes the scripts with docstrings to the output directory.
+    """
+    prompt = ai.instruction_prompt([DOCSTRING_INSTRUCTIONS, packing.PACKED_INSTRUCTIONS], "Python scripts")
+    batch = [(f"S{index}", sources[script]) for index, script in enumerate(scripts)]
+    logger.info(f"Processing {len(scripts)} scripts in one request to create docstrings.")
+    ai_response = run_chain_routed(prompt, packing.build_input(batch), MODEL_NAME, stage="docstrings", unit=", ".join(scripts),
+                                   validate=lambda response: packing.is_complete(response, batch),
+                                   unit_complexity=max(ai.complexity(text) or 0 for _, text in batch))
+    outputs, failed = packing.split_response(ai_response, batch)
+    for unit_id, output in outputs.items():
+        script = scripts[int(unit_id[1:])]
+        output = repair_docstrings(script, sources[script], output)
+        output_file_path = get_output_path(script)
+        os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+        with open(output_file_path, "w") as output_file:
+            output_file.write(output)
+        logger.info(f"Docstrings created in {output_file_path}")
+    if failed:
+        logger.warning(f"{len(failed)} scripts could not be taken from the packed response, processing them individually.")
+    return [scripts[int(unit_id[1:])] for unit_id in failed]
+
+def process_script(script_path, force=False, changed_lines=None):
+    """
+    Creates the docstrings for one script, as a unit of work of the thread pool.
+
+    Args:
+        script_path (str): The path to the Python script file.
+        force (bool): Process the script even if the existing output is newer.
+        changed_lines (list, optional): The changed line ranges of the script, or None if the whole script changed.
+    """
+    with profiling.span("create_docstrings", "unit", file=script_path):
+        create_docstrings(script_path, force, changed_lines)
+
+def process_queued_script(script, payload):
+    """
+    Creates the docstrings for a script leased from the work queue (see work_queue.py).
+
+    Args:
+        script (str): The path to the Python script file.
+        payload (dict): The changed line ranges of the script ("changed_lines"), or None if the whole script changed.
+    """
+    process_script(script, True, payload["changed_lines"])
+
+def select_changed_scripts(since):
+    """
+    Selects the scripts that changed since a git reference, and updates the outputs of deleted and renamed scripts.
+
+    Args:
+        since (str): The git reference to compare with.
+
+    Returns:
+        dict: Maps the paths of the added and modified scripts to their changed line ranges (None if the whole script
+        changed).
+
+    Side Effects:
+        Removes the outputs of deleted scripts and moves the outputs of renamed scripts (unless planning).
+        Exits the program if the changes cannot be determined with git.
+    """
+    changed = git_changes.changes(CODEBASE_DIR, since, logger)
+    if changed is None:
+        logger.error(f"Error: Unable to determine the changes in {CODEBASE_DIR} since {since}.")
+        sys.exit(1)
+    changed = {path: change for path, change in changed.items() if path.endswith(".py")}
+    output_path = lambda path: get_output_path(os.path.join(CODEBASE_DIR, path))
+    if args.plan:
+        # Do not touch the outputs when planning
+        unchanged = set(path for path, change in changed.items()
+                        if change["status"] == "R" and not change["lines"] and os.path.exists(output_path(change["old_path"])))
+    else:
+        unchanged = git_changes.apply_deletions_and_renames(changed, output_path, logger)
+    scripts = {os.path.join(CODEBASE_DIR, path): change["lines"] for path, change in changed.items()
+               if change["status"] != "D" and path not in unchanged}
+    logger.info(f"{len(scripts)} scripts changed since {since}")
+    return scripts
+
 def create_mdocs_report(documentation):
     """
     Generates a summary report of the documentation using AI.
 
     Args:
-        documentation (str): The documentation content to summarize.
+        documentation (str): The condensed documentation to summarize (see condense_documentation).
 
     Returns:
         str: The AI-generated summary of the documentation.
@@ -141,21 +497,17 @@ def create_mdocs_report(documentation):
         Writes the summary to a file in the output directory.
         Logs the process of creating the summary.
     """
-    prompt = ChatPromptTemplate.from_template("""
-        Here is the output of a mdocs analysis of the docstrings in this module.
-        Summarize the key functionalities and workflows described in this documentation.md. 
+    prompt = ai.instruction_prompt("""
+        Here is the documentation generated from the docstrings in this module, condensed per module.
+        Summarize the key functionalities and workflows described in this documentation. 
         Highlight the main modules, their responsibilities, and how they interact. 
         Additionally, point out any unique features or design patterns used.
-
-        Documentation:
-         {input}
-        """
-    )
+        """, "Documentation")
     
     output_file_path = os.path.join(OUTPUT_DOCS, "documentation_summary_ai.md")
     ai_response = ""
     with open(output_file_path, "w") as output_file:
-        ai_response = run_chain(prompt, documentation, MODEL_NAME)
+        ai_response = run_chain(prompt, documentation, MODEL_NAME, stage="docs")
         output_file.write(ai_response)
     logger.info(f"Documentation summary saved to {output_file_path}")
     return ai_response
@@ -165,7 +517,7 @@ def create_mdocs_onboarding(documentation):
     Creates an onboarding guide for new developers based on the documentation.
 
     Args:
-        documentation (str): The documentation content to use for the onboarding guide.
+        documentation (str): The condensed documentation to use for the onboarding guide (see condense_documentation).
 
     Returns:
         str: The AI-generated onboarding guide.
@@ -174,40 +526,261 @@ def create_mdocs_onboarding(documentation):
         Writes the onboarding guide to a file in the output directory.
         Logs the process of creating the onboarding guide.
     """
-    prompt = ChatPromptTemplate.from_template("""
-        Here is the output of a mdocs analysis of the docstrings in this module.
-        Create an onboarding guide for new developers based on the documentation.md. 
+    prompt = ai.instruction_prompt("""
+        Here is the documentation generated from the docstrings in this module, condensed per module.
+        Create an onboarding guide for new developers based on the documentation. 
         Explain the codebase structure, key modules to focus on, and the typical development workflow.
-
-        Documentation:
-         {input}
-        """
-    )
+        """, "Documentation")
     
     output_file_path = os.path.join(OUTPUT_DOCS, "documentation_onboarding_ai.md")
     ai_response = ""
     with open(output_file_path, "w") as output_file:
-        ai_response = run_chain(prompt, documentation, MODEL_NAME)
+        ai_response = run_chain(prompt, documentation, MODEL_NAME, stage="docs")
         output_file.write(ai_response)
     logger.info(f"Documentation onboarding saved to {output_file_path}")
     return ai_response
 
-def process_mdocs():
+def build_documentation():
     """
-    Processes the mdocs settings and generates the documentation file.
+    Builds (or updates) the documentation file from the docstrings of the scripts in the output directory.
+
+    Returns:
+        dict: The result of the build (see doc_builder.build), including the modules whose section changed.
 
     Side Effects:
-        Writes the mdocs settings to a JSON file.
-        Executes shell commands to generate and move the documentation file.
+        Writes the documentation file to the docs directory, when it changed.
         Logs the process of generating the documentation.
     """
-    config = {"title": f"{TITLE}", "description": f"{DESCRIPTION}", "developer": f"{DEVELOPER}", "mail": f"{MAIL}", "link": f"{LINK}"}
-    mdocs_settings_path = os.path.join(OUTPUT_DIR, "mdocs_settings.json")
-    with open(mdocs_settings_path, "w") as settings_file:
-        json.dump(config, settings_file, indent=4)
-    logger.info(f"mdocs running on {OUTPUT_DIR}{CODEBASE_DIR}")
-    run_command(f"mdocs {OUTPUT_DIR}{CODEBASE_DIR}", output_file=None, logger=logger)
-    run_command(f"mv {OUTPUT_DIR}documentation.md {OUTPUT_DOCS}", output_file=None, logger=logger)
+    logger.info(f"Building documentation of {OUTPUT_DIR}{CODEBASE_DIR}")
+    header = doc_builder.render_header(TITLE, DESCRIPTION, DEVELOPER, MAIL, LINK)
+    return doc_builder.build(OUTPUT_DIR + CODEBASE_DIR, os.path.join(OUTPUT_DOCS, "documentation.md"), header, CACHE_DIR)
+
+def condense_section(path, section):
+    """
+    Condenses the documentation section of a module into a short overview, reusing the cached overview when the section did
+    not change. Small sections are used as they are.
+
+    Args:
+        path (str): The path of the module, used for the heading, logging and telemetry.
+        section (str): The documentation section of the module (see doc_builder.render_module).
+
+    Returns:
+        str: The condensed section in Markdown.
+    """
+    if telemetry.estimate_tokens(section) <= CONDENSE_TOKENS:
+        return section
+    prompt = ai.instruction_prompt("""
+        Here is the documentation of one module of a codebase, generated from its docstrings.
+        Condense it into a short overview for readers of the whole codebase: the purpose of the module, its main functions
+        and classes and how they are used, the other modules and external tools it depends on, and any side effects,
+        issues or future work that stand out. Output Markdown without a heading.
+        """, "Documentation")
+    key = cache.make_key(MODEL_NAME, prompt.format(input=section))
+    condensed = cache.load(CACHE_DIR, "documentation_condensed", key)
+    if condensed is None:
+        condensed = run_chain_routed(prompt, section, MODEL_NAME, stage="docs", unit=path,
+                                     validate=lambda response: bool(response.strip()))
+        cache.store(CACHE_DIR, "documentation_condensed", key, condensed)
+    return f"## Module {path}\n{condensed.strip()}\n\n"
+
+def condense_documentation(sections):
+    """
+    Condenses the documentation once, per module and concurrently, as the shared input of the summary and the onboarding.
+
+    Args:
+        sections (dict): The documentation section of each module, by module path (see doc_builder.build).
+
+    Returns:
+        str: The header of the documentation followed by the condensed sections, in the order of the modules.
+    """
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        condensed = list(executor.map(lambda path: condense_section(path, sections[path]), sorted(sections)))
+    return doc_builder.render_header(TITLE, DESCRIPTION, DEVELOPER, MAIL, LINK) + "".join(condensed)
+
+def select_packed(scripts, changed_lines):
+    """
+    Selects the small scripts (up to a quarter of the budget) to pack into shared requests, unless only some of their
+    definitions changed, and bin-packs them.
+
+    Args:
+        scripts (list): The paths of the scripts to process.
+        changed_lines (dict): The changed line ranges by script, when selecting changes with git.
+
+    Returns:
+        tuple: The source code of the small scripts (dict by path) and the batches of more than one script (lists of
+        (path, source) tuples).
+    """
+    sources = {}
+    for script in scripts:
+        if 0 < os.path.getsize(script) <= args.pack_budget and not changed_lines.get(script):
+            with profiling.span("read", "io", file=script):
+                with open(script, "r") as file:
+                    source = file.read()
+            if 0 < telemetry.estimate_tokens(source) <= args.pack_budget // 4:
+                sources[script] = source
+    return sources, [batch for batch in packing.pack(list(sources.items()), args.pack_budget) if len(batch) > 1]
+
+def plan_docstrings(scripts, sources, batches, changed_lines):
+    """
+    Describes the docstring calls a run would make, without calling the model (see planner.py).
+
+    Args:
+        scripts (list): The paths of the scripts to process.
+        sources (dict): The source code of the small scripts, by path.
+        batches (list): The batches of packed scripts (see select_packed).
+        changed_lines (dict): The changed line ranges by script, when selecting changes with git.
+
+    Returns:
+        list: The planned calls (see planner.call).
+    """
+    calls = []
+
+    def plan(stage, instructions, text, unit, unit_complexity=None, ratio=DOCSTRING_OUTPUT_RATIO):
+        model = ai.route(text, MODEL_NAME, stage, unit_complexity)[0]
+        calls.append(planner.call(stage, model, instructions + text, telemetry.estimate_tokens(text) * ratio, unit))
+
+    for batch in batches:
+        plan("docstrings", DOCSTRING_INSTRUCTIONS + packing.PACKED_INSTRUCTIONS, packing.build_input(batch),
+             ", ".join(script for script, _ in batch), max(ai.complexity(source) or 0 for _, source in batch))
+    packed = set(script for batch in batches for script, _ in batch)
+    for script in scripts:
+        if script in sources:
+            source = sources[script]
+        else:
+            with open(script, "r") as file:
+                source = file.read()
+        if script in packed or not source.strip():
+            continue
+        output_file_path = get_output_path(script)
+        narrowed = changed_lines.get(script) and os.path.exists(output_file_path)
+        try:
+            segments = python_chunks.split_module(source) if narrowed or telemetry.estimate_tokens(source) > args.split_tokens else None
+        except SyntaxError:
+            segments = None
+        if segments is None:
+            plan("docstrings", DOCSTRING_INSTRUCTIONS, source, script, ai.complexity(source))
+            continue
+        pending = [(f"D{index}", segment["text"]) for index, segment in enumerate(segments) if segment["kind"] == "definition"
+                   and (not narrowed or git_changes.intersects(segment["first"], segment["last"], changed_lines[script]))]
+        context = python_chunks.module_context(segments)
+        for batch in packing.pack(pending, max(args.split_tokens // 2, 1)):
+            plan("docstrings", DEFINITION_INSTRUCTIONS + packing.PACKED_INSTRUCTIONS,
+                 "Module context:\n" + context + "\nDefinitions:\n" + packing.build_input(batch), script,
+                 max(ai.complexity(text) or 0 for _, text in batch))
+        if not narrowed and ast.get_docstring(ast.parse(source)) is None:
+            plan("docstrings", MODULE_DOCSTRING_INSTRUCTIONS, context, script, ratio=0.1)
+    return calls
+
+def plan_documentation(scripts):
+    """
+    Describes the calls of the documentation stage, without calling the model (see planner.py): the condensing of the
+    larger sections, then the report and the onboarding. The size of a section is estimated from the size of the script;
+    cached sections are not taken into account.
+
+    Args:
+        scripts (list): The paths of the scripts in the documentation.
+
+    Returns:
+        list: The planned calls (see planner.call).
+    """
+    calls = []
+    condensed = ""
+    for script in scripts:
+        with open(script, "r") as file:
+            source = file.read()
+        section = source[:int(len(source) * DOCUMENTATION_RATIO)]
+        if telemetry.estimate_tokens(section) > CONDENSE_TOKENS:
+            calls.append(planner.call("docs: condense", ai.route(section, MODEL_NAME, "docs")[0], section, CONDENSE_TOKENS,
+                                      script))
+            section = section[:len(section) * CONDENSE_TOKENS // telemetry.estimate_tokens(section)]
+        condensed += section
+    if scripts:
+        calls += [planner.call("docs", MODEL_NAME, condensed, 1500, unit) for unit in ("summary", "onboarding")]
+    return calls
+
+def create_documentation():
+    """
+    Builds the documentation from the scripts with docstrings, and creates the report and onboarding from it when it
+    changed.
+
+    Side Effects:
+        Writes the documentation, the report and the onboarding to the docs directory.
+        Logs the process.
+    """
+    logger.info("Creating documentation file")
+    with profiling.span("build_documentation", "stage"):
+        build = build_documentation()
+    outputs = [os.path.join(OUTPUT_DOCS, name) for name in ("documentation_summary_ai.md", "documentation_onboarding_ai.md")]
+    if not build["changed"] and not build["removed"] and all(os.path.exists(path) for path in outputs):
+        logger.info("Documentation did not change, keeping the existing report and onboarding")
+    elif build["sections"]:
+        with profiling.span("condense_documentation", "stage"):
+            documentation = condense_documentation(build["sections"])
+        # The report and the onboarding share the condensed documentation and are created concurrently
+        logger.info("Creating report and onboarding")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            report = executor.submit(create_mdocs_report, documentation)
+            onboarding = executor.submit(create_mdocs_onboarding, documentation)
+            report.result()
+            onboarding.result()
+    else:
+        logger.error(f"Error: No Python scripts found in {OUTPUT_DIR}{CODEBASE_DIR} to document.")
+
+def process_changes(paths, sources):
+    """
+    Reprocesses the scripts that changed in watch mode. Only the definitions intersecting the changed lines are sent to
+    the model again (see create_docstrings_split), and the documentation is rebuilt afterwards.
+
+    Args:
+        paths (list): The changed paths; a path that no longer exists was deleted.
+        sources (dict): The last processed content by script, updated with the changed scripts.
+
+    Side Effects:
+        Writes the scripts with docstrings, removes the outputs of deleted scripts and rebuilds the documentation.
+    """
+    scripts = {}
+    for path in paths:
+        output_file_path = get_output_path(path)
+        if not os.path.exists(path):
+            sources.pop(path, None)
+            if os.path.exists(output_file_path) and os.path.abspath(output_file_path) != os.path.abspath(path):
+                os.remove(output_file_path)
+                logger.info(f"Removed {output_file_path}, as {path} was deleted.")
+            continue
+        with open(path, "r") as file:
+            source = file.read()
+        if source == sources.get(path):
+            continue
+        scripts[path] = watch.changed_lines(sources.get(path), source)
+        sources[path] = source
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(lambda script: process_script(script, True, scripts[script]),
+                          planner.largest_first(scripts, os.path.getsize)))
+    for script in scripts:
+        watch.suppress(get_output_path(script))
+        if os.path.abspath(get_output_path(script)) == os.path.abspath(script):
+            # The script was overwritten with its docstrings
+            with open(script, "r") as file:
+                sources[script] = file.read()
+    create_documentation()
+
+def watch_codebase():
+    """
+    Keeps running after the first run, and reprocesses the scripts that change (see watch.py). When only the
+    documentation is created (--python F), the documentation is rebuilt when the scripts with docstrings change.
+    """
+    if args.python not in ['T', 't']:
+        watch.watch(OUTPUT_DIR + CODEBASE_DIR, (".py",), lambda paths: create_documentation(), logger, args.debounce,
+                    args.poll_interval)
+        return
+    sources = {}
+    for root, dirs, files in os.walk(CODEBASE_DIR):
+        for file in files:
+            if file.endswith(".py"):
+                with open(os.path.join(root, file), "r") as script:
+                    sources[os.path.join(root, file)] = script.read()
+    watch.watch(CODEBASE_DIR, (".py",), lambda paths: process_changes(paths, sources), logger, args.debounce,
+                args.poll_interval)
 
 def main():
     """
@@ -224,26 +797,58 @@ def main():
         logger.error(f"Error: Directory {CODEBASE_DIR} does not exist.")
         sys.exit(1)
 
+    if args.worker:
+        # The scripts are enqueued, and the documentation is created, by the process started without --worker
+        work_queue.run_worker(args.queue, "docstrings", process_queued_script, logger, args.workers, args.lease, wait=True)
+        return
+
     if args.python in ['T', 't']:
         logger.info(f"Analyzing scripts at: {CODEBASE_DIR}")
         logger.info(f"Scripts with docstrings will be saved to: {OUTPUT_DIR}")
-        for root, dirs, files in os.walk(CODEBASE_DIR):
-            for file in files:
-                if file.endswith(".py"):
-                    script_path = os.path.join(root, file)
-                    create_docstrings(script_path)
-    logger.info("Creating mdocs file")
-    process_mdocs()
-    documentation_path = os.path.join(OUTPUT_DOCS, "documentation.md")
-    if os.path.exists(documentation_path):
-        with open(documentation_path, "r") as doc_file:
-            documentation = doc_file.read()
-        logger.info("Creating report")
-        create_mdocs_report(documentation)
-        logger.info("Creating onboarding")
-        create_mdocs_onboarding(documentation)
-    else:
-        logger.error(f"Error: {documentation_path} does not exist.")
+        since = git_changes.get_since(args)
+        changed_lines = {}
+        if since:
+            changed_lines = select_changed_scripts(since)
+            scripts = list(changed_lines)
+        else:
+            with profiling.span("walk", "walk", cpu=True, directory=CODEBASE_DIR):
+                scripts = [os.path.join(root, file) for root, dirs, files in os.walk(CODEBASE_DIR)
+                           for file in files if file.endswith(".py")]
+        scripts = [script for script in scripts if needs_processing(script, force=bool(since))]
+        sources, batches = select_packed(scripts, changed_lines)
+        packed = set(script for batch in batches for script, _ in batch)
+        if args.plan:
+            calls = plan_docstrings(scripts, sources, batches, changed_lines) + plan_documentation(scripts)
+            planner.report(planner.estimate(calls, args.workers), args.workers, logger)
+            return
+        if args.queue:
+            # The scripts are spread over the worker processes of the queue, largest first; this process is one of them
+            work_queue.enqueue(args.queue, "docstrings", {script: {"changed_lines": changed_lines.get(script)}
+                                                          for script in planner.largest_first(scripts, os.path.getsize)})
+            work_queue.run_worker(args.queue, "docstrings", process_queued_script, logger, args.workers, args.lease)
+            if not work_queue.check_done(args.queue, "docstrings", scripts, logger):
+                logger.error("Not all scripts got their docstrings, not creating the documentation")
+                sys.exit(1)
+        else:
+            # Scripts and packed batches are processed concurrently, largest first; duplicated scripts share one model call
+            tasks = planner.largest_first([("batch", batch) for batch in batches] +
+                                          [("script", script) for script in scripts if script not in packed],
+                                          lambda task: sum(len(source) for _, source in task[1]) if task[0] == "batch"
+                                          else os.path.getsize(task[1]))
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                failed = list(executor.map(
+                    lambda task: create_docstrings_packed([script for script, _ in task[1]], sources) if task[0] == "batch"
+                    else process_script(task[1], True, changed_lines.get(task[1])) or [], tasks))
+                list(executor.map(lambda script_path: process_script(script_path, force=True),
+                                  [script for scripts_failed in failed for script in scripts_failed]))
+    elif args.plan:
+        scripts = [os.path.join(root, file) for root, dirs, files in os.walk(OUTPUT_DIR + CODEBASE_DIR)
+                   for file in files if file.endswith(".py")]
+        planner.report(planner.estimate(plan_documentation(scripts), args.workers), args.workers, logger)
+        return
+    create_documentation()
+    if args.watch:
+        watch_codebase()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,8 +2,12 @@ import os
 import sys
 import argparse
 import logging
-from ai import run_chain
-from langchain_core.prompts import ChatPromptTemplate
+import telemetry
+import profiling
+import packing
+import cache
+import directory_summaries
+from ai import run_chain, instruction_prompt
 
 """
 This script analyzes a codebase and creates or updates a README.md file using AI. 
@@ -17,7 +21,10 @@ parser.add_argument("-o", "--output", required=True, help="The location of the R
 parser.add_argument("-t", "--title", default="Repository documentation", help="Title of the documentation")
 parser.add_argument("-l", "--log_file", default='./analysis.log', help="The file to save the log.")
 parser.add_argument("-m", "--model_name", default="gpt-4o", help="OpenAI model name.")
+parser.add_argument("-w", "--workers", type=int, default=4, help="The number of directories to summarize concurrently.")
+parser.add_argument("-T", "--telemetry_dir", default=None, help="The directory to write the LLM telemetry (trace, summary and metrics) to.")
 
+profiling.add_arguments(parser)
 args = parser.parse_args()
 
 # Configure logging
@@ -30,6 +37,11 @@ logging.basicConfig(
 # Create a logger object
 logger = logging.getLogger(__name__)
 
+profiling.configure(args.profile, args.profile_cpu)
+
+if args.telemetry_dir:
+    telemetry.configure(args.telemetry_dir)
+
 CODEBASE_DIR = args.codebase_dir
 if not os.path.exists(CODEBASE_DIR):
     logger.error(f"Error: Directory {CODEBASE_DIR} does not exist.")
@@ -50,6 +62,30 @@ MODEL_NAME = args.model_name
 # Ensure output directory exists
 os.makedirs(os.path.dirname(OUTPUT_DOC), exist_ok=True)
 
+# The directory summaries are cached next to the README
+CACHE_DIR = os.path.join(os.path.dirname(OUTPUT_DOC), cache.CACHE_DIRNAME)
+
+SUMMARY_INSTRUCTIONS = """
+Please summarize the directory of a codebase below for the README.md of the project, in at most 150 words. The input lists
+a digest of each file in the directory (the docstrings and signatures of Python scripts, the start of other files) and the
+summaries of its subdirectories. Describe the purpose of the directory and its main modules, scripts (marked as runnable)
+and subdirectories, in plain text without headings.
+"""
+
+def summarize_directory(name, input):
+    """
+    Summarizes a directory of the codebase from the digests of its files and the summaries of its subdirectories.
+
+    Args:
+        name (str): The path of the directory, relative to the codebase directory.
+        input (str): The digests and summaries (see directory_summaries.summarize_tree).
+
+    Returns:
+        str: The AI-generated summary.
+    """
+    prompt = instruction_prompt(SUMMARY_INSTRUCTIONS, "Directory")
+    return run_chain(prompt, input, MODEL_NAME, stage="readme").strip()
+
 def create_readme(input):
     """
     Generates or updates a README.md file based on the provided input using an AI model.
@@ -67,7 +103,7 @@ def create_readme(input):
     Raises:
         - Logs an error if the AI response is empty.
     """
-    prompt = ChatPromptTemplate.from_template("""
+    prompt = instruction_prompt("""
     A README.md serves as the main entry point for users and developers to understand and use the project. It should be clear, structured, and 
     informative.
 
@@ -84,18 +120,13 @@ def create_readme(input):
     - Contributing Guide (for open-source projects)
     - License & Author Information
     
-    The files you can use as a reference are listed below, using $$$$$ as a separator:
-    
-    {input}
-        """
-    )
+    The summaries of the codebase and its top-level directories, and the files you can use as a reference, are listed below, 
+    using $$$$$ as a separator:
+    """)
 
     ai_response = ""
-    ai_response = run_chain(prompt, input, MODEL_NAME)
-    if ai_response.startswith("```"):
-        ai_response = ai_response[9:].strip()
-    if ai_response.endswith("```"):
-        ai_response = ai_response[:-3]
+    ai_response = run_chain(prompt, input, MODEL_NAME, stage="readme")
+    ai_response = packing.strip_code_fences(ai_response)
 
     if len(ai_response.strip()) > 0:
         with open(OUTPUT_DOC, "w") as output_file:
@@ -122,29 +153,28 @@ def main():
 
     input_text = f"$$$$$ Title:  {TITLE} $$$$$\n\n"
     readme_text = "$$$$$ NO EXISTING README.md, please create new one $$$$$\n"
- 
-    for root, dirs, files in os.walk(CODEBASE_DIR):
-        for file in files:
-            script_path = os.path.join(root, file)
-            if file == "README.md":
-                with open(script_path, "r") as readme_file:
-                    readme_text = f"\n$$$$$ Existing README.md $$$$$\n" + readme_file.read() + f"\n$$$$$ End of existing README.md $$$$$\n"
-            if file == "LICENSE":
-                with open(script_path, "r") as license_file:
-                    input_text += f"\n$$$$$ License file {file} $$$$$\n" + license_file.read() + f"\n$$$$$ End of license file {file} $$$$$\n"
-
-            if file.endswith(".md") and file != "README.md":
-                with open(script_path, "r") as doc_file:
-                    input_text += f"\n$$$$$ Documentation file {script_path} $$$$$\n" + doc_file.read() + f"\n$$$$$ End of documentation file {script_path} $$$$$\n"
-
-            if file.endswith(".py"):
-                with open(script_path, "r") as python_file:
-                    python_script = python_file.read()
-                    if "__main__" in python_script:
-                        input_text += f"\n$$$$$ Python script {script_path} $$$$$\n" + python_script + f"\n$$$$$ End of Python script {script_path} $$$$$\n"
-            if file == "requirements.txt":
-                with open(script_path, "r") as req_file:
-                    input_text += f"\n$$$$$ Requirements file {file} $$$$$\n" + req_file.read() + f"\n$$$$$ End of requirements file {file} $$$$$\n"
+
+    # The codebase is summarized bottom-up; only the summaries of the top level go into the README prompt
+    with profiling.span("summaries", "summaries", directory=CODEBASE_DIR):
+        summaries = directory_summaries.summarize_tree(CODEBASE_DIR, summarize_directory, CACHE_DIR,
+                                                       salt=f"{MODEL_NAME}\n{SUMMARY_INSTRUCTIONS}", workers=args.workers)
+    for name, summary in sorted(summaries.items()):
+        if name == ".":
+            input_text += f"\n$$$$$ Summary of the codebase $$$$$\n" + summary + f"\n$$$$$ End of summary of the codebase $$$$$\n"
+        elif os.sep not in name:
+            input_text += f"\n$$$$$ Summary of directory {name} $$$$$\n" + summary + f"\n$$$$$ End of summary of directory {name} $$$$$\n"
+
+    for file in sorted(os.listdir(CODEBASE_DIR)):
+        script_path = os.path.join(CODEBASE_DIR, file)
+        if file == "README.md":
+            with open(script_path, "r") as readme_file:
+                readme_text = f"\n$$$$$ Existing README.md $$$$$\n" + readme_file.read() + f"\n$$$$$ End of existing README.md $$$$$\n"
+        if file == "LICENSE":
+            with open(script_path, "r") as license_file:
+                input_text += f"\n$$$$$ License file {file} $$$$$\n" + license_file.read() + f"\n$$$$$ End of license file {file} $$$$$\n"
+        if file == "requirements.txt":
+            with open(script_path, "r") as req_file:
+                input_text += f"\n$$$$$ Requirements file {file} $$$$$\n" + req_file.read() + f"\n$$$$$ End of requirements file {file} $$$$$\n"
 
     input_text += readme_text
 
@@ -2,15 +2,27 @@
 This script generates analysis reports based on the analysis of a codebase using AI. It processes reports generated by 
 various tools like Vulture, Pylint, Radon CC, and Radon MI, and uses OpenAI to create summaries and suggestions for 
 improvement. The script requires an OpenAI API key and uses environment variables for configuration.
-"""
 
-from langchain_core.prompts import ChatPromptTemplate
+The reports are not sent to the model as they are: each report is streamed line by line into a compact digest (counts and
+the most severe entries, see report_digest.py), so the memory and the prompt stay small whatever the size of the report.
+The summaries of the four reports are created concurrently; the full report is created as soon as the last one is available
+and is streamed to disk. Summaries are cached by digest, so unchanged reports are not sent to the model again.
+In watch mode the summaries are refreshed whenever analyse_codebase.py (in watch mode) updates a report.
+"""
 
 import os
 import sys
 import argparse
 import logging
-from ai import run_chain
+from concurrent.futures import ThreadPoolExecutor
+import cache
+import telemetry
+import profiling
+import planner
+import ai
+import watch
+import report_digest
+from ai import run_chain_routed
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(description="Create reports based on the analysis of a codebase using AI.")
@@ -18,6 +30,11 @@ parser.add_argument("-r", "--report_dir", required=True, help="The directory of
 parser.add_argument("-o", "--output_dir", required=True, help="The directory to save the analysis reports generated by AI.")
 parser.add_argument("-l", "--log_file", default='./analysis.log', help="The file to save the log.")
 parser.add_argument("-m", "--model_name", default="gpt-4o", help="OpenAI model name.")
+parser.add_argument("-T", "--telemetry_dir", default=None, help="The directory to write the LLM telemetry (trace, summary and metrics) to.")
+profiling.add_arguments(parser)
+ai.add_arguments(parser)
+planner.add_arguments(parser)
+watch.add_arguments(parser)
 args = parser.parse_args()
 
 # Configure logging
@@ -30,6 +47,13 @@ logging.basicConfig(
 # Create a logger object
 logger = logging.getLogger(__name__)
 
+profiling.configure(args.profile, args.profile_cpu)
+ai.configure_routing(args.routing)
+ai.set_token_budget(args.token_budget)
+
+if args.telemetry_dir:
+    telemetry.configure(args.telemetry_dir)
+
 REPORT_DIR = args.report_dir
 if not REPORT_DIR.endswith('/'):
     REPORT_DIR += '/'
@@ -37,16 +61,46 @@ OUTPUT_DIR = args.output_dir
 if not OUTPUT_DIR.endswith('/'):
     OUTPUT_DIR += '/'
 MODEL_NAME = args.model_name
+CACHE_DIR = os.path.join(OUTPUT_DIR, cache.CACHE_DIRNAME)
 
 # Ensure output directory exists
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+def summarize(prompt, report, unit, output_file_path):
+    """
+    Summarizes a report using AI, reusing the cached summary when the report and prompt did not change.
+
+    Args:
+        prompt (ChatPromptTemplate): The prompt template for the summary.
+        report (str): The digest of the report.
+        unit (str): The name of the report, used for telemetry.
+        output_file_path (str): The markdown file to write the summary to.
+
+    Returns:
+        str: The AI-generated (or cached) summary.
+
+    Side Effects:
+        Streams the summary to the output file and stores it in the cache.
+    """
+    key = cache.make_key(MODEL_NAME, prompt.format(input=report))
+    ai_response = cache.load(CACHE_DIR, "report", key)
+    if ai_response is None:
+        with open(output_file_path, "w") as output_file:
+            ai_response = run_chain_routed(prompt, report, model_name=MODEL_NAME, stage="report", unit=unit,
+                                           validate=lambda response: bool(response.strip()), output_file=output_file)
+        cache.store(CACHE_DIR, "report", key, ai_response)
+    else:
+        logger.info(f"Reusing cached summary for {unit} report")
+        with open(output_file_path, "w") as output_file:
+            output_file.write(ai_response)
+    return ai_response
+
 def create_vulture_report(report):
     """
     Creates a summary report for Vulture analysis using AI.
 
     Args:
-        report (str): The Vulture analysis report content.
+        report (str): The digest of the Vulture analysis report.
 
     Returns:
         str: The AI-generated summary of the Vulture report.
@@ -54,25 +108,17 @@ def create_vulture_report(report):
     Side Effects:
         Writes the summary to a markdown file in the output directory.
     """
-    prompt = ChatPromptTemplate.from_template("""
-        Here is the output of a vulture analysis report that lists unused code, functions, and variables in a Python project.
+    prompt = ai.instruction_prompt("""
+        Here is a digest (counts and the top entries) of a vulture analysis report that lists unused code, functions, and variables in a Python project.
 
         Please:
          - Summarize the unused functions, variables, and classes.
          - Identify any critical-looking unused code that might need further investigation.
          - Suggest which unused code can likely be removed safely and which might need a review for hidden dependencies
-                                                
-
-        Report:
-         {input}
-        """
-    )
+        """, "Report")
     
     output_file_path = os.path.join(OUTPUT_DIR, "vulture_analysis_summary_ai.md")
-    ai_response = ""
-    with open(output_file_path, "w") as output_file:
-        ai_response = run_chain(prompt, report, model_name=MODEL_NAME)
-        output_file.write(ai_response)
+    ai_response = summarize(prompt, report, "vulture", output_file_path)
     logger.info(f"Vulture analysis summary saved to {output_file_path}")
     return ai_response
 
@@ -81,7 +127,7 @@ def create_pylint_report(report):
     Creates a summary report for Pylint analysis using AI.
 
     Args:
-        report (str): The Pylint analysis report content.
+        report (str): The digest of the Pylint analysis report.
 
     Returns:
         str: The AI-generated summary of the Pylint report.
@@ -89,8 +135,8 @@ def create_pylint_report(report):
     Side Effects:
         Writes the summary to a markdown file in the output directory.
     """
-    prompt = ChatPromptTemplate.from_template("""
-        Here is the output of a pylint analysis report that highlights code quality issues in a Python project.
+    prompt = ai.instruction_prompt("""
+        Here is a digest (counts and the top entries) of a pylint analysis report that highlights code quality issues in a Python project.
                                               
         Please:
 
@@ -98,16 +144,9 @@ def create_pylint_report(report):
          - Group the issues by type and explain their impact on code quality.
          - Suggest specific fixes or refactoring strategies for the most critical issues.
          - Provide an overall quality assessment of the codebase based on this report.
-
-        Report:
-         {input}
-        """
-    )
+        """, "Report")
     output_file_path = os.path.join(OUTPUT_DIR, "pylint_report_summary_ai.md")
-    ai_response = ""
-    with open(output_file_path, "w") as output_file:
-        ai_response = run_chain(prompt, report) 
-        output_file.write(ai_response)
+    ai_response = summarize(prompt, report, "pylint", output_file_path)
     logger.info(f"Pylint analysis summary saved to {output_file_path}")
     return ai_response
 
@@ -116,7 +155,7 @@ def create_radon_cc_report(report):
     Creates a summary report for Radon CC analysis using AI.
 
     Args:
-        report (str): The Radon CC analysis report content.
+        report (str): The digest of the Radon CC analysis report.
 
     Returns:
         str: The AI-generated summary of the Radon CC report.
@@ -124,25 +163,17 @@ def create_radon_cc_report(report):
     Side Effects:
         Writes the summary to a markdown file in the output directory.
     """
-    prompt = ChatPromptTemplate.from_template("""
-        Here is the output of a radon cc analysis report that measures cyclomatic complexity for functions and methods in a Python project.
+    prompt = ai.instruction_prompt("""
+        Here is a digest (counts and the top entries) of a radon cc analysis report that measures cyclomatic complexity for functions and methods in a Python project.
 
         Please:
 
          - Highlight the functions or methods with the highest complexity scores and explain their impact on maintainability.
          - Suggest ways to refactor or simplify the most complex functions/methods.
          - Provide a general summary of the codebase’s complexity and recommendations for improvement.
-                                              
-
-        Report:
-         {input}
-        """
-    )
+        """, "Report")
     output_file_path = os.path.join(OUTPUT_DIR, "radon_cc_report_summary_ai.md")
-    ai_response = ""
-    with open(output_file_path, "w") as output_file:
-        ai_response = run_chain(prompt, report)
-        output_file.write(ai_response)
+    ai_response = summarize(prompt, report, "radon_cc", output_file_path)
     logger.info(f"Radon cc analysis summary saved to {output_file_path}")
     return ai_response
 
@@ -151,7 +182,7 @@ def create_radon_mi_report(report):
     Creates a summary report for Radon MI analysis using AI.
 
     Args:
-        report (str): The Radon MI analysis report content.
+        report (str): The digest of the Radon MI analysis report.
 
     Returns:
         str: The AI-generated summary of the Radon MI report.
@@ -159,25 +190,17 @@ def create_radon_mi_report(report):
     Side Effects:
         Writes the summary to a markdown file in the output directory.
     """
-    prompt = ChatPromptTemplate.from_template("""
-        Here is the output of a radon mi analysis report that measures the maintainability index of each file in a Python project.
+    prompt = ai.instruction_prompt("""
+        Here is a digest (counts and the top entries) of a radon mi analysis report that measures the maintainability index of each file in a Python project.
 
         Please:
          - List the files with the lowest maintainability index scores.
          - Identify common patterns or reasons for low scores.
          - Suggest specific improvements for increasing maintainability (e.g., reducing complexity, adding comments, splitting large files).
          - Provide an overall assessment of the codebase’s maintainability.
-                                              
-
-        Report:
-         {input}
-        """
-    )
+        """, "Report")
     output_file_path = os.path.join(OUTPUT_DIR, "radon_mi_report_summary_ai.md")
-    ai_response = ""
-    with open(output_file_path, "w") as output_file:
-        ai_response = run_chain(prompt, report) 
-        output_file.write(ai_response)
+    ai_response = summarize(prompt, report, "radon_mi", output_file_path)
     logger.info(f"Radon mi analysis summary saved to {output_file_path}")
     return ai_response
 
@@ -194,7 +217,7 @@ def create_full_report(report):
     Side Effects:
         Writes the summary to a markdown file in the output directory.
     """
-    prompt = ChatPromptTemplate.from_template("""
+    prompt = ai.instruction_prompt("""
         Here is the output of a full analysis report that includes vulture, pylint, radon cc, and radon mi reports for a Python project.
 
         Please:
@@ -202,47 +225,101 @@ def create_full_report(report):
          - Summarize the key findings from each report.
          - Identify common issues across the reports and suggest high-level strategies for improvement.
          - Provide an overall assessment of the codebase’s quality, complexity, and maintainability.
-                                              
-
-        Report:
-         {input}
-        """
-    )
+        """, "Report")
     output_file_path = os.path.join(OUTPUT_DIR, "full_analysis_summary_ai.md")
-    ai_response = ""
-    with open(output_file_path, "w") as output_file:
-        ai_response = run_chain(prompt, report) 
-        output_file.write(ai_response)
+    ai_response = summarize(prompt, report, "full", output_file_path)
     logger.info(f"Full analysis summary saved to {output_file_path}")
     return ai_response
 
+# The reports created by analyse_codebase.py, in the order of the full report
+REPORTS = [
+    ("vulture_report.txt", "Vulture Report", create_vulture_report),
+    ("pylint_report.txt", "Pylint Report", create_pylint_report),
+    ("radon_cc_report.txt", "Radon cc Report", create_radon_cc_report),
+    ("radon_mi_report.txt", "Radon mi Report", create_radon_mi_report),
+]
+
+# Rough sizes for the plan (see planner.py): tokens of the instructions of a summary prompt, and output tokens of a summary
+# and of the full report
+PROMPT_TOKENS = 150
+SUMMARY_TOKENS = 800
+FULL_REPORT_TOKENS = 1500
+
+def select_report_files():
+    """
+    Selects the report files in the report directory that can be summarized.
+
+    Returns:
+        list: Tuples (index in REPORTS, title, path, create_report function), largest report first.
+    """
+    report_files = []
+    for report_file in sorted(os.listdir(REPORT_DIR)):
+        if report_file.endswith(".txt"):
+            for index, (name, title, create_report) in enumerate(REPORTS):
+                if name in report_file:
+                    report_files.append((index, title, os.path.join(REPORT_DIR, report_file), create_report))
+                    break
+    return planner.largest_first(report_files, lambda item: os.path.getsize(item[2]))
+
+def plan_reports():
+    """
+    Describes the calls of the run, without calling the model (see planner.py). Cached summaries are not taken into
+    account.
+
+    Returns:
+        list: The planned calls (see planner.call).
+    """
+    calls = []
+    for index, title, report_path, create_report in select_report_files():
+        report = report_digest.digest_report(report_path)
+        calls.append(planner.call("report", ai.route(report, MODEL_NAME, "report")[0], report, SUMMARY_TOKENS, title))
+        calls[-1]["input_tokens"] += PROMPT_TOKENS
+    if calls:
+        input_tokens = SUMMARY_TOKENS * len(calls)
+        calls.append({"stage": "report: full", "model": ai.route(None, MODEL_NAME, "report", input_tokens=input_tokens)[0],
+                      "unit": "full", "input_tokens": PROMPT_TOKENS + input_tokens, "output_tokens": FULL_REPORT_TOKENS})
+    return calls
+
+def summarize_report_file(report_path, create_report):
+    """
+    Digests a report file and summarizes the digest.
+
+    Args:
+        report_path (str): The path of the report file.
+        create_report (function): The function creating the summary of this type of report.
+
+    Returns:
+        str: The AI-generated summary.
+    """
+    with profiling.span("digest", "io", file=report_path):
+        report = report_digest.digest_report(report_path)
+    with profiling.span("summarize", "stage", report=os.path.basename(report_path)):
+        return create_report(report)
+
 def create_report_with_openai():
     """
     Generates analysis reports using OpenAI.
 
+    The reports are summarized concurrently, largest first. The full report is created from the summaries once all of them
+    are available.
+
     Side Effects:
         Processes each report file in the report directory and generates corresponding AI summaries.
         Writes the summaries to markdown files in the output directory.
     """
     logger.info("Generating analysis reports using OpenAI...")
-    full_report = ""
     # Generate reports for each file in the report directory
-    for report_file in os.listdir(REPORT_DIR):
-        logger.info(f"Processing report: {report_file}")
-        if report_file.endswith(".txt"):
-            report_path = os.path.join(REPORT_DIR, report_file)
-            with open(report_path, "r") as f:
-                report = f.read()
-                if "vulture_report.txt" in report_file:
-                    full_report += "Vulture Report:\n" + create_vulture_report(report) + "\n\n"
-                elif "pylint_report.txt" in report_file:
-                    full_report += "Pylint Report:\n" + create_pylint_report(report) + "\n\n"
-                elif "radon_cc_report.txt" in report_file:
-                    full_report += "Radon cc Report:\n" + create_radon_cc_report(report) + "\n\n" 
-                elif "radon_mi_report.txt" in report_file:
-                    full_report += "Radon mi Report:\n" + create_radon_mi_report(report) + "\n\n"
+    with ThreadPoolExecutor(max_workers=len(REPORTS)) as executor:
+        futures = []
+        for index, title, report_path, create_report in select_report_files():
+            logger.info(f"Processing report: {report_path}")
+            futures.append((index, title, executor.submit(summarize_report_file, report_path, create_report)))
+        # Keep a fixed order of the sections, so an unchanged full report is a cache hit
+        sections = [(title, future.result()) for index, title, future in sorted(futures, key=lambda item: item[0])]
+    full_report = "".join(f"{title}:\n{summary}\n\n" for title, summary in sections)
     if len(full_report) > 0:
-        create_full_report(full_report)
+        with profiling.span("summarize", "stage", report="full"):
+            create_full_report(full_report)
     logger.info(f"Reports generated")
 
 def main():
@@ -259,7 +336,14 @@ def main():
 
     logger.info(f"Analyzing reports at: {REPORT_DIR}")
     logger.info(f"AI reports will be saved to: {OUTPUT_DIR}")
+    if args.plan:
+        planner.report(planner.estimate(plan_reports(), len(REPORTS)), len(REPORTS), logger)
+        return
     create_report_with_openai()
+    if args.watch:
+        # Only the summaries of the changed reports are created again, the others are taken from the cache
+        watch.watch(REPORT_DIR, tuple(name for name, _, _ in REPORTS), lambda paths: create_report_with_openai(), logger,
+                    args.debounce, args.poll_interval)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
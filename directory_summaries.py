@@ -0,0 +1,149 @@
+"""
+This script summarizes a codebase bottom-up, one directory at a time, for the creation of the README (see create_readme.py).
+Each directory is summarized from short digests of its files (the module docstring and signatures of a Python script, the
+start of a documentation file) and the summaries of its subdirectories, so no request contains the whole tree.
+
+Every summary is cached by its path and a Merkle-style hash of its subtree: the hash of a directory combines the hashes of
+its files and the hashes of its subdirectories. When a file changes, only the directories on the path from that file to the root get a new
+hash and are summarized again; the summaries of all other directories are taken from the cache.
+
+Functions:
+- file_digest: Returns a short digest of a file.
+- summarize_tree: Summarizes a directory tree bottom-up.
+"""
+
+import os
+import ast
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import cache
+import telemetry
+
+# Create a logger object
+logger = logging.getLogger(__name__)
+
+# The files that are summarized, by extension or name
+SUMMARY_EXTENSIONS = (".py", ".md", ".txt", ".toml", ".cfg")
+SKIPPED_FILES = ("README.md", "LICENSE")
+
+# Maximum number of estimated tokens of the digest of one file
+DIGEST_TOKENS = 400
+
+def _is_skipped_directory(name):
+    """
+    Checks whether a directory is left out: hidden directories (e.g. the cache) and compiled files.
+    """
+    return name.startswith(".") or name == "__pycache__"
+
+def _truncate(text, max_tokens):
+    """
+    Truncates a text to about the given number of estimated tokens.
+    """
+    tokens = telemetry.estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return text[:len(text) * max_tokens // tokens] + "\n..."
+
+def file_digest(path, source):
+    """
+    Returns a short digest of a file: for a Python script its module docstring and the signatures (with the first line of
+    the docstring) of its top-level functions and classes, and for other files their start.
+
+    Args:
+        path (str): The path of the file.
+        source (str): The content of the file.
+
+    Returns:
+        str: The digest, of at most about DIGEST_TOKENS tokens.
+    """
+    if not path.endswith(".py"):
+        return _truncate(source, DIGEST_TOKENS)
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return _truncate(source, DIGEST_TOKENS)
+    lines = source.splitlines()
+    parts = []
+    if ast.get_docstring(tree):
+        parts.append(ast.get_docstring(tree))
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            docstring = (ast.get_docstring(node) or "").strip().split("\n")[0]
+            parts.append(lines[node.lineno - 1].strip() + (f"  # {docstring}" if docstring else ""))
+    if "__main__" in source:
+        parts.append("(runnable script)")
+    return _truncate("\n".join(parts), DIGEST_TOKENS)
+
+def _scan(root):
+    """
+    Collects the files to summarize and the subdirectories of each directory, and computes the subtree hashes bottom-up.
+    Directories without files to summarize (also in their subdirectories) are left out.
+    """
+    nodes = {}
+    for directory, dirs, files in os.walk(root, topdown=False):
+        relative = os.path.relpath(directory, root)
+        if relative != "." and any(_is_skipped_directory(part) for part in relative.split(os.sep)):
+            continue
+        entries = []
+        digests = []
+        for file in sorted(files):
+            if not file.endswith(SUMMARY_EXTENSIONS) or file in SKIPPED_FILES:
+                continue
+            path = os.path.join(directory, file)
+            try:
+                with open(path, "r") as summarized_file:
+                    source = summarized_file.read()
+            except (OSError, UnicodeDecodeError) as e:
+                logger.warning(f"Skipping {path} in the summaries: {e}")
+                continue
+            entries.append(f"file {file} {hashlib.sha256(source.encode('utf-8', 'surrogatepass')).hexdigest()}")
+            digests.append((file, file_digest(path, source)))
+        children = [os.path.join(directory, name) for name in sorted(dirs) if os.path.join(directory, name) in nodes]
+        entries += [f"directory {os.path.basename(child)} {nodes[child]['hash']}" for child in children]
+        if digests or children:
+            nodes[directory] = {"digests": digests, "children": children, "hash": cache.make_key(*entries),
+                                "depth": 0 if relative == "." else relative.count(os.sep) + 1}
+    return nodes
+
+def summarize_tree(root, summarize, cache_dir, salt="", workers=4):
+    """
+    Summarizes a directory tree bottom-up; the directories of the same depth are summarized concurrently.
+
+    Args:
+        root (str): The root directory of the tree.
+        summarize (function): Called with the relative path of a directory and its input (the digests of its files and
+            the summaries of its subdirectories); returns the summary.
+        cache_dir (str): The cache directory.
+        salt (str): Added to the cache keys, e.g. the model and the prompt, so changing them invalidates the summaries.
+        workers (int): The number of directories to summarize concurrently.
+
+    Returns:
+        dict: The summary of each directory, by path relative to the root ("." for the root). Empty when the tree has
+        nothing to summarize.
+    """
+    nodes = _scan(root)
+    summaries = {}
+
+    def summarize_node(directory):
+        node = nodes[directory]
+        name = os.path.relpath(directory, root)
+        # The name is part of the input, so the same contents under another name are summarized again
+        key = cache.make_key(salt, name, node["hash"])
+        summary = cache.load(cache_dir, "directory_summary", key)
+        if summary is None:
+            logger.info(f"Summarizing directory {name}")
+            text = f"Directory: {name}\n"
+            for file, digest in node["digests"]:
+                text += f"\nFile {file}:\n{digest}\n"
+            for child in node["children"]:
+                text += f"\nSubdirectory {os.path.basename(child)}:\n{summaries[child]}\n"
+            summary = summarize(name, text)
+            cache.store(cache_dir, "directory_summary", key, summary)
+        return directory, summary
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for depth in sorted(set(node["depth"] for node in nodes.values()), reverse=True):
+            level = [directory for directory, node in nodes.items() if node["depth"] == depth]
+            summaries.update(executor.map(summarize_node, level))
+    return {os.path.relpath(directory, root): summary for directory, summary in summaries.items()}
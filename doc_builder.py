@@ -0,0 +1,168 @@
+"""
+This script builds the Markdown documentation of a Python codebase from its docstrings, in the format that was produced by
+`mdocs`: a header with the title, description and contact details, followed by a section per module with the docstrings of its
+functions and classes.
+
+The documentation is built in-process and incrementally. Each module section is cached by the hash of the module's path and
+content, so only changed modules are parsed and rendered again. The documentation file is only rewritten when a section
+changed, and the build reports which sections changed or were removed, so downstream summaries can be updated incrementally.
+
+Functions:
+- render_header: Renders the header of the documentation.
+- render_docstring: Renders a docstring as Markdown.
+- render_module: Renders the documentation section of a module.
+- build: Builds (or updates) the documentation of a codebase.
+"""
+
+import os
+import re
+import ast
+import inspect
+import logging
+import cache
+import profiling
+
+# Create a logger object
+logger = logging.getLogger(__name__)
+
+# Docstring sections whose entries are rendered as a list
+LIST_SECTIONS = ("Args:", "Arguments:", "Parameters:", "Returns:", "Yields:", "Raises:", "Attributes:")
+
+# An entry in a list section, e.g. "model_name (str): The name of the model."
+ENTRY_PATTERN = re.compile(r'^[\w*][\w*.\[\], |]*(?:\s*\(.*?\))?:')
+
+def render_header(title, description, developer, mail, link):
+    """
+    Renders the header of the documentation.
+
+    Args:
+        title (str): The title of the documentation.
+        description (str): A short description.
+        developer (str): The name of the developer / owner.
+        mail (str): The e-mail address, may be empty.
+        link (str): The URL of the website / repository, may be empty.
+
+    Returns:
+        str: The header in Markdown.
+    """
+    header = f"# {title}\n{description}\n\n#### Developed by {developer}\n\n"
+    if link:
+        header += f"- GitHub: [{link}]({link})\n\n"
+    if mail:
+        header += f"- Contact: [{mail}](mailto:{mail})\n\n"
+    return header
+
+def render_docstring(docstring):
+    """
+    Renders a docstring as Markdown: the entries of the argument, return and exception sections become list items.
+
+    Args:
+        docstring (str): The docstring, as found in the code.
+
+    Returns:
+        str: The docstring in Markdown.
+    """
+    lines = []
+    in_list = False
+    for line in inspect.cleandoc(docstring).split("\n"):
+        stripped = line.strip()
+        if not line.startswith((" ", "\t")):
+            in_list = stripped in LIST_SECTIONS
+            lines.append(line)
+        elif in_list and ENTRY_PATTERN.match(stripped):
+            lines.append("- " + stripped)
+        elif in_list and lines and lines[-1].startswith("- "):
+            # Continuation of the previous entry
+            lines[-1] += " " + stripped
+        else:
+            lines.append(line)
+    return "\n".join(lines)
+
+def render_module(name, source):
+    """
+    Renders the documentation section of a module: the module docstring and the docstrings of all functions and classes
+    (including methods and nested functions), in the order of the code.
+
+    Args:
+        name (str): The name of the module, as shown in the section heading.
+        source (str): The source code of the module.
+
+    Returns:
+        str: The section in Markdown. A module that cannot be parsed gets a section with a note.
+    """
+    section = f"## Module {name}\n"
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        logger.warning(f"Unable to parse {name} for the documentation: {e}")
+        return section + f"_Unable to parse the module: {e}_\n\n---\n\n"
+    module_docstring = ast.get_docstring(tree, clean=False)
+    if module_docstring:
+        section += f"\n{render_docstring(module_docstring)}\n\n"
+    definitions = [node for node in ast.walk(tree)
+                   if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))]
+    for node in sorted(definitions, key=lambda node: (node.lineno, node.col_offset)):
+        heading = f"### class {node.name}" if isinstance(node, ast.ClassDef) else f"### {node.name}( )"
+        docstring = ast.get_docstring(node, clean=False)
+        if docstring:
+            section += f"{heading}\n\n{render_docstring(docstring)}\n\n\n"
+        else:
+            section += f"{heading}\n_No docstring available_\n\n"
+    return section + "---\n\n"
+
+def build(codebase_dir, output_path, header, cache_dir):
+    """
+    Builds (or updates) the documentation of a codebase. Sections of unchanged modules are taken from the cache, and the
+    documentation file is only rewritten when its content changed.
+
+    Args:
+        codebase_dir (str): The directory with the Python modules (with docstrings).
+        output_path (str): The path of the documentation file.
+        header (str): The header of the documentation (see render_header).
+        cache_dir (str): The cache directory.
+
+    Returns:
+        dict: The result of the build, with:
+            - sections: The section of each module in Markdown, by module path (relative to the codebase directory).
+            - changed: The paths of the modules whose section was added or changed since the previous build.
+            - removed: The paths of the modules whose section was removed since the previous build.
+
+    Side Effects:
+        Writes the documentation file and stores the sections and the list of modules of this build in the cache.
+    """
+    paths = []
+    with profiling.span("walk", "walk", directory=codebase_dir):
+        for root, dirs, files in os.walk(codebase_dir):
+            # Skip hidden directories (e.g. the cache) and compiled files
+            dirs[:] = [directory for directory in dirs if not directory.startswith(".") and directory != "__pycache__"]
+            paths.extend(os.path.relpath(os.path.join(root, file), codebase_dir) for file in files if file.endswith(".py"))
+    paths.sort()
+    manifest_key = cache.make_key("documentation", os.path.abspath(output_path))
+    previous = cache.load(cache_dir, "documentation", manifest_key) or {}
+    hashes = {}
+    sections = {}
+    for path in paths:
+        with open(os.path.join(codebase_dir, path), "r") as module_file:
+            source = module_file.read()
+        hashes[path] = cache.make_key(path, source)
+        sections[path] = cache.load(cache_dir, "documentation_section", hashes[path])
+        if sections[path] is None:
+            sections[path] = render_module(path, source)
+            cache.store(cache_dir, "documentation_section", hashes[path], sections[path])
+    changed = [path for path in paths if previous.get(path) != hashes[path]]
+    removed = sorted(set(previous) - set(hashes))
+
+    documentation = header + "".join(sections[path] for path in paths)
+    current = None
+    if os.path.exists(output_path):
+        with open(output_path, "r") as documentation_file:
+            current = documentation_file.read()
+    if documentation != current:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with open(output_path, "w") as documentation_file:
+            documentation_file.write(documentation)
+        logger.info(f"Documentation written to {output_path}: {len(changed)} sections changed, {len(removed)} removed")
+    else:
+        logger.info(f"Documentation in {output_path} is up to date")
+    cache.store(cache_dir, "documentation", manifest_key, hashes)
+    return {"sections": sections, "changed": changed, "removed": removed}
@@ -0,0 +1,145 @@
+"""
+This script selects the files (and the lines within them) that changed in a git repository since a given reference. It is
+used by the `--since` / `--changed_only` modes of create_docstrings.py and refactor_java.py, so the work on a pull request
+scales with the size of the diff instead of the size of the repository.
+
+Changes are taken from `git diff --name-status -M` (including renames and deletions) and the changed line ranges from the
+hunks of `git diff -U0`. Untracked files are reported as added.
+
+Functions:
+- add_arguments: Adds the change selection options to an argument parser.
+- get_since: Returns the git reference to compare with, based on the parsed arguments.
+- changes: Returns the changed files in a directory since a git reference.
+- intersects: Checks whether a line range intersects the changed lines.
+- apply_deletions_and_renames: Removes the outputs of deleted files and moves the outputs of renamed files.
+"""
+
+import os
+import re
+import shlex
+import shutil
+from commands import capture_command
+
+HUNK_PATTERN = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+
+def add_arguments(parser):
+    """
+    Adds the change selection options to an argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser of the script.
+    """
+    parser.add_argument("--since", default=None, help="Only process files (and methods) changed since this git reference.")
+    parser.add_argument("--changed_only", "--changed-only", action="store_true",
+                        help="Only process files (and methods) changed since the last commit (same as --since HEAD).")
+
+def get_since(args):
+    """
+    Returns the git reference to compare with, based on the parsed arguments.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+
+    Returns:
+        str: The git reference, or None when all files should be processed.
+    """
+    if args.since:
+        return args.since
+    if args.changed_only:
+        return "HEAD"
+    return None
+
+def changes(directory, since, logger):
+    """
+    Returns the changed files in a directory since a git reference.
+
+    Args:
+        directory (str): A directory within a git repository. Only changes within this directory are returned.
+        since (str): The git reference to compare the working tree with.
+        logger (logging.Logger): A logger instance used to log errors.
+
+    Returns:
+        dict: Maps the path of each changed file (relative to the directory) to a dict with:
+            - status: "A" (added), "M" (modified), "D" (deleted), "R" (renamed) or "C" (copied).
+            - old_path: The previous path of a renamed or copied file, otherwise None.
+            - lines: The list of changed line ranges (first, last) in the new file, or None for an added file.
+        None is returned if git fails, e.g. because the directory is not in a git repository.
+    """
+    git = f"git -C {shlex.quote(directory)}"
+    name_status = capture_command(f"{git} diff --name-status -M --relative {shlex.quote(since)} --", logger)
+    if name_status is None:
+        return None
+    result = {}
+    for line in name_status.splitlines():
+        parts = line.split("\t")
+        status = parts[0][0]
+        if status in "RC":
+            result[parts[2]] = {"status": status, "old_path": parts[1], "lines": [] if status == "R" else None}
+        else:
+            result[parts[1]] = {"status": status, "old_path": None, "lines": None if status == "A" else []}
+
+    untracked = capture_command(f"{git} ls-files --others --exclude-standard", logger) or ""
+    for path in untracked.splitlines():
+        result[path] = {"status": "A", "old_path": None, "lines": None}
+
+    hunks = capture_command(f"{git} diff -U0 -M --relative {shlex.quote(since)} --", logger) or ""
+    current = None
+    for line in hunks.splitlines():
+        if line.startswith("+++ "):
+            path = line[4:]
+            current = result.get(path[2:]) if path.startswith("b/") else None
+        elif current is not None and current["lines"] is not None:
+            match = HUNK_PATTERN.match(line)
+            if match:
+                first = int(match.group(1))
+                count = int(match.group(2)) if match.group(2) is not None else 1
+                # A pure deletion (count 0) is reported as a change of the line before it
+                current["lines"].append((first, first + max(count, 1) - 1))
+    return result
+
+def intersects(first, last, lines):
+    """
+    Checks whether a line range intersects the changed lines.
+
+    Args:
+        first (int): The first line of the range (1-based).
+        last (int): The last line of the range.
+        lines (list): The changed line ranges, or None if the whole file changed.
+
+    Returns:
+        bool: True if any line in the range changed.
+    """
+    if lines is None:
+        return True
+    return any(start <= last and end >= first for start, end in lines)
+
+def apply_deletions_and_renames(changed, output_path, logger):
+    """
+    Removes the outputs of deleted files and moves the outputs of renamed files.
+
+    Args:
+        changed (dict): The changed files, as returned by changes().
+        output_path (function): Returns the output path for a path in the changed files.
+        logger (logging.Logger): A logger instance used to log the changes.
+
+    Returns:
+        set: The paths of renamed files whose content did not change and whose output was moved, so they need no processing.
+
+    Side Effects:
+        A renamed file without previous output is marked as completely changed (its lines are set to None).
+    """
+    unchanged = set()
+    for path, change in changed.items():
+        if change["status"] == "D":
+            if os.path.exists(output_path(path)):
+                os.remove(output_path(path))
+                logger.info(f"Removed output of deleted file: {output_path(path)}")
+        elif change["status"] == "R" and os.path.exists(output_path(change["old_path"])):
+            os.makedirs(os.path.dirname(output_path(path)), exist_ok=True)
+            shutil.move(output_path(change["old_path"]), output_path(path))
+            logger.info(f"Moved output of renamed file: {output_path(change['old_path'])} -> {output_path(path)}")
+            if not change["lines"]:
+                unchanged.add(path)
+        elif change["status"] == "R":
+            change["lines"] = None
+    return unchanged
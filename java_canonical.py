@@ -0,0 +1,265 @@
+"""
+This script provides a near-duplicate cache for the refactoring of Java methods. Many methods only differ in identifiers,
+literals or whitespace (DTO accessors, builder methods, generated mappers). Such methods have the same canonical form: the
+token stream with local identifiers alpha-renamed (ID0, ID1, ...) and literals masked (LIT0, LIT1, ...).
+
+When a method has the same canonical form as a method that was refactored before, the cached refactoring is mapped back
+onto the names and literals of the new method. The mapping is verified: when it is not clean (e.g. an identifier that the
+model introduced collides with a name of the new method), the method is refactored by the model instead.
+
+To keep the cache safe for API refactorings, only local names are renamed: keywords, type names (capitalized), member
+accesses (`.name`, except `this.name`) and called methods (except the declared method) are kept verbatim.
+
+Functions:
+- tokenize: Splits Java code into tokens.
+- canonicalize: Returns the canonical form of Java code and the names of its renamed tokens.
+- resubstitute: Maps a cached refactoring onto a near-duplicate method.
+- refactor_with_cache: Refactors a method, reusing the refactoring of a near-duplicate method when possible.
+- cached_refactoring: Returns the cached refactoring of a method (or a near-duplicate), without calling the model.
+- remember: Stores a refactoring that was obtained in another way, e.g. from a packed request.
+"""
+
+import re
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future
+import cache
+import telemetry
+
+# Create a logger object
+logger = logging.getLogger(__name__)
+
+JAVA_KEYWORDS = {
+    "abstract", "assert", "boolean", "break", "byte", "case", "catch", "char", "class", "const", "continue", "default",
+    "do", "double", "else", "enum", "extends", "final", "finally", "float", "for", "goto", "if", "implements", "import",
+    "instanceof", "int", "interface", "long", "native", "new", "package", "private", "protected", "public", "return",
+    "short", "static", "strictfp", "super", "switch", "synchronized", "this", "throw", "throws", "transient", "try",
+    "void", "volatile", "while", "var", "record", "yield", "true", "false", "null",
+}
+
+TOKEN_PATTERN = re.compile(
+    r'(?P<space>\s+)'
+    r'|(?P<literal>/\*COMMENT\d+\*/'  # Comment placeholders (see refactor_java.remove_comments_from_code)
+    r'|"(?:\\.|[^"\\\n])*"'  # String literals
+    r"|'(?:\\.|[^'\\\n])*'"  # Character literals
+    r'|0[xX][0-9a-fA-F_]+[lL]?|\d[\d_]*(?:\.\d*)?(?:[eE][+-]?\d+)?[lLfFdD]?|\.\d+(?:[eE][+-]?\d+)?[fFdD]?)'  # Numbers
+    r'|(?P<identifier>[A-Za-z_$][\w$]*)'
+    r'|(?P<other>.)',
+    re.DOTALL
+)
+
+# Cache entries by canonical key, as futures so concurrent near-duplicates wait for the first refactoring
+_entries = {}
+_entries_lock = threading.Lock()
+
+def tokenize(java_code):
+    """
+    Splits Java code into tokens.
+
+    Args:
+        java_code (str): The Java code.
+
+    Returns:
+        list: Tuples (kind, text, start, end) for all tokens except whitespace. The kind is "literal", "identifier" or "other".
+    """
+    return [(match.lastgroup, match.group(), match.start(), match.end())
+            for match in TOKEN_PATTERN.finditer(java_code) if match.lastgroup != "space"]
+
+def _renamable(tokens):
+    """
+    Determines for each token whether it is a local name (or literal) that is renamed in the canonical form.
+    """
+    renamable = []
+    in_body = False
+    for index, (kind, text, _, _) in enumerate(tokens):
+        if text == "{":
+            in_body = True
+        if kind == "literal":
+            renamable.append(True)
+            continue
+        if kind != "identifier" or text in JAVA_KEYWORDS or text[0].isupper():
+            renamable.append(False)
+            continue
+        previous = tokens[index - 1][1] if index > 0 else ""
+        qualifier = tokens[index - 2][1] if index > 1 else ""
+        following = tokens[index + 1][1] if index + 1 < len(tokens) else ""
+        if previous == "@" or (previous == "." and qualifier != "this"):
+            renamable.append(False)
+        elif following == "(":
+            # Only the declared method name is renamed, calls are kept verbatim
+            renamable.append(not in_body)
+        else:
+            renamable.append(True)
+    return renamable
+
+def canonicalize(java_code):
+    """
+    Returns the canonical form of Java code and the names of its renamed tokens.
+
+    Args:
+        java_code (str): The Java code.
+
+    Returns:
+        tuple: The canonical form (str) and a dict mapping each canonical name (e.g. "ID0" or "LIT0") to the original text.
+    """
+    tokens = tokenize(java_code)
+    canonical = []
+    names = {}
+    for (kind, text, _, _), renamable in zip(tokens, _renamable(tokens)):
+        if renamable:
+            prefix = "LIT" if kind == "literal" else "ID"
+            name = names.setdefault((prefix, text), f"{prefix}{sum(1 for p, _ in names if p == prefix)}")
+            canonical.append(name)
+        else:
+            canonical.append(text)
+    return " ".join(canonical), {name: text for (_, text), name in names.items()}
+
+def resubstitute(cached_method, cached_refactoring, method):
+    """
+    Maps a cached refactoring onto a near-duplicate method.
+
+    Args:
+        cached_method (str): The method that was refactored by the model.
+        cached_refactoring (str): The refactoring of that method.
+        method (str): The new method, with the same canonical form as the cached method.
+
+    Returns:
+        str: The refactoring of the new method, or None when the mapping is not clean.
+    """
+    cached_canonical, cached_names = canonicalize(cached_method)
+    canonical, names = canonicalize(method)
+    if cached_canonical != canonical:
+        return None
+    mapping = {(name[:2] == "ID", cached_names[name]): names[name] for name in cached_names}
+
+    # A literal is only replaced by matching its text, so the model must have kept each literal that differs in the new
+    # method verbatim: e.g. when `x * 2` became `x << 1`, the refactoring of `x * 3` cannot be derived from it
+    literal_counts = lambda code: Counter(text for kind, text, _, _ in tokenize(code) if kind == "literal")
+    method_literals, refactoring_literals = literal_counts(cached_method), literal_counts(cached_refactoring)
+    for name, text in cached_names.items():
+        if name.startswith("LIT") and names[name] != text and method_literals[text] != refactoring_literals[text]:
+            return None
+
+    tokens = tokenize(cached_refactoring)
+    pieces = []
+    position = 0
+    for (kind, text, start, end), renamable in zip(tokens, _renamable(tokens)):
+        replacement = mapping.get((kind == "identifier", text))
+        if not renamable:
+            # A renamed name that the model used in a verbatim position (e.g. `this.name` became `other.name`) cannot be
+            # mapped reliably
+            if replacement is not None and replacement != text:
+                return None
+            continue
+        if replacement is not None:
+            pieces.append(cached_refactoring[position:start])
+            pieces.append(replacement)
+            position = end
+    pieces.append(cached_refactoring[position:])
+    refactoring = "".join(pieces)
+
+    # Verification: the result must have the same structure as the cached refactoring. This fails, for example, when
+    # a name introduced by the model collides with a name of the new method.
+    if canonicalize(refactoring)[0] != canonicalize(cached_refactoring)[0]:
+        return None
+    return refactoring
+
+def refactor_with_cache(method_code, context, call, cache_dir=None):
+    """
+    Refactors a method, reusing the refactoring of a near-duplicate method when possible.
+
+    Args:
+        method_code (str): The Java method to refactor.
+        context (str): Everything else that determines the refactoring, e.g. the model name and the prompt.
+        call (function): Refactors a method using the model; called with the method code.
+        cache_dir (str, optional): The cache directory, to reuse refactorings across runs.
+
+    Returns:
+        str: The refactored method.
+
+    Side Effects:
+        Records hits and misses of the "java_near_duplicate" cache in the telemetry.
+    """
+    key = cache.make_key(context, canonicalize(method_code)[0])
+    with _entries_lock:
+        entry = _entries.get(key)
+        leader = entry is None
+        if leader:
+            entry = _entries[key] = Future()
+    if leader:
+        stored = cache.load(cache_dir, "java_method", key) if cache_dir else None
+        if stored is None:
+            telemetry.record_cache("java_near_duplicate", False)
+            try:
+                refactoring = call(method_code)
+            except BaseException as e:
+                with _entries_lock:
+                    del _entries[key]
+                entry.set_exception(e)
+                raise
+            stored = {"method": method_code, "refactoring": refactoring}
+            if cache_dir:
+                cache.store(cache_dir, "java_method", key, stored)
+            entry.set_result(stored)
+            return refactoring
+        entry.set_result(stored)
+    else:
+        stored = entry.result()
+
+    if stored["method"] == method_code:
+        telemetry.record_cache("java_near_duplicate", True)
+        return stored["refactoring"]
+    refactoring = resubstitute(stored["method"], stored["refactoring"], method_code)
+    telemetry.record_cache("java_near_duplicate", refactoring is not None)
+    if refactoring is None:
+        logger.info("Near-duplicate mapping is not clean, refactoring the method using the model.")
+        return call(method_code)
+    return refactoring
+
+def cached_refactoring(method_code, context, cache_dir=None):
+    """
+    Returns the cached refactoring of a method (or a near-duplicate), without calling the model.
+
+    Args:
+        method_code (str): The Java method.
+        context (str): Everything else that determines the refactoring, e.g. the model name and the prompt.
+        cache_dir (str, optional): The cache directory.
+
+    Returns:
+        str: The refactored method, or None if no (cleanly mappable) refactoring is cached.
+    """
+    key = cache.make_key(context, canonicalize(method_code)[0])
+    with _entries_lock:
+        entry = _entries.get(key)
+    if entry is not None and entry.done() and entry.exception() is None:
+        stored = entry.result()
+    elif cache_dir:
+        stored = cache.load(cache_dir, "java_method", key)
+    else:
+        stored = None
+    if stored is None:
+        return None
+    if stored["method"] == method_code:
+        return stored["refactoring"]
+    return resubstitute(stored["method"], stored["refactoring"], method_code)
+
+def remember(method_code, context, refactoring, cache_dir=None):
+    """
+    Stores a refactoring that was obtained in another way, e.g. from a packed request.
+
+    Args:
+        method_code (str): The Java method.
+        context (str): Everything else that determines the refactoring, e.g. the model name and the prompt.
+        refactoring (str): The refactored method.
+        cache_dir (str, optional): The cache directory.
+    """
+    key = cache.make_key(context, canonicalize(method_code)[0])
+    stored = {"method": method_code, "refactoring": refactoring}
+    with _entries_lock:
+        if key in _entries:
+            return
+        entry = _entries[key] = Future()
+        entry.set_result(stored)
+    if cache_dir:
+        cache.store(cache_dir, "java_method", key, stored)
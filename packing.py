@@ -0,0 +1,120 @@
+"""
+This script packs many small units of work (small Python scripts, short Java methods) into a single LLM request, to avoid
+paying a full request round-trip and the repeated instruction prompt for each of them.
+
+Units are bin-packed (first-fit decreasing) into batches up to a token budget. Each unit is placed between delimiter lines
+in the request, and the model is asked to answer with the same delimiters. The response is split back per unit; units that
+are missing or cannot be parsed from the response are returned as failed, so the caller can process them individually.
+
+Functions:
+- pack: Bin-packs units into batches up to a token budget.
+- build_input: Builds the input of a request for a batch of units.
+- strip_code_fences: Removes a Markdown code fence around a text.
+- split_response: Splits the response to a packed request per unit.
+- is_complete: Checks whether all units can be taken from the response to a packed request.
+"""
+
+import re
+import telemetry
+
+# Instructions added to the prompt of a packed request
+PACKED_INSTRUCTIONS = """
+        The input below contains several independent units. Each unit starts with a line <<<UNIT id>>> and ends with a
+        line <<<END UNIT id>>>. Apply the instructions to each unit separately. Output every unit between the same
+        delimiter lines, with the same id, in the same order, and output nothing outside the delimiters.
+"""
+
+SECTION_PATTERN = re.compile(r'^<<<UNIT (\w+)>>>[ \t]*\n(.*?)\n?^<<<END UNIT \1>>>[ \t]*$', re.MULTILINE | re.DOTALL)
+
+def pack(units, budget):
+    """
+    Bin-packs units into batches up to a token budget, using first-fit decreasing.
+
+    Args:
+        units (list): Tuples (id, text).
+        budget (int): The maximum number of estimated tokens of the units in one batch.
+
+    Returns:
+        list: The batches, each a list of (id, text) tuples. A unit larger than the budget gets a batch of its own.
+    """
+    batches = []
+    for unit in sorted(units, key=lambda unit: telemetry.estimate_tokens(unit[1]), reverse=True):
+        size = telemetry.estimate_tokens(unit[1])
+        for batch in batches:
+            if batch[0] + size <= budget:
+                batch[0] += size
+                batch[1].append(unit)
+                break
+        else:
+            batches.append([size, [unit]])
+    return [batch for _, batch in batches]
+
+def build_input(batch):
+    """
+    Builds the input of a request for a batch of units.
+
+    Args:
+        batch (list): Tuples (id, text). The ids must be words (letters, digits and underscores).
+
+    Returns:
+        str: The units between delimiter lines.
+    """
+    return "\n".join(f"<<<UNIT {unit_id}>>>\n{text.strip(chr(10))}\n<<<END UNIT {unit_id}>>>" for unit_id, text in batch)
+
+def strip_code_fences(text):
+    """
+    Removes a Markdown code fence around a text, if the model added one. The closing fence may be missing when the
+    response was cut off.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        str: The text without the code fence.
+    """
+    match = re.match(r'^\s*```[\w+-]*[ \t]*\n(.*?)(?:\n?```\s*)?$', text, re.DOTALL)
+    return match.group(1) if match else text
+
+def split_response(response, batch):
+    """
+    Splits the response to a packed request per unit.
+
+    Args:
+        response (str): The response of the model.
+        batch (list): The (id, text) tuples of the request.
+
+    Returns:
+        tuple: A dict mapping the id of each cleanly parsed unit to its output, and the list of ids that failed
+        (missing, duplicated or empty in the response).
+    """
+    sections = {}
+    duplicated = set()
+    for match in SECTION_PATTERN.finditer(strip_code_fences(response)):
+        unit_id = match.group(1)
+        if unit_id in sections:
+            duplicated.add(unit_id)
+        sections[unit_id] = strip_code_fences(match.group(2))
+    outputs = {}
+    failed = []
+    for unit_id, _ in batch:
+        output = sections.get(unit_id)
+        if output is None or unit_id in duplicated or not output.strip():
+            failed.append(unit_id)
+        else:
+            outputs[unit_id] = output
+    return outputs, failed
+
+def is_complete(response, batch, check=None):
+    """
+    Checks whether all units can be taken from the response to a packed request, e.g. to validate the output of a model.
+
+    Args:
+        response (str): The response of the model.
+        batch (list): The (id, text) tuples of the request.
+        check (function, optional): Checks the output of a unit (called with the id and the output).
+
+    Returns:
+        bool: True if no unit failed and all outputs pass the check.
+    """
+    outputs, failed = split_response(response, batch)
+    return not failed and (check is None or all(check(unit_id, output) for unit_id, output in outputs.items()))
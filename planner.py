@@ -0,0 +1,135 @@
+"""
+This script plans a run before it is started. The scripts that call the LLM (create_docstrings.py, refactor_java.py and
+create_reports.py) walk their inputs in `--plan` mode and describe the calls they would make; this script estimates the
+tokens (with the offline approximation of telemetry.estimate_tokens), the cost and the wall time at the given concurrency,
+and reports them without calling the model.
+
+The wall time is estimated by scheduling the calls of each stage largest-first on the workers, with a fixed latency per
+call plus the time to generate the output tokens. The same largest-first order is used by the real runs, so the longest
+calls do not end up as the tail of a concurrent run.
+
+Functions:
+- add_arguments: Adds the planning and budget options to an argument parser.
+- call: Describes a planned call.
+- largest_first: Orders units of work from largest to smallest.
+- estimate: Estimates the calls, tokens, cost and wall time of a run.
+- report: Prints the estimate of a run.
+"""
+
+import heapq
+import telemetry
+
+# Latency model of a call: a fixed overhead plus the generation of the output tokens
+CALL_OVERHEAD_SECONDS = 1.5
+OUTPUT_TOKENS_PER_SECOND = 60.0
+
+def add_arguments(parser):
+    """
+    Adds the planning and budget options to an argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser of the script.
+    """
+    parser.add_argument("--plan", action="store_true",
+                        help="Only estimate the calls, tokens, cost and wall time of the run, without calling the model.")
+    parser.add_argument("--token_budget", type=int, default=None,
+                        help="Hard limit on the number of tokens of the run; calls that would exceed it are not made.")
+
+def call(stage, model, input_text, output_tokens, unit=None):
+    """
+    Describes a planned call.
+
+    Args:
+        stage (str): The calling stage, e.g. "docstrings".
+        model (str): The model the call is routed to.
+        input_text (str): The full input of the call (prompt and input data).
+        output_tokens (int): The expected number of output tokens.
+        unit (str, optional): The unit of work.
+
+    Returns:
+        dict: The planned call.
+    """
+    return {"stage": stage, "model": model, "unit": unit, "input_tokens": telemetry.estimate_tokens(input_text),
+            "output_tokens": int(output_tokens)}
+
+def largest_first(items, size):
+    """
+    Orders units of work from largest to smallest, so a concurrent run does not end with one large unit.
+
+    Args:
+        items (iterable): The units of work.
+        size (function): Returns the size of a unit (e.g. in bytes or tokens).
+
+    Returns:
+        list: The units, largest first.
+    """
+    return sorted(items, key=size, reverse=True)
+
+def _latency(planned):
+    """
+    Returns the estimated latency in seconds of a planned call.
+    """
+    return CALL_OVERHEAD_SECONDS + planned["output_tokens"] / OUTPUT_TOKENS_PER_SECOND
+
+def estimate(calls, concurrency):
+    """
+    Estimates the calls, tokens, cost and wall time of a run. The stages run one after another; the calls of a stage are
+    scheduled largest-first on the workers.
+
+    Args:
+        calls (list): The planned calls (see call), in the order of the stages.
+        concurrency (int): The number of concurrent calls.
+
+    Returns:
+        dict: Totals and per stage: calls, input_tokens, output_tokens, cost (None when a price is unknown) and
+        wall_time (seconds).
+    """
+    stages = {}
+    for planned in calls:
+        stages.setdefault(planned["stage"], []).append(planned)
+    result = {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0, "wall_time": 0.0, "stages": []}
+    for stage, stage_calls in stages.items():
+        workers = [0.0] * max(1, concurrency)
+        for planned in largest_first(stage_calls, _latency):
+            heapq.heapreplace(workers, workers[0] + _latency(planned))
+        costs = [telemetry.estimate_cost(p["model"], p["input_tokens"], p["output_tokens"]) for p in stage_calls]
+        summary = {
+            "stage": stage,
+            "calls": len(stage_calls),
+            "input_tokens": sum(p["input_tokens"] for p in stage_calls),
+            "output_tokens": sum(p["output_tokens"] for p in stage_calls),
+            "cost": None if None in costs else round(sum(costs), 4),
+            "wall_time": round(max(workers), 1),
+            "models": sorted(set(p["model"] for p in stage_calls)),
+        }
+        result["stages"].append(summary)
+        for key in ("calls", "input_tokens", "output_tokens", "wall_time"):
+            result[key] += summary[key]
+        result["cost"] = None if result["cost"] is None or summary["cost"] is None else result["cost"] + summary["cost"]
+    if result["cost"] is not None:
+        result["cost"] = round(result["cost"], 4)
+    result["wall_time"] = round(result["wall_time"], 1)
+    return result
+
+def report(plan, concurrency, logger):
+    """
+    Prints the estimate of a run, and logs it.
+
+    Args:
+        plan (dict): The estimate (see estimate).
+        concurrency (int): The number of concurrent calls the estimate is based on.
+        logger (logging.Logger): A logger instance used to log the estimate.
+    """
+    def cost(value):
+        return "unknown" if value is None else f"${value:.2f}"
+
+    lines = [f"Plan at concurrency {concurrency}: {plan['calls']} calls, {plan['input_tokens']} input tokens, "
+             f"{plan['output_tokens']} output tokens, estimated cost {cost(plan['cost'])}, "
+             f"estimated wall time {plan['wall_time']:.0f}s"]
+    for stage in plan["stages"]:
+        lines.append(f"  {stage['stage']} ({', '.join(stage['models'])}): {stage['calls']} calls, "
+                     f"{stage['input_tokens']} input tokens, {stage['output_tokens']} output tokens, "
+                     f"cost {cost(stage['cost'])}, wall time {stage['wall_time']:.0f}s")
+    for line in lines:
+        print(line)
+        logger.info(line)
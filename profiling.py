@@ -0,0 +1,129 @@
+"""
+This script provides a lightweight profiling mode for the other scripts. Phases of a run (walking the codebase, file I/O,
+subprocesses, regex extraction, waiting on the model) are wrapped in timed spans, which are written as a Chrome/Perfetto
+trace-event JSON file at the end of the run. The file can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+Optionally, the CPU-bound phases are profiled with cProfile and dumped in the pstats format (e.g. for snakeviz or
+`python -m pstats`).
+
+When profiling is not configured, the spans cost next to nothing.
+
+Functions:
+- add_arguments: Adds the profiling options to an argument parser.
+- configure: Enables profiling.
+- span: Context manager that records a timed span.
+- write_profile: Writes the trace and the CPU profile.
+"""
+
+import os
+import json
+import time
+import atexit
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+
+# Create a logger object
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_trace_path = None
+_events = []
+_cpu_path = None
+_cpu_profiler = None
+_cpu_lock = threading.Lock()
+_local = threading.local()
+
+def add_arguments(parser):
+    """
+    Adds the profiling options to an argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser of the script.
+    """
+    parser.add_argument("--profile", default=None, help="Write a Chrome/Perfetto trace of the run to this JSON file.")
+    parser.add_argument("--profile_cpu", default=None, help="Write a cProfile dump of the CPU-bound phases to this file.")
+
+def configure(trace_path=None, cpu_path=None):
+    """
+    Enables profiling.
+
+    Args:
+        trace_path (str, optional): The file to write the trace-event JSON to.
+        cpu_path (str, optional): The file to write the cProfile (pstats) dump of the CPU-bound phases to.
+
+    Side Effects:
+        Registers the writing of the profile at exit.
+    """
+    global _trace_path, _cpu_path, _cpu_profiler
+    if not trace_path and not cpu_path:
+        return
+    _trace_path = trace_path
+    if cpu_path:
+        _cpu_path = cpu_path
+        _cpu_profiler = cProfile.Profile()
+    atexit.register(write_profile)
+    logger.info(f"Profiling enabled (trace: {trace_path}, CPU profile: {cpu_path})")
+
+@contextmanager
+def span(name, category="run", cpu=False, **span_args):
+    """
+    Context manager that records a timed span.
+
+    Args:
+        name (str): The name of the span.
+        category (str): The category of the span, e.g. "walk", "io", "subprocess", "cpu" or "llm".
+        cpu (bool): Whether the span is a CPU-bound phase that should be included in the CPU profile.
+        **span_args: Additional information to store with the span (shown in the trace viewer).
+
+    Yields:
+        None
+    """
+    if not _trace_path and not _cpu_profiler:
+        yield
+        return
+    # Only the outermost CPU-bound span of one thread at a time is profiled, as cProfile does not nest
+    profiling_cpu = False
+    if cpu and _cpu_profiler and not getattr(_local, "cpu_active", False) and _cpu_lock.acquire(blocking=False):
+        _local.cpu_active = profiling_cpu = True
+        _cpu_profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        if profiling_cpu:
+            _cpu_profiler.disable()
+            _local.cpu_active = False
+            _cpu_lock.release()
+        if _trace_path:
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round(start * 1_000_000),
+                "dur": round(duration * 1_000_000),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {key: str(value) for key, value in span_args.items()},
+            }
+            with _lock:
+                _events.append(event)
+
+def write_profile():
+    """
+    Writes the trace and the CPU profile.
+
+    Side Effects:
+        Writes the trace-event JSON file and the pstats dump to the configured paths.
+    """
+    if _trace_path:
+        with _lock:
+            events = list(_events)
+        with open(_trace_path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+        logger.info(f"Profile trace with {len(events)} spans written to: {_trace_path}")
+    if _cpu_profiler:
+        _cpu_profiler.dump_stats(_cpu_path)
+        logger.info(f"CPU profile written to: {_cpu_path}")
@@ -0,0 +1,250 @@
+"""
+This script splits Python modules at the boundaries of their top-level definitions, so docstrings for a large module can be
+created in several smaller requests that are processed concurrently (see create_docstrings.py).
+
+A module is split (using `ast`) into definition segments (top-level classes and functions, including their decorators)
+and code segments (everything else: imports, globals, comments, the main block). Only the definitions are sent to the
+model; the code segments are kept byte-exact when the module is reassembled in the original order.
+
+The output of the model is verified by comparing its AST with the original with the docstrings removed, so a changed or
+missing (truncated) definition is found and only that definition has to be requested again.
+
+Functions:
+- split_module: Splits a module into code and definition segments.
+- definition_keys: Returns a key for each definition segment, to match definitions between two versions of a module.
+- module_context: Returns the shared context of a module for the requests of its definitions.
+- check_definition: Checks whether a generated definition is valid, has the expected name and the original code.
+- code_dump: Returns a dump of the AST of a node without docstrings.
+- parse_prefix: Parses the longest complete part of a possibly truncated module.
+- verify: Compares a generated module with the original, ignoring docstrings.
+- insert_module_docstring: Adds a module docstring to the source code.
+- reassemble: Reassembles a module from its segments and the generated definitions.
+"""
+
+import ast
+import copy
+import telemetry
+
+DEFINITION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+def split_module(source):
+    """
+    Splits a module into code and definition segments.
+
+    Args:
+        source (str): The source code of the module.
+
+    Returns:
+        list: Dicts with the keys "kind" ("code" or "definition"), "name" (of a definition, otherwise None), "text", and
+        "first" and "last" (the 1-based line range). Joining the texts results in the exact source.
+
+    Raises:
+        SyntaxError: If the source is not valid Python.
+    """
+    tree = ast.parse(source)
+    lines = source.splitlines(keepends=True)
+    segments = []
+    position = 0  # Index of the first line that is not in a segment yet
+    for node in tree.body:
+        if not isinstance(node, DEFINITION_TYPES):
+            continue
+        first = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list]) - 1
+        if first > position:
+            segments.append({"kind": "code", "name": None, "text": "".join(lines[position:first]),
+                             "first": position + 1, "last": first})
+        segments.append({"kind": "definition", "name": node.name, "text": "".join(lines[first:node.end_lineno]),
+                         "first": first + 1, "last": node.end_lineno})
+        position = node.end_lineno
+    if position < len(lines):
+        segments.append({"kind": "code", "name": None, "text": "".join(lines[position:]),
+                         "first": position + 1, "last": len(lines)})
+    return segments
+
+def definition_keys(segments):
+    """
+    Returns a key for each definition segment, to match definitions between two versions of a module.
+
+    Args:
+        segments (list): The segments, as returned by split_module().
+
+    Returns:
+        list: A (name, occurrence) tuple for each segment; None for code segments.
+    """
+    seen = {}
+    keys = []
+    for segment in segments:
+        if segment["kind"] == "definition":
+            occurrence = seen.get(segment["name"], 0)
+            seen[segment["name"]] = occurrence + 1
+            keys.append((segment["name"], occurrence))
+        else:
+            keys.append(None)
+    return keys
+
+def module_context(segments, max_tokens=1500):
+    """
+    Returns the shared context of a module for the requests of its definitions: the code segments (imports, globals)
+    and the first line of each definition.
+
+    Args:
+        segments (list): The segments, as returned by split_module().
+        max_tokens (int): The maximum number of estimated tokens of the context. Longer code segments are truncated.
+
+    Returns:
+        str: The context.
+    """
+    parts = []
+    remaining = max_tokens
+    for segment in segments:
+        if segment["kind"] == "definition":
+            text = segment["text"].lstrip("\n").split("\n", 1)[0] + "\n    ...\n"
+        else:
+            text = segment["text"]
+        tokens = telemetry.estimate_tokens(text)
+        if tokens > remaining:
+            parts.append("# ... (truncated)\n")
+            break
+        parts.append(text)
+        remaining -= tokens
+    return "".join(parts)
+
+def check_definition(output, name, original=None):
+    """
+    Checks whether a generated definition is valid, has the expected name and (when given) the original code.
+
+    Args:
+        output (str): The generated code.
+        name (str): The name of the definition.
+        original (str, optional): The original definition; the code of the output must be the same apart from docstrings.
+
+    Returns:
+        bool: True if the output is valid Python consisting of exactly one top-level definition with the name (and the
+        original code).
+    """
+    try:
+        tree = ast.parse(output)
+    except SyntaxError:
+        return False
+    if not (len(tree.body) == 1 and isinstance(tree.body[0], DEFINITION_TYPES) and tree.body[0].name == name):
+        return False
+    return original is None or code_dump(tree) == code_dump(ast.parse(original))
+
+def _is_docstring(node):
+    """
+    Checks whether a statement is a docstring.
+    """
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+
+def code_dump(node):
+    """
+    Returns a dump of the AST of a node without the docstrings of the module, classes and functions in it, to compare
+    code regardless of its docstrings (and of its formatting and comments).
+
+    Args:
+        node (ast.AST): The node.
+
+    Returns:
+        str: The dump.
+    """
+    node = copy.deepcopy(node)
+    for child in ast.walk(node):
+        if isinstance(child, (ast.Module,) + DEFINITION_TYPES) and child.body and _is_docstring(child.body[0]):
+            child.body = child.body[1:]
+    return ast.dump(node)
+
+def parse_prefix(source):
+    """
+    Parses the longest complete part of a possibly truncated module: the module itself when it is valid, otherwise the
+    longest valid part that ends before a top-level statement.
+
+    Args:
+        source (str): The source code of the module.
+
+    Returns:
+        tuple: The valid part of the source code and its AST (empty when no part is valid).
+    """
+    try:
+        return source, ast.parse(source)
+    except SyntaxError:
+        pass
+    lines = source.splitlines(keepends=True)
+    for end in range(len(lines) - 1, 0, -1):
+        if lines[end].strip() and lines[end][0] not in " \t#)]}":
+            prefix = "".join(lines[:end])
+            try:
+                return prefix, ast.parse(prefix)
+            except SyntaxError:
+                continue
+    return "", ast.parse("")
+
+def verify(segments, output):
+    """
+    Compares a generated module with the original, ignoring docstrings.
+
+    Args:
+        segments (list): The segments of the original module, as returned by split_module().
+        output (str): The generated module, possibly truncated or with changed code.
+
+    Returns:
+        dict: With the keys "identical" (True if the complete output has the original code), "definitions" (the
+        generated text of each definition that has the original code, by segment index), "differing" (the indices of
+        the definitions that were changed or are missing) and "module_docstring" (the module docstring of the output as
+        it is written there, or None).
+    """
+    original = ast.parse("".join(segment["text"] for segment in segments))
+    prefix, tree = parse_prefix(output)
+    generated = split_module(prefix)
+    generated = dict(zip(definition_keys(generated), generated))
+    result = {"identical": prefix == output and code_dump(tree) == code_dump(original), "definitions": {},
+              "differing": [], "module_docstring": None}
+    for index, (segment, key) in enumerate(zip(segments, definition_keys(segments))):
+        if key is None:
+            continue
+        if key in generated and check_definition(generated[key]["text"], segment["name"], segment["text"]):
+            result["definitions"][index] = generated[key]["text"]
+        else:
+            result["differing"].append(index)
+    if ast.get_docstring(tree) is not None:
+        result["module_docstring"] = ast.get_source_segment(prefix, tree.body[0])
+    return result
+
+def insert_module_docstring(source, docstring):
+    """
+    Adds a module docstring to the source code, after a shebang and encoding declaration.
+
+    Args:
+        source (str): The source code of the module.
+        docstring (str): The docstring, with or without quotes.
+
+    Returns:
+        str: The source code with the docstring.
+    """
+    docstring = docstring.strip()
+    if not docstring.startswith(('"""', "'''")):
+        docstring = '"""\n' + docstring.replace('"""', "'''") + '\n"""'
+    lines = source.splitlines(keepends=True)
+    position = 0
+    while position < len(lines) and position < 2 and lines[position].startswith("#") and (
+            position == 0 and lines[position].startswith("#!") or "coding" in lines[position]):
+        position += 1
+    return "".join(lines[:position]) + docstring + "\n\n" + "".join(lines[position:])
+
+def reassemble(segments, outputs):
+    """
+    Reassembles a module from its segments and the generated definitions.
+
+    Args:
+        segments (list): The segments, as returned by split_module().
+        outputs (dict): The generated code by segment index. Segments without output are kept as they are.
+
+    Returns:
+        str: The module. The code segments are byte-exact.
+    """
+    parts = []
+    for index, segment in enumerate(segments):
+        output = outputs.get(index)
+        if output is None:
+            parts.append(segment["text"])
+            continue
+        parts.append(output.strip("\n") + ("\n" if segment["text"].endswith("\n") else ""))
+    return "".join(parts)
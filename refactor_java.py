@@ -3,9 +3,20 @@ import sys
 import logging
 import argparse
 import os
-from ai import run_chain, create_connection
-from commands import run_command
-from langchain_core.prompts import ChatPromptTemplate
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import telemetry
+import profiling
+import cache
+import java_canonical
+import packing
+import git_changes
+import ai
+from ai import run_chain_routed, create_connection
+import batch_format
+import planner
+import watch
+import work_queue
 
 """
 This script refactors Java code using AI. It processes Java files in a specified directory, 
@@ -21,7 +32,20 @@ parser.add_argument("-o", "--output_dir", required=True, help="The directory to
 parser.add_argument("-l", "--log_file", default='./analysis.log', help="The file to save the log.")
 parser.add_argument("-m", "--model_name", default="gpt-4o", help="OpenAI model name.")
 parser.add_argument("-p", "--prompt", default="./refactoring_prompt.txt", help="The refactor prompt")
+parser.add_argument("-w", "--workers", type=int, default=4, help="The number of files to refactor concurrently.")
+parser.add_argument("--pack_budget", type=int, default=2000, help="Token budget to pack short methods into one request (0 to disable).")
+parser.add_argument("--format_workers", type=int, default=2, help="The number of astyle processes to run concurrently.")
+parser.add_argument("--format_batch", type=int, default=100, help="The number of files to format per astyle process.")
+git_changes.add_arguments(parser)
+parser.add_argument("-T", "--telemetry_dir", default=None, help="The directory to write the LLM telemetry (trace, summary and metrics) to.")
+profiling.add_arguments(parser)
+ai.add_arguments(parser)
+planner.add_arguments(parser)
+watch.add_arguments(parser)
+work_queue.add_arguments(parser)
 args = parser.parse_args()
+if args.worker and not args.queue:
+    parser.error("--worker requires --queue")
 
 # Configure logging
 logging.basicConfig(
@@ -33,6 +57,13 @@ logging.basicConfig(
 # Create a logger object
 logger = logging.getLogger(__name__)
 
+profiling.configure(args.profile, args.profile_cpu)
+ai.configure_routing(args.routing)
+ai.set_token_budget(args.token_budget)
+
+if args.telemetry_dir:
+    telemetry.configure(args.telemetry_dir)
+
 SRC_DIR = args.java_dir
 if not os.path.exists(SRC_DIR):
     logger.error(f"Error: Directory {SRC_DIR} does not exist.")
@@ -45,18 +76,22 @@ if not OUTPUT_DIR.endswith('/'):
     OUTPUT_DIR += '/'
 
 MODEL_NAME = args.model_name
+CACHE_DIR = os.path.join(OUTPUT_DIR, cache.CACHE_DIRNAME)
 
 # Ensure output directory exists
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-def refactor(method_code, prompt_text, connection):
+def refactor(method_code, prompt_text, connection, unit=None):
     """
-    Refactors a given method using AI based on a provided prompt.
+    Refactors a given method using AI based on a provided prompt. Identical methods (e.g. getters and setters that occur
+    in several files) are sent to the model only once per run. Methods that only differ in local names and literals reuse
+    the refactoring of an earlier near-duplicate method (see java_canonical.py), also across runs.
 
     Args:
         method_code (str): The Java method code to be refactored.
         prompt_text (str): The prompt text to guide the AI refactoring.
         connection: The connection object for interacting with the AI model.
+        unit (str, optional): The file the method belongs to, used for telemetry.
 
     Returns:
         str: The refactored method code.
@@ -64,17 +99,96 @@ def refactor(method_code, prompt_text, connection):
     Raises:
         Exception: If the AI response is not in the expected format.
     """
-    prompt = ChatPromptTemplate.from_template(prompt_text + """
-                                                          
-        Method: 
-        `{input}`
-        """
-    )
-    ai_response = run_chain(prompt, method_code, model_name=MODEL_NAME, connection=connection)
-    if ai_response.startswith("```"):
-        ai_response = ai_response[7:].strip()
-        ai_response = ai_response.rsplit("```", 1)[0].strip()
-    return ai_response
+    prompt = ai.instruction_prompt(prompt_text, "Method")
+
+    def call_model(code):
+        ai_response = run_chain_routed(prompt, code, model_name=MODEL_NAME, connection=connection, stage="refactor", unit=unit,
+                                       validate=lambda response: is_valid_method(packing.strip_code_fences(response)),
+                                       unit_complexity=ai.complexity(code, "java"))
+        return packing.strip_code_fences(ai_response).strip()
+
+    return java_canonical.refactor_with_cache(method_code, MODEL_NAME + "\0" + prompt_text, call_model, CACHE_DIR)
+
+def is_valid_method(refactored_method):
+    """
+    Checks whether a refactored method looks like a complete Java method: non-empty with balanced braces.
+
+    Args:
+        refactored_method (str): The refactored method code.
+
+    Returns:
+        bool: True if the method is non-empty and its braces are balanced.
+    """
+    braces = [text for kind, text, _, _ in java_canonical.tokenize(refactored_method) if text in "{}"]
+    return braces.count("{") > 0 and braces.count("{") == braces.count("}")
+
+def refactor_packed(methods, prompt_text, connection, unit=None):
+    """
+    Refactors several short methods in one request (see packing.py).
+
+    Args:
+        methods (list): The Java methods to be refactored.
+        prompt_text (str): The prompt text to guide the AI refactoring.
+        connection: The connection object for interacting with the AI model.
+        unit (str, optional): The file the methods belong to, used for telemetry.
+
+    Returns:
+        dict: The refactored code of each method. Methods that could not be taken from the response are refactored
+        individually.
+    """
+    prompt = ai.instruction_prompt([prompt_text, packing.PACKED_INSTRUCTIONS], "Methods")
+    batch = [(f"M{index}", method) for index, method in enumerate(methods)]
+    ai_response = run_chain_routed(prompt, packing.build_input(batch), model_name=MODEL_NAME, connection=connection,
+                                   stage="refactor", unit=unit,
+                                   validate=lambda response: packing.is_complete(
+                                       response, batch, lambda unit_id, output: is_valid_method(output)),
+                                   unit_complexity=max(ai.complexity(method, "java") for method in methods))
+    outputs, failed = packing.split_response(ai_response, batch)
+    refactored = {}
+    for unit_id, output in outputs.items():
+        method = methods[int(unit_id[1:])]
+        if is_valid_method(output):
+            refactored[method] = output
+            java_canonical.remember(method, MODEL_NAME + "\0" + prompt_text, output, CACHE_DIR)
+        else:
+            failed.append(unit_id)
+    if failed:
+        logger.warning(f"{len(failed)} methods could not be taken from the packed response, refactoring them individually.")
+    for unit_id in failed:
+        method = methods[int(unit_id[1:])]
+        refactored[method] = refactor(method, prompt_text, connection, unit)
+    return refactored
+
+def refactor_methods(methods, prompt_text, connection, unit=None):
+    """
+    Refactors the methods of a file. Cached refactorings are reused, short methods are packed into shared requests and
+    the other methods are refactored individually.
+
+    Args:
+        methods (list): The (unique) Java methods to be refactored.
+        prompt_text (str): The prompt text to guide the AI refactoring.
+        connection: The connection object for interacting with the AI model.
+        unit (str, optional): The file the methods belong to, used for telemetry.
+
+    Returns:
+        dict: The refactored code of each method.
+    """
+    refactored = {}
+    short = []
+    for method in methods:
+        cached = java_canonical.cached_refactoring(method, MODEL_NAME + "\0" + prompt_text, CACHE_DIR)
+        if cached is not None:
+            refactored[method] = cached
+        elif telemetry.estimate_tokens(method) <= args.pack_budget // 4:
+            short.append(method)
+        else:
+            refactored[method] = refactor(method, prompt_text, connection, unit)
+    for batch in packing.pack([(method, method) for method in short], args.pack_budget):
+        if len(batch) > 1:
+            refactored.update(refactor_packed([method for method, _ in batch], prompt_text, connection, unit))
+        else:
+            refactored[batch[0][0]] = refactor(batch[0][0], prompt_text, connection, unit)
+    return refactored
 
 def remove_comments_from_code(java_code):
     """
@@ -111,26 +225,40 @@ def restore_comments(refactored_code, comments):
         refactored_code = refactored_code.replace(f'/*COMMENT{i}*/', comment, 1)
     return refactored_code
 
-def extract_and_refactor_methods(file_path, prompt_text, connection):
+def line_counter(stripped_code, comments):
     """
-    Extracts methods from a Java file, refactors them using AI, and restores comments.
+    Creates a function that returns the line number in the original code of an offset in the stripped code.
 
     Args:
-        file_path (str): The path to the Java file to be refactored.
-        prompt_text (str): The prompt text to guide the AI refactoring.
-        connection: The connection object for interacting with the AI model.
+        stripped_code (str): The Java code with comments replaced by placeholders.
+        comments (list): The list of original comments.
 
     Returns:
-        str: The refactored Java code with comments restored.
+        function: Maps an offset in the stripped code to a line number (1-based) in the original code.
     """
-    with open(file_path, 'r', encoding='utf-8') as f:
-        java_code = f.read()
+    # The placeholders hide the newlines of the comments they replace
+    positions = []
+    hidden_newlines = [0]
+    for match in re.finditer(r'/\*COMMENT(\d+)\*/', stripped_code):
+        positions.append(match.start())
+        hidden_newlines.append(hidden_newlines[-1] + comments[int(match.group(1))].count("\n"))
 
-    # Step 1: Remove comments temporarily to avoid `{}` inside comments affecting extraction
-    java_code = java_code.replace("//", " // ")  # Ensure `//` comments are separated by spaces
-    stripped_code, comments = remove_comments_from_code(java_code)
+    def line_of(offset):
+        return stripped_code.count("\n", 0, offset) + hidden_newlines[bisect.bisect_left(positions, offset)] + 1
 
-    # Step 2: Updated regex to correctly handle return types, generics (`<>`), and exclude control statements
+    return line_of
+
+def extract_method_spans(stripped_code):
+    """
+    Finds the methods in Java code from which the comments have been removed.
+
+    Args:
+        stripped_code (str): The Java code with comments replaced by placeholders.
+
+    Returns:
+        list: The (start, end) offsets of each method, in order of appearance.
+    """
+    # Updated regex to correctly handle return types, generics (`<>`), and exclude control statements
     method_signature_pattern = re.compile(
         r'^\s*'  # Start of line with optional spaces
         r'(?:(?:public|private|protected|static|final|synchronized|abstract|native|transient)\s+)*'  # Modifiers
@@ -144,10 +272,9 @@ def extract_and_refactor_methods(file_path, prompt_text, connection):
     )
     
     method_positions = [m.start() for m in method_signature_pattern.finditer(stripped_code)]
-    refactored_code = stripped_code  # Preserve original file structure
-    method_bodies = {}
+    spans = []
 
-    # Step 3: Extract and refactor methods using a stack-based approach
+    # Extract methods using a stack-based approach
     for start in method_positions:
         brace_count = 0
         inside_string = False
@@ -164,41 +291,345 @@ def extract_and_refactor_methods(file_path, prompt_text, connection):
                 elif char == '}':
                     brace_count -= 1
                     if brace_count == 0:
-                        method_body = stripped_code[start:i + 1]
-                        refactored_method = refactor(method_body, prompt_text, connection)
-                        method_bodies[method_body] = refactored_method
+                        spans.append((start, i + 1))
                         break
+    return spans
+
+def extract_methods(stripped_code):
+    """
+    Extracts the methods from Java code from which the comments have been removed.
+
+    Args:
+        stripped_code (str): The Java code with comments replaced by placeholders.
+
+    Returns:
+        list: The source code of each method, in order of appearance.
+    """
+    return [stripped_code[start:end] for start, end in extract_method_spans(stripped_code)]
+
+def method_keys(methods):
+    """
+    Returns a key for each method that identifies it across versions of a file: its name and the number of methods with
+    the same name (overloads) before it.
+
+    Args:
+        methods (list): The source code of the methods, in order of appearance.
+
+    Returns:
+        list: The (name, occurrence) key of each method.
+    """
+    occurrences = {}
+    keys = []
+    for method in methods:
+        name = re.search(r'(\w+)\s*\(', method).group(1)
+        keys.append((name, occurrences.get(name, 0)))
+        occurrences[name] = occurrences.get(name, 0) + 1
+    return keys
+
+def previous_methods(output_file_path):
+    """
+    Returns the methods in the existing output of a Java file, so the methods that did not change are taken from it
+    instead of being refactored again.
+
+    Args:
+        output_file_path (str): The path of the refactored file.
+
+    Returns:
+        dict: The refactored code of each method (with its comments) by method key (see method_keys); empty if there is
+        no output yet.
+    """
+    if not os.path.exists(output_file_path):
+        return {}
+    with open(output_file_path, 'r', encoding='utf-8') as f:
+        stripped_code, comments = remove_comments_from_code(f.read())
+    methods = extract_methods(stripped_code)
+    return {key: restore_comments(method, comments) for key, method in zip(method_keys(methods), methods)}
 
-    # Step 4: Replace old methods with refactored versions in the modified code
-    for old_method, new_method in method_bodies.items():
-        refactored_code = refactored_code.replace(old_method, new_method)
+def select_methods(file_path, stripped_code, comments, spans, changed_lines):
+    """
+    Selects the methods of a Java file to refactor: all of them, or the methods that intersect the changed lines. The
+    other methods are taken from the existing output; a method that is not found there is selected as well, so the
+    original code never replaces a refactored method in the output.
+
+    Args:
+        file_path (str): The path to the Java file.
+        stripped_code (str): The Java code with comments replaced by placeholders.
+        comments (list): The list of original comments.
+        spans (list): The (start, end) offsets of the methods (see extract_method_spans).
+        changed_lines (list, optional): The changed line ranges (see git_changes.py), or None to select all methods.
+
+    Returns:
+        list: For each method, None if it is selected, or its code in the existing output.
+    """
+    if changed_lines is None:
+        return [None] * len(spans)
+    line_of = line_counter(stripped_code, comments)
+    previous = previous_methods(get_output_path(file_path))
+    keys = method_keys([stripped_code[start:end] for start, end in spans])
+    return [None if git_changes.intersects(line_of(start), line_of(end - 1), changed_lines) else previous.get(key)
+            for (start, end), key in zip(spans, keys)]
+
+def extract_and_refactor_methods(file_path, prompt_text, connection, changed_lines=None):
+    """
+    Extracts methods from a Java file, refactors them using AI, and restores comments.
+
+    Args:
+        file_path (str): The path to the Java file to be refactored.
+        prompt_text (str): The prompt text to guide the AI refactoring.
+        connection: The connection object for interacting with the AI model.
+        changed_lines (list, optional): The changed line ranges (see git_changes.py). When given, only the methods that
+            intersect them are refactored; the other methods are taken from the existing output (see select_methods).
+
+    Returns:
+        str: The refactored Java code with comments restored.
+    """
+    with profiling.span("read", "io", file=file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            java_code = f.read()
+
+    with profiling.span("extract_methods", "cpu", cpu=True, file=file_path):
+        # Step 1: Remove comments temporarily to avoid `{}` inside comments affecting extraction
+        java_code = java_code.replace("//", " // ")  # Ensure `//` comments are separated by spaces
+        stripped_code, comments = remove_comments_from_code(java_code)
 
-    # Step 5: Restore original comments before writing back the file
-    refactored_code = restore_comments(refactored_code, comments)
+        # Step 2: Extract the methods
+        spans = extract_method_spans(stripped_code)
+        previous = select_methods(file_path, stripped_code, comments, spans, changed_lines)
+    refactored_code = stripped_code  # Preserve original file structure
+    method_bodies = {}
+
+    # Step 3: Refactor the methods
+    selected_methods = []
+    for (start, end), previous_method in zip(spans, previous):
+        method_body = stripped_code[start:end]
+        if method_body in method_bodies:
+            continue
+        if previous_method is None:
+            method_bodies[method_body] = None
+            selected_methods.append(method_body)
+        else:
+            method_bodies[method_body] = previous_method
+    method_bodies.update(refactor_methods(selected_methods, prompt_text, connection, unit=file_path))
+
+    with profiling.span("splice_methods", "cpu", cpu=True, file=file_path):
+        # Step 4: Replace old methods with refactored versions in the modified code
+        for old_method, new_method in method_bodies.items():
+            refactored_code = refactored_code.replace(old_method, new_method)
+
+        # Step 5: Restore original comments before writing back the file
+        refactored_code = restore_comments(refactored_code, comments)
     return refactored_code
 
+def get_output_path(file_path):
+    """
+    Returns the path in the output directory for a Java file.
+
+    Args:
+        file_path (str): The path to the Java file.
+
+    Returns:
+        str: The path of the refactored file.
+    """
+    cleaned_path = re.sub(r"^(\.\./|\.\/)+", "", file_path)
+    if cleaned_path.startswith("/"):
+        cleaned_path = cleaned_path[1:] 
+        logger.warning(f"Input path is absolute. Removing leading slash: {cleaned_path}")
+    return os.path.join(OUTPUT_DIR, cleaned_path)
+
+def refactor_file(file_path, prompt_text, connection, changed_lines=None, force=False):
+    """
+    Refactors a Java file, unless the existing output is newer, and queues the result for formatting.
+
+    Args:
+        file_path (str): The path to the Java file to be refactored.
+        prompt_text (str): The prompt text to guide the AI refactoring.
+        connection: The connection object for interacting with the AI model.
+        changed_lines (list, optional): The changed line ranges; only the methods intersecting them are refactored.
+        force (bool): Refactor the file even if the existing output is newer (used when selecting changes with git).
+
+    Side Effects:
+        Writes the refactored code to the output directory and queues it for formatting with astyle (see
+        batch_format.py). When the output already holds the formatted version of the same code, only its modification
+        time is updated.
+    """
+    output_file_path = get_output_path(file_path)
+
+    if not force and os.path.exists(output_file_path) and os.path.getmtime(file_path) < os.path.getmtime(output_file_path):
+        logger.info(f"Skipping {file_path} as it is not newer than the existing output.")
+        return
+    logger.info(f"Refactoring {file_path}.")
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    with profiling.span("refactor_file", "unit", file=file_path):
+        refactored_code = extract_and_refactor_methods(file_path, prompt_text, connection, changed_lines)
+    if batch_format.is_formatted(output_file_path, refactored_code):
+        logger.info(f"Refactored code did not change, keeping: {output_file_path}")
+        os.utime(output_file_path)
+        return
+    with profiling.span("write", "io", file=output_file_path):
+        with open(output_file_path, "w") as output_file:
+            output_file.write(refactored_code)
+            logger.info(f"Refactored code written to: {output_file_path}")
+    batch_format.submit(output_file_path, refactored_code)
+
+def select_changed_files(since):
+    """
+    Selects the Java files that changed since a git reference, and updates the outputs of deleted and renamed files.
+
+    Args:
+        since (str): The git reference to compare with.
+
+    Returns:
+        dict: Maps the path of each added or modified Java file to its changed line ranges (None for a new file).
+
+    Side Effects:
+        Removes the outputs of deleted files and moves the outputs of renamed files (unless planning).
+        Exits the program if the changes cannot be determined with git.
+    """
+    changed = git_changes.changes(SRC_DIR, since, logger)
+    if changed is None:
+        logger.error(f"Error: Unable to determine the changes in {SRC_DIR} since {since}.")
+        sys.exit(1)
+    changed = {path: change for path, change in changed.items() if path.endswith(".java")}
+    output_path = lambda path: get_output_path(os.path.join(SRC_DIR, path))
+    if args.plan:
+        # Do not touch the outputs when planning
+        unchanged = set(path for path, change in changed.items()
+                        if change["status"] == "R" and not change["lines"] and os.path.exists(output_path(change["old_path"])))
+    else:
+        unchanged = git_changes.apply_deletions_and_renames(changed, output_path, logger)
+    java_files = {os.path.join(SRC_DIR, path): change["lines"] for path, change in changed.items()
+                  if change["status"] != "D" and path not in unchanged}
+    logger.info(f"{len(java_files)} Java files changed since {since}")
+    return java_files
+
+def process_changes(paths, prompt_text, connection, sources):
+    """
+    Refactors the Java files that changed in watch mode. Only the methods intersecting the changed lines are refactored
+    again, and the outputs are formatted in one round of batches.
+
+    Args:
+        paths (list): The changed paths; a path that no longer exists was deleted.
+        prompt_text (str): The prompt text to guide the AI refactoring.
+        connection: The connection object for interacting with the AI model.
+        sources (dict): The last refactored content by Java file, updated with the changed files.
+
+    Side Effects:
+        Writes and formats the refactored files, and removes the outputs of deleted files.
+    """
+    java_files = {}
+    for path in paths:
+        output_file_path = get_output_path(path)
+        if not os.path.exists(path):
+            sources.pop(path, None)
+            if os.path.exists(output_file_path) and os.path.abspath(output_file_path) != os.path.abspath(path):
+                os.remove(output_file_path)
+                logger.info(f"Removed {output_file_path}, as {path} was deleted.")
+            continue
+        with open(path, "r") as java_file:
+            source = java_file.read()
+        if source == sources.get(path):
+            continue
+        java_files[path] = watch.changed_lines(sources.get(path), source)
+        sources[path] = source
+    batch_format.start(args.format_workers, args.format_batch, CACHE_DIR)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(lambda file_path: refactor_file(file_path, prompt_text, connection, java_files[file_path],
+                                                          force=True),
+                          planner.largest_first(java_files, os.path.getsize)))
+    batch_format.finish()
+    for file_path in java_files:
+        watch.suppress(get_output_path(file_path))
+
+def plan_file(file_path, prompt_text, changed_lines=None, force=False):
+    """
+    Describes the calls the refactoring of a Java file would make, without calling the model (see planner.py).
+
+    Args:
+        file_path (str): The path to the Java file.
+        prompt_text (str): The prompt text to guide the AI refactoring.
+        changed_lines (list, optional): The changed line ranges; only the methods intersecting them are refactored.
+        force (bool): Plan the file even if the existing output is newer.
+
+    Returns:
+        list: The planned calls (see planner.call). Methods with a cached refactoring need no call.
+    """
+    output_file_path = get_output_path(file_path)
+    if not force and os.path.exists(output_file_path) and os.path.getmtime(file_path) < os.path.getmtime(output_file_path):
+        return []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        stripped_code, comments = remove_comments_from_code(f.read().replace("//", " // "))
+    spans = extract_method_spans(stripped_code)
+    spans = [span for span, previous_method in zip(spans, select_methods(file_path, stripped_code, comments, spans,
+                                                                         changed_lines)) if previous_method is None]
+    methods = []
+    for start, end in spans:
+        method = stripped_code[start:end]
+        if method not in methods and java_canonical.cached_refactoring(method, MODEL_NAME + "\0" + prompt_text, CACHE_DIR) is None:
+            methods.append(method)
+    calls = []
+    short = [method for method in methods if telemetry.estimate_tokens(method) <= args.pack_budget // 4]
+    units = [[method] for method in methods if method not in short]
+    units += [[method for method, _ in batch] for batch in packing.pack([(method, method) for method in short], args.pack_budget)]
+    for unit in units:
+        if len(unit) > 1:
+            text = prompt_text + packing.PACKED_INSTRUCTIONS + packing.build_input([(f"M{i}", m) for i, m in enumerate(unit)])
+        else:
+            text = prompt_text + unit[0]
+        model = ai.route(text[len(prompt_text):], MODEL_NAME, "refactor",
+                         max(ai.complexity(method, "java") for method in unit))[0]
+        calls.append(planner.call("refactor", model, text, sum(telemetry.estimate_tokens(method) for method in unit), file_path))
+    return calls
+
 if __name__ == "__main__":
-    connection = create_connection()
+    connection = create_connection(MODEL_NAME)
     with open(args.prompt, 'r', encoding='utf-8') as prompt_file:
         prompt_text = prompt_file.read()
-    for root, dirs, files in os.walk(SRC_DIR):
-        for file in files:
-            if file.endswith(".java"):
-                file_path = os.path.join(root, file)
-                cleaned_path = re.sub(r"^(\.\./|\.\/)+", "", file_path)
-                if cleaned_path.startswith("/"):
-                    cleaned_path = cleaned_path[1:] 
-                    logger.warning(f"Input path is absolute. Removing leading slash: {cleaned_path}")
-                output_file_path = os.path.join(OUTPUT_DIR, cleaned_path)
-
-                if os.path.exists(output_file_path) and os.path.getmtime(file_path) < os.path.getmtime(output_file_path):
-                    logger.info(f"Skipping {file_path} as it is not newer than the existing output.")
-                else:
-                    logger.info(f"Refactoring {file_path}.")
-                    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-                    refactored_code = extract_and_refactor_methods(file_path, prompt_text, connection)
-                    with open(output_file_path, "w") as output_file:
-                        output_file.write(refactored_code)
-                        logger.info(f"Refactored code written to: {output_file_path}")
-                    run_command(f"astyle -n --style=java {output_file_path}", None, logger)
-    logger.info("Refactoring completed.")
\ No newline at end of file
+    since = git_changes.get_since(args)
+    if args.worker:
+        # The Java files are enqueued by the process started without --worker
+        java_files = {}
+    elif since:
+        java_files = select_changed_files(since)
+    else:
+        with profiling.span("walk", "walk", cpu=True, directory=SRC_DIR):
+            java_files = {os.path.join(root, file): None for root, dirs, files in os.walk(SRC_DIR)
+                          for file in files if file.endswith(".java")}
+    if args.plan:
+        calls = [planned for file_path in java_files
+                 for planned in plan_file(file_path, prompt_text, java_files[file_path], force=bool(since))]
+        planner.report(planner.estimate(calls, args.workers), args.workers, logger)
+        sys.exit(0)
+    # Files are refactored concurrently, largest first; identical methods in different files share one model call. The
+    # output is formatted in batches in the background.
+    batch_format.start(args.format_workers, args.format_batch, CACHE_DIR)
+    if args.queue:
+        # The files are spread over the worker processes of the queue, largest first; this process is one of them
+        if not args.worker:
+            work_queue.enqueue(args.queue, "refactor",
+                               {file_path: {"changed_lines": java_files[file_path], "force": bool(since)}
+                                for file_path in planner.largest_first(java_files, os.path.getsize)})
+        work_queue.run_worker(args.queue, "refactor",
+                              lambda file_path, payload: refactor_file(file_path, prompt_text, connection,
+                                                                       payload["changed_lines"], payload["force"]),
+                              logger, args.workers, args.lease, wait=args.worker)
+    else:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(lambda file_path: refactor_file(file_path, prompt_text, connection, java_files[file_path],
+                                                              force=bool(since)),
+                              planner.largest_first(java_files, os.path.getsize)))
+    with profiling.span("format", "stage"):
+        batch_format.finish()
+    if args.queue and not args.worker and not work_queue.check_done(args.queue, "refactor", list(java_files), logger):
+        logger.error("Refactoring incomplete: not all files were refactored.")
+        sys.exit(1)
+    logger.info("Refactoring completed.")
+    if args.watch and not args.worker:
+        # Keep the connection and caches warm, and refactor the files that change
+        sources = {}
+        for root, dirs, files in os.walk(SRC_DIR):
+            for file in files:
+                if file.endswith(".java"):
+                    with open(os.path.join(root, file), "r") as java_file:
+                        sources[os.path.join(root, file)] = java_file.read()
+        watch.watch(SRC_DIR, (".java",), lambda paths: process_changes(paths, prompt_text, connection, sources), logger,
+                    args.debounce, args.poll_interval)
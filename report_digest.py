@@ -0,0 +1,252 @@
+"""
+This script condenses the reports of analyse_codebase.py (pylint, radon cc, radon mi and vulture) into compact digests for
+the prompts of create_reports.py. A report is read line by line and folded into aggregates of bounded size: counters by
+message type or rank, the TOP_K most severe or complex entries, and the files with the most findings (counted with the
+space-saving algorithm, so the number of counters stays at FILE_COUNTERS however many files the report covers). The
+memory used does not depend on the size of the report, and the digest stays small enough for one prompt.
+
+Functions:
+- digest_pylint: Digests the lines of a pylint report.
+- digest_radon_cc: Digests the lines of a radon cc report.
+- digest_radon_mi: Digests the lines of a radon mi report.
+- digest_vulture: Digests the lines of a vulture report.
+- digest_report: Digests a report file, chosen by its name.
+"""
+
+import os
+import re
+import heapq
+import itertools
+
+# Number of entries kept per top list, and number of counters of the files with the most findings
+TOP_K = 25
+FILE_COUNTERS = 50
+
+# Maximum length of an entry in the digest
+ENTRY_LENGTH = 200
+
+# Lines of the report formats
+PYLINT_MESSAGE = re.compile(r"^(?P<path>.+?):(?P<line>\d+):(?P<column>-?\d+): (?P<id>[CRWEFI]\d{4}): (?P<text>.*?)(?: \((?P<symbol>[a-z0-9-]+)\))?$")
+PYLINT_RATING = re.compile(r"^Your code has been rated at (?P<rating>.*)$")
+RADON_CC_BLOCK = re.compile(r"^\s+(?P<type>[FMC]) (?P<line>\d+):\d+ (?P<name>\S+) - (?P<rank>[A-F]) \((?P<complexity>\d+)\)$")
+RADON_CC_AVERAGE = re.compile(r"^Average complexity: (?P<average>.*)$")
+RADON_MI_FILE = re.compile(r"^(?P<path>.+) - (?P<rank>[A-C]) \((?P<score>[\d.]+)\)$")
+VULTURE_FINDING = re.compile(r"^(?P<path>.+?):(?P<line>\d+): (?P<text>(?P<kind>[^'(]+?)(?: '.*')?) \((?P<confidence>\d+)% confidence(?:, \d+ lines?)?\)$")
+
+# Pylint categories, most severe first
+PYLINT_CATEGORIES = {"F": "fatal", "E": "error", "W": "warning", "R": "refactor", "C": "convention", "I": "info"}
+
+def _entry(text):
+    """
+    Shortens an entry of a report to ENTRY_LENGTH characters.
+    """
+    return text if len(text) <= ENTRY_LENGTH else text[:ENTRY_LENGTH] + "..."
+
+def _keep(heap, item, k=TOP_K):
+    """
+    Keeps the k largest items in a min-heap.
+    """
+    if len(heap) < k:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+def _count(counters, key, capacity=FILE_COUNTERS):
+    """
+    Counts a key with the space-saving algorithm: when all counters are taken, the smallest counter is given to the new
+    key. The counts of the most frequent keys are then exact or slightly overestimated.
+    """
+    if key in counters or len(counters) < capacity:
+        counters[key] = counters.get(key, 0) + 1
+    else:
+        smallest = min(counters, key=counters.get)
+        counters[key] = counters.pop(smallest) + 1
+
+def _counts(title, counters, limit=TOP_K):
+    """
+    Formats counters as a section of a digest, most frequent first.
+    """
+    lines = [f"{title}:"]
+    for key, count in sorted(counters.items(), key=lambda item: (-item[1], item[0]))[:limit]:
+        lines.append(f"  {count} {key}")
+    return lines
+
+def digest_pylint(lines):
+    """
+    Digests the lines of a pylint report: the number of messages by category and by message, the modules with the most
+    messages, the most severe messages and the rating.
+
+    Args:
+        lines (iterable): The lines of the report.
+
+    Returns:
+        str: The digest.
+    """
+    categories = {}
+    messages = {}
+    examples = {}
+    modules = {}
+    severe = []
+    rating = None
+    order = itertools.count()
+    for line in lines:
+        line = line.rstrip("\n")
+        match = PYLINT_MESSAGE.match(line)
+        if match is None:
+            rating_match = PYLINT_RATING.match(line)
+            if rating_match:
+                rating = rating_match.group("rating")
+            continue
+        category = match.group("id")[0]
+        message = f"{match.group('id')} {match.group('symbol') or match.group('text')}"
+        categories[category] = categories.get(category, 0) + 1
+        # The message ids of pylint are a fixed set, so this counter is bounded
+        messages[message] = messages.get(message, 0) + 1
+        examples.setdefault(message, _entry(line))
+        _count(modules, match.group("path"))
+        # The most severe messages, the earliest first among equally severe ones
+        _keep(severe, (-list(PYLINT_CATEGORIES).index(category), -next(order), _entry(line)))
+    total = sum(categories.values())
+    digest = [f"Pylint messages: {total}"]
+    digest += [f"  {categories[category]} {name}" for category, name in PYLINT_CATEGORIES.items() if category in categories]
+    if rating:
+        digest.append(f"Rating: {rating}")
+    digest += _counts("Messages by type", messages)
+    digest.append("Example of each frequent message type:")
+    digest += [f"  {examples[message]}" for message, _ in sorted(messages.items(), key=lambda item: -item[1])[:10]]
+    digest += _counts("Modules with the most messages", modules)
+    digest.append("Most severe messages:")
+    digest += [f"  {line}" for _, _, line in sorted(severe, reverse=True)]
+    return "\n".join(digest)
+
+def digest_radon_cc(lines):
+    """
+    Digests the lines of a radon cc report (`radon cc -s`): the number of blocks by rank, the average complexity and the
+    most complex blocks.
+
+    Args:
+        lines (iterable): The lines of the report.
+
+    Returns:
+        str: The digest.
+    """
+    ranks = {}
+    total_complexity = 0
+    complex_blocks = []
+    average = None
+    path = None
+    for line in lines:
+        line = line.rstrip("\n")
+        match = RADON_CC_BLOCK.match(line)
+        if match is None:
+            average_match = RADON_CC_AVERAGE.match(line)
+            if average_match:
+                average = average_match.group("average")
+            elif line and not line[0].isspace() and not line[0].isdigit():
+                path = line
+            continue
+        complexity = int(match.group("complexity"))
+        ranks[match.group("rank")] = ranks.get(match.group("rank"), 0) + 1
+        total_complexity += complexity
+        _keep(complex_blocks, (complexity, _entry(f"{path}:{match.group('line')} {match.group('name')} - "
+                                                  f"{match.group('rank')} ({complexity})")))
+    blocks = sum(ranks.values())
+    digest = [f"Blocks analyzed: {blocks}"]
+    digest += [f"  {ranks[rank]} of rank {rank}" for rank in sorted(ranks)]
+    if average:
+        digest.append(f"Average complexity: {average}")
+    elif blocks:
+        digest.append(f"Average complexity: {total_complexity / blocks:.2f}")
+    digest.append("Most complex blocks:")
+    digest += [f"  {block}" for _, block in sorted(complex_blocks, reverse=True)]
+    return "\n".join(digest)
+
+def digest_radon_mi(lines):
+    """
+    Digests the lines of a radon mi report (`radon mi -s`): the number of files by rank, the average maintainability
+    index and the least maintainable files.
+
+    Args:
+        lines (iterable): The lines of the report.
+
+    Returns:
+        str: The digest.
+    """
+    ranks = {}
+    total_score = 0.0
+    least_maintainable = []
+    for line in lines:
+        match = RADON_MI_FILE.match(line.rstrip("\n"))
+        if match is None:
+            continue
+        score = float(match.group("score"))
+        ranks[match.group("rank")] = ranks.get(match.group("rank"), 0) + 1
+        total_score += score
+        _keep(least_maintainable, (-score, _entry(f"{match.group('path')} - {match.group('rank')} ({score:.2f})")))
+    files = sum(ranks.values())
+    digest = [f"Files analyzed: {files}"]
+    digest += [f"  {ranks[rank]} of rank {rank}" for rank in sorted(ranks)]
+    if files:
+        digest.append(f"Average maintainability index: {total_score / files:.2f}")
+    digest.append("Least maintainable files:")
+    digest += [f"  {entry}" for _, entry in sorted(least_maintainable, reverse=True)]
+    return "\n".join(digest)
+
+def digest_vulture(lines):
+    """
+    Digests the lines of a vulture report: the number of findings by kind and by confidence, the files with the most
+    findings and the findings with the highest confidence.
+
+    Args:
+        lines (iterable): The lines of the report.
+
+    Returns:
+        str: The digest.
+    """
+    kinds = {}
+    confidences = {}
+    files = {}
+    confident = []
+    order = itertools.count()
+    for line in lines:
+        line = line.rstrip("\n")
+        match = VULTURE_FINDING.match(line)
+        if match is None:
+            continue
+        confidence = int(match.group("confidence"))
+        # The kinds of findings of vulture (unused function, unused import, ...) are a fixed set
+        kinds[match.group("kind")] = kinds.get(match.group("kind"), 0) + 1
+        confidences[f"{confidence}% confidence"] = confidences.get(f"{confidence}% confidence", 0) + 1
+        _count(files, match.group("path"))
+        _keep(confident, (confidence, -next(order), _entry(line)))
+    digest = [f"Findings: {sum(kinds.values())}"]
+    digest += _counts("Findings by kind", kinds)[1:]
+    digest += _counts("Findings by confidence", confidences)
+    digest += _counts("Files with the most findings", files)
+    digest.append("Findings with the highest confidence:")
+    digest += [f"  {line}" for _, _, line in sorted(confident, reverse=True)]
+    return "\n".join(digest)
+
+# The digest function by report name (see analyse_codebase.py)
+DIGESTS = {
+    "pylint_report": digest_pylint,
+    "radon_cc_report": digest_radon_cc,
+    "radon_mi_report": digest_radon_mi,
+    "vulture_report": digest_vulture,
+}
+
+def digest_report(path):
+    """
+    Digests a report file, chosen by its name, reading it line by line.
+
+    Args:
+        path (str): The path of the report file, e.g. "reports/pylint_report.txt".
+
+    Returns:
+        str: The digest, or None if the report type is not known.
+    """
+    for name, digest in DIGESTS.items():
+        if name in os.path.basename(path):
+            with open(path, "r", errors="replace") as report_file:
+                return digest(report_file)
+    return None
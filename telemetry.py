@@ -0,0 +1,290 @@
+"""
+This script collects telemetry on the large language model calls made by the other scripts. For every call it records the
+calling stage, the model, the number of input and output tokens (and of the input tokens read from the provider's prompt
+cache), the time to the first token, the total latency and the number of retries. Cache hits and misses of the various caches are counted as well.
+
+The trace of all calls is written as JSONL while the run progresses. At the end of the run a summary is logged and, when an
+output directory is configured, written as JSON together with a metrics file in the Prometheus textfile format.
+
+Functions:
+- configure: Sets the directory to write the trace, summary and metrics files to.
+- estimate_tokens: Estimates the number of tokens of a text, without a tokenizer.
+- estimate_cost: Estimates the cost of a call based on the number of tokens.
+- record_call: Records a single large language model call.
+- record_cache: Records a hit or miss of a cache.
+- summary: Returns the aggregated telemetry of the run.
+- write_summary: Logs the summary and writes the summary and metrics files.
+"""
+
+import os
+import re
+import json
+import time
+import atexit
+import logging
+import threading
+
+# Create a logger object
+logger = logging.getLogger(__name__)
+
+# Prices in USD per million tokens (input, output, cached input). Calls to unknown models are reported without cost.
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00, 1.25),
+    "gpt-4o-mini": (0.15, 0.60, 0.075),
+    "gpt-4.1": (2.00, 8.00, 0.50),
+    "gpt-4.1-mini": (0.40, 1.60, 0.10),
+    "gpt-4.1-nano": (0.10, 0.40, 0.025),
+    "o3-mini": (1.10, 4.40, 0.55),
+}
+
+TRACE_FILE = "llm_trace.jsonl"
+SUMMARY_FILE = "llm_summary.json"
+METRICS_FILE = "llm_metrics.prom"
+
+# Words (split in pieces of 4 characters), punctuation and line breaks with their indentation
+TOKEN_ESTIMATE_PATTERN = re.compile(r"\w{1,4}|[^\w\s]|\n[ \t]*")
+
+_lock = threading.Lock()
+_output_dir = None
+_trace = None
+_calls = {}
+_caches = {}
+_started = time.time()
+
+def configure(output_dir):
+    """
+    Sets the directory to write the trace, summary and metrics files to.
+
+    Args:
+        output_dir (str): The directory for the telemetry files. It is created when it does not exist.
+
+    Side Effects:
+        Opens (and truncates) the JSONL trace file in the output directory.
+    """
+    global _output_dir, _trace
+    os.makedirs(output_dir, exist_ok=True)
+    with _lock:
+        _output_dir = output_dir
+        _trace = open(os.path.join(output_dir, TRACE_FILE), "w")
+    logger.info(f"LLM telemetry will be written to: {output_dir}")
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens of a text, without a tokenizer. For source code and English text the estimate is
+    somewhat higher than the count of the tokenizers of the OpenAI models, which is the safe side for budgets.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return len(TOKEN_ESTIMATE_PATTERN.findall(text))
+
+def estimate_cost(model, input_tokens, output_tokens, cached_tokens=0):
+    """
+    Estimates the cost of a call based on the number of tokens.
+
+    Args:
+        model (str): The name of the model.
+        input_tokens (int): The number of input (prompt) tokens, including the cached ones.
+        output_tokens (int): The number of output (completion) tokens.
+        cached_tokens (int): The number of input tokens read from the provider's prompt cache.
+
+    Returns:
+        float: The estimated cost in USD, or None when the price of the model is unknown.
+    """
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return ((input_tokens - cached_tokens) * prices[0] + cached_tokens * prices[2] + output_tokens * prices[1]) / 1_000_000
+
+def record_call(stage, model, input_tokens, output_tokens, time_to_first_token, latency, retries=0, status="ok",
+                unit=None, estimated=False, cached_tokens=0):
+    """
+    Records a single large language model call.
+
+    Args:
+        stage (str): The calling stage, e.g. "docstrings", "report", "readme" or "refactor".
+        model (str): The name of the model.
+        input_tokens (int): The number of input tokens.
+        output_tokens (int): The number of output tokens.
+        time_to_first_token (float): Seconds until the first chunk of the response arrived in the last attempt, or None.
+        latency (float): Total seconds of the call, including retries.
+        retries (int): The number of retries needed.
+        status (str): "ok" or "error".
+        unit (str, optional): The unit of work, e.g. the file being processed.
+        estimated (bool): Whether the token counts are estimated because the API did not report them.
+        cached_tokens (int): The number of input tokens read from the provider's prompt cache.
+
+    Side Effects:
+        Appends the call to the JSONL trace when telemetry output is configured.
+    """
+    cost = estimate_cost(model, input_tokens, output_tokens, cached_tokens)
+    record = {
+        "timestamp": time.time(),
+        "stage": stage,
+        "model": model,
+        "unit": unit,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_input_tokens": cached_tokens,
+        "tokens_estimated": estimated,
+        "time_to_first_token": time_to_first_token,
+        "latency": latency,
+        "retries": retries,
+        "status": status,
+        "cost": cost,
+    }
+    with _lock:
+        stats = _calls.setdefault((stage, model), {
+            "calls": 0, "failures": 0, "retries": 0, "input_tokens": 0, "output_tokens": 0, "cached_input_tokens": 0,
+            "cost": 0.0, "latency": [], "time_to_first_token": [],
+        })
+        stats["calls"] += 1
+        stats["failures"] += status != "ok"
+        stats["retries"] += retries
+        stats["input_tokens"] += input_tokens
+        stats["output_tokens"] += output_tokens
+        stats["cached_input_tokens"] += cached_tokens
+        stats["cost"] += cost or 0.0
+        stats["latency"].append(latency)
+        if time_to_first_token is not None:
+            stats["time_to_first_token"].append(time_to_first_token)
+        if _trace:
+            _trace.write(json.dumps(record) + "\n")
+            _trace.flush()
+
+def record_cache(cache, hit):
+    """
+    Records a hit or miss of a cache.
+
+    Args:
+        cache (str): The name of the cache.
+        hit (bool): Whether the lookup was a hit.
+    """
+    with _lock:
+        stats = _caches.setdefault(cache, {"hits": 0, "misses": 0})
+        stats["hits" if hit else "misses"] += 1
+
+def _percentile(values, fraction):
+    """
+    Returns the given percentile of a list of values (nearest rank), or None for an empty list.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summary():
+    """
+    Returns the aggregated telemetry of the run.
+
+    Returns:
+        dict: Totals, per stage/model statistics (including latency percentiles) and cache hit rates.
+    """
+    with _lock:
+        stages = []
+        for (stage, model), stats in sorted(_calls.items()):
+            stages.append({
+                "stage": stage,
+                "model": model,
+                "calls": stats["calls"],
+                "failures": stats["failures"],
+                "retries": stats["retries"],
+                "input_tokens": stats["input_tokens"],
+                "output_tokens": stats["output_tokens"],
+                "cached_input_tokens": stats["cached_input_tokens"],
+                "cost": round(stats["cost"], 6),
+                "latency_total": round(sum(stats["latency"]), 3),
+                "latency_p50": _percentile(stats["latency"], 0.5),
+                "latency_p95": _percentile(stats["latency"], 0.95),
+                "latency_max": max(stats["latency"]),
+                "time_to_first_token_p50": _percentile(stats["time_to_first_token"], 0.5),
+            })
+        caches = {}
+        for cache, stats in sorted(_caches.items()):
+            lookups = stats["hits"] + stats["misses"]
+            caches[cache] = dict(stats, hit_rate=round(stats["hits"] / lookups, 4) if lookups else None)
+    return {
+        "wall_time": round(time.time() - _started, 3),
+        "calls": sum(s["calls"] for s in stages),
+        "input_tokens": sum(s["input_tokens"] for s in stages),
+        "output_tokens": sum(s["output_tokens"] for s in stages),
+        "cached_input_tokens": sum(s["cached_input_tokens"] for s in stages),
+        "cost": round(sum(s["cost"] for s in stages), 6),
+        "stages": stages,
+        "caches": caches,
+    }
+
+def _metrics(report):
+    """
+    Renders the summary in the Prometheus textfile format.
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP codebaseai_{name} {help_text}")
+        lines.append(f"# TYPE codebaseai_{name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+            lines.append(f"codebaseai_{name}{{{label_text}}} {value}")
+
+    stages = report["stages"]
+    labels = [{"stage": s["stage"], "model": s["model"]} for s in stages]
+    metric("llm_calls_total", "counter", "Number of LLM calls.", zip(labels, [s["calls"] for s in stages]))
+    metric("llm_failures_total", "counter", "Number of failed LLM calls.", zip(labels, [s["failures"] for s in stages]))
+    metric("llm_retries_total", "counter", "Number of LLM call retries.", zip(labels, [s["retries"] for s in stages]))
+    metric("llm_input_tokens_total", "counter", "Number of input tokens sent.",
+           zip(labels, [s["input_tokens"] for s in stages]))
+    metric("llm_cached_input_tokens_total", "counter", "Number of input tokens read from the prompt cache.",
+           zip(labels, [s["cached_input_tokens"] for s in stages]))
+    metric("llm_output_tokens_total", "counter", "Number of output tokens received.",
+           zip(labels, [s["output_tokens"] for s in stages]))
+    metric("llm_cost_usd_total", "counter", "Estimated cost in USD.", zip(labels, [s["cost"] for s in stages]))
+    metric("llm_latency_seconds_sum", "counter", "Total latency of LLM calls.",
+           zip(labels, [s["latency_total"] for s in stages]))
+    metric("llm_latency_seconds_max", "gauge", "Maximum latency of a single LLM call.",
+           zip(labels, [s["latency_max"] for s in stages]))
+    caches = report["caches"]
+    metric("cache_hits_total", "counter", "Number of cache hits.",
+           [({"cache": name}, stats["hits"]) for name, stats in caches.items()])
+    metric("cache_misses_total", "counter", "Number of cache misses.",
+           [({"cache": name}, stats["misses"]) for name, stats in caches.items()])
+    return "\n".join(lines) + "\n"
+
+def write_summary():
+    """
+    Logs the summary and writes the summary and metrics files.
+
+    Side Effects:
+        Logs the end-of-run summary when any call or cache lookup was recorded.
+        Writes the summary (JSON) and metrics (Prometheus textfile) to the configured output directory.
+        Closes the JSONL trace.
+    """
+    global _trace
+    if not _calls and not _caches:
+        return
+    report = summary()
+    logger.info(f"LLM telemetry: {report['calls']} calls, {report['input_tokens']} input tokens "
+                f"({report['cached_input_tokens']} cached), {report['output_tokens']} output tokens, estimated cost ${report['cost']:.2f}")
+    for stage in report["stages"]:
+        logger.info(f"LLM telemetry for {stage['stage']} ({stage['model']}): {stage['calls']} calls, "
+                    f"{stage['retries']} retries, p50 latency {stage['latency_p50']:.2f}s, "
+                    f"p95 latency {stage['latency_p95']:.2f}s")
+    for cache, stats in report["caches"].items():
+        logger.info(f"Cache {cache}: {stats['hits']} hits, {stats['misses']} misses")
+    if _output_dir:
+        with open(os.path.join(_output_dir, SUMMARY_FILE), "w") as summary_file:
+            json.dump(report, summary_file, indent=4)
+        # Write the metrics atomically, as the textfile collector may read it at any moment
+        metrics_path = os.path.join(_output_dir, METRICS_FILE)
+        with open(metrics_path + ".tmp", "w") as metrics_file:
+            metrics_file.write(_metrics(report))
+        os.replace(metrics_path + ".tmp", metrics_path)
+    with _lock:
+        if _trace:
+            _trace.close()
+            _trace = None
+
+atexit.register(write_summary)
@@ -0,0 +1,200 @@
+"""
+This script provides the watch mode of the other scripts: a long-running process that keeps its connections and caches
+warm and reprocesses only the files that changed. File events are taken from inotify (with the optional `inotify_simple`
+package on Linux) or, without it, from polling the modification times. Events are debounced: the changed files are
+handed to the script once no new event arrived for the debounce time, so an editor saving several files (or one file
+several times) results in one round of work.
+
+Files that a script writes itself (e.g. when the output directory is the codebase directory) can be suppressed, so they
+do not trigger another round.
+
+Functions:
+- add_arguments: Adds the watch options to an argument parser.
+- suppress: Ignores the current version of a file that was written by the script itself.
+- changed_lines: Returns the changed line ranges between two versions of a file.
+- watch: Watches a directory and calls a handler with the changed files.
+"""
+
+import os
+import time
+import difflib
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # Optional dependency; polling is used without it
+    INotify = None
+
+_suppressed = {}
+_suppressed_lock = threading.Lock()
+
+def add_arguments(parser):
+    """
+    Adds the watch options to an argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser of the script.
+    """
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running after the first run and reprocess the files that change.")
+    parser.add_argument("--debounce", type=float, default=1.0,
+                        help="Seconds without file events before the changed files are processed (watch mode).")
+    parser.add_argument("--poll_interval", type=float, default=1.0,
+                        help="Seconds between scans when inotify is not available (watch mode).")
+
+def _is_hidden(name):
+    """
+    Checks whether a directory is skipped: hidden directories (e.g. the cache) and compiled files.
+    """
+    return name.startswith(".") or name == "__pycache__"
+
+def _stat(path):
+    """
+    Returns the modification time and size of a file, or None if it does not exist.
+    """
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None
+    return status.st_mtime_ns, status.st_size
+
+def suppress(path):
+    """
+    Ignores the current version of a file that was written by the script itself. A later change of the file is not
+    ignored.
+
+    Args:
+        path (str): The path of the file.
+    """
+    with _suppressed_lock:
+        _suppressed[os.path.normpath(path)] = _stat(path)
+
+def _is_suppressed(path):
+    """
+    Checks whether the current version of a file is suppressed.
+    """
+    with _suppressed_lock:
+        stat = _suppressed.get(os.path.normpath(path))
+    return stat is not None and stat == _stat(path)
+
+def changed_lines(previous, current):
+    """
+    Returns the changed line ranges between two versions of a file, in the format of git_changes.changes, so only the
+    affected definitions or methods are reprocessed.
+
+    Args:
+        previous (str): The previous content, or None if the file is new.
+        current (str): The current content.
+
+    Returns:
+        list: The changed line ranges (first, last) in the current content, or None if the file is new.
+    """
+    if previous is None:
+        return None
+    matcher = difflib.SequenceMatcher(None, previous.splitlines(), current.splitlines(), autojunk=False)
+    # A deletion is reported at the line before it, like git does
+    return [(first + 1, last) if last > first else (first, first)
+            for tag, _, _, first, last in matcher.get_opcodes() if tag != "equal"]
+
+def _snapshot(directory, extensions):
+    """
+    Returns the modification time and size of all files with the extensions in a directory, by path.
+    """
+    snapshot = {}
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [name for name in dirs if not _is_hidden(name)]
+        for file in files:
+            if file.endswith(extensions):
+                path = os.path.join(root, file)
+                snapshot[path] = _stat(path)
+    return snapshot
+
+def _polling_events(directory, extensions, poll_interval):
+    """
+    Returns a function that waits for changed files by comparing snapshots of the directory.
+    """
+    state = {"snapshot": _snapshot(directory, extensions)}
+
+    def wait(timeout):
+        time.sleep(poll_interval if timeout is None else min(timeout, poll_interval))
+        previous, current = state["snapshot"], _snapshot(directory, extensions)
+        state["snapshot"] = current
+        return set(path for path in previous.keys() | current.keys() if previous.get(path) != current.get(path))
+
+    return wait
+
+def _inotify_events(directory, extensions):
+    """
+    Returns a function that waits for changed files using inotify, watching all (new) subdirectories.
+    """
+    inotify = INotify()
+    mask = flags.CREATE | flags.CLOSE_WRITE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO
+    watches = {}
+
+    def add(root):
+        # Files created in a new directory before its watch was added are reported as changed
+        added = set()
+        for path, dirs, files in os.walk(root):
+            dirs[:] = [name for name in dirs if not _is_hidden(name)]
+            watches[inotify.add_watch(path, mask)] = path
+            added.update(os.path.join(path, file) for file in files if file.endswith(extensions))
+        return added
+
+    add(directory)
+
+    def wait(timeout):
+        changed = set()
+        for event in inotify.read(timeout=None if timeout is None else int(timeout * 1000)):
+            parent = watches.get(event.wd)
+            if parent is None or not event.name:
+                continue
+            path = os.path.join(parent, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO) and not _is_hidden(event.name):
+                    changed.update(add(path))
+            elif event.name.endswith(extensions):
+                changed.add(path)
+        return changed
+
+    return wait
+
+def watch(directory, extensions, handler, logger, debounce=1.0, poll_interval=1.0):
+    """
+    Watches a directory and calls a handler with the changed files, until the process is interrupted.
+
+    Args:
+        directory (str): The directory to watch, including its subdirectories (except hidden ones).
+        extensions (tuple): The extensions of the files to watch, e.g. (".py",).
+        handler (function): Called with the sorted list of changed paths; a path that no longer exists was deleted. When
+            it fails, the error is logged and the round is skipped; the files are processed again when they change.
+        logger (logging.Logger): A logger instance used to log the rounds of work.
+        debounce (float): Seconds without new events before the changed files are handed to the handler.
+        poll_interval (float): Seconds between scans when inotify is not available.
+    """
+    if INotify is not None:
+        wait = _inotify_events(directory, extensions)
+        logger.info(f"Watching {directory} for changes using inotify")
+    else:
+        wait = _polling_events(directory, extensions, poll_interval)
+        logger.info(f"Watching {directory} for changes every {poll_interval}s")
+    pending = set()
+    deadline = None
+    try:
+        while True:
+            changed = set(path for path in wait(debounce if pending else None) if not _is_suppressed(path))
+            if changed:
+                pending |= changed
+                deadline = time.monotonic() + debounce
+            elif pending and time.monotonic() >= deadline:
+                paths, pending = sorted(pending), set()
+                logger.info(f"Processing {len(paths)} changed files: {', '.join(paths)}")
+                try:
+                    handler(paths)
+                except SystemExit as e:
+                    # The model calls exit on a persistent error or an exhausted token budget
+                    logger.error(f"Processing the changed files stopped with status {e.code}, skipping this round")
+                except Exception as e:
+                    logger.error(f"Error while processing the changed files, skipping this round: {e}")
+                logger.info("Waiting for changes")
+    except KeyboardInterrupt:
+        logger.info("Watch mode stopped")
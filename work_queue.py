@@ -0,0 +1,324 @@
+"""
+This script provides a durable work queue in an SQLite database, to spread the units of work of a run (scripts, Java
+files, files to analyze) over several worker processes, possibly on several hosts that share a filesystem.
+
+The process started with `--queue PATH` enqueues the units and works on them itself; processes started with
+`--queue PATH --worker` (with the same other options) only work on the units. A worker leases a unit for a limited
+time and renews the lease with heartbeats while it works on it. When a worker dies, its lease expires and the unit is
+leased again by another worker; a unit that failed MAX_ATTEMPTS times is not leased again. The results are written to
+the normal output tree by the workers, or stored in the queue for the enqueueing process to merge.
+
+Functions:
+- add_arguments: Adds the queue options to an argument parser.
+- worker_id: Returns the identifier of this worker process.
+- enqueue: Adds units of work to a queue.
+- lease: Leases the next available unit of work.
+- heartbeat: Renews the lease of a unit.
+- complete: Marks a unit as done, with its result.
+- fail: Marks an attempt at a unit as failed.
+- counts: Counts the units of a queue by status.
+- results: Returns the results of units.
+- check_done: Checks that units are done, logging those that are not.
+- run_worker: Works on the units of a queue until it is drained.
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import closing
+
+DEFAULT_LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+
+def add_arguments(parser):
+    """
+    Adds the queue options to an argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser of the script.
+    """
+    parser.add_argument("--queue", default=None,
+                        help="SQLite database of a work queue shared by worker processes (on a shared filesystem).")
+    parser.add_argument("--worker", action="store_true",
+                        help="Only work on the units of the queue, which are enqueued by another process.")
+    parser.add_argument("--lease", type=int, default=DEFAULT_LEASE_SECONDS,
+                        help="Seconds a worker may work on a unit without a heartbeat before it is leased again.")
+
+def worker_id():
+    """
+    Returns the identifier of this worker process.
+
+    Returns:
+        str: The host name and process id.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _connect(path):
+    """
+    Opens the queue database, creating its table when needed. The default rollback journal is used, as the WAL
+    journal does not work on network filesystems.
+    """
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS units (
+            queue TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            payload TEXT,
+            status TEXT NOT NULL,
+            worker TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            result TEXT,
+            enqueued REAL,
+            PRIMARY KEY (queue, unit)
+        )""")
+    return connection
+
+def enqueue(path, queue, units):
+    """
+    Adds units of work to a queue. A unit that was done or failed in an earlier run is enqueued again; a unit that is
+    currently leased keeps its lease.
+
+    Args:
+        path (str): The path of the queue database.
+        queue (str): The name of the queue, e.g. "docstrings".
+        units (dict): The payload (JSON serializable) by unit id.
+    """
+    now = time.time()
+    with closing(_connect(path)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.executemany("""
+            INSERT INTO units (queue, unit, payload, status, enqueued) VALUES (?, ?, ?, 'pending', ?)
+            ON CONFLICT (queue, unit) DO UPDATE SET payload = excluded.payload, status = 'pending', worker = NULL,
+                lease_until = NULL, attempts = 0, error = NULL, result = NULL, enqueued = excluded.enqueued
+            WHERE units.status != 'leased' OR units.lease_until < excluded.enqueued""",
+            [(queue, unit, json.dumps(payload), now) for unit, payload in units.items()])
+        connection.execute("COMMIT")
+
+def lease(path, queue, worker, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Leases the next available unit of work: a pending unit, or a unit whose lease expired.
+
+    Args:
+        path (str): The path of the queue database.
+        queue (str): The name of the queue.
+        worker (str): The identifier of the worker (see worker_id).
+        lease_seconds (int): The duration of the lease.
+
+    Returns:
+        tuple: The unit id and its payload, or None if no unit is available.
+    """
+    with closing(_connect(path)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        # A unit whose last attempt was abandoned (its worker died) is not leased again after MAX_ATTEMPTS
+        connection.execute("""
+            UPDATE units SET status = 'failed', error = 'The lease expired'
+            WHERE queue = ? AND status = 'leased' AND lease_until < ? AND attempts >= ?""", (queue, now, MAX_ATTEMPTS))
+        row = connection.execute("""
+            SELECT unit, payload FROM units
+            WHERE queue = ? AND attempts < ? AND (status = 'pending' OR (status = 'leased' AND lease_until < ?))
+            ORDER BY rowid LIMIT 1""", (queue, MAX_ATTEMPTS, now)).fetchone()
+        if row is not None:
+            connection.execute("""
+                UPDATE units SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1
+                WHERE queue = ? AND unit = ?""", (worker, now + lease_seconds, queue, row[0]))
+        connection.execute("COMMIT")
+    return None if row is None else (row[0], json.loads(row[1]))
+
+def heartbeat(path, queue, unit, worker, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Renews the lease of a unit.
+
+    Args:
+        path (str): The path of the queue database.
+        queue (str): The name of the queue.
+        unit (str): The unit id.
+        worker (str): The identifier of the worker holding the lease.
+        lease_seconds (int): The new duration of the lease.
+
+    Returns:
+        bool: False if the worker no longer holds the lease (it expired and the unit was leased again).
+    """
+    with closing(_connect(path)) as connection:
+        cursor = connection.execute("""
+            UPDATE units SET lease_until = ? WHERE queue = ? AND unit = ? AND worker = ? AND status = 'leased'""",
+            (time.time() + lease_seconds, queue, unit, worker))
+        return cursor.rowcount > 0
+
+def complete(path, queue, unit, worker, result=None):
+    """
+    Marks a unit as done, with its result, if the worker still holds its lease.
+
+    Args:
+        path (str): The path of the queue database.
+        queue (str): The name of the queue.
+        unit (str): The unit id.
+        worker (str): The identifier of the worker.
+        result (optional): The result (JSON serializable) to merge by the enqueueing process.
+
+    Returns:
+        bool: False if the worker no longer holds the lease, so the result of the worker that took over is kept.
+    """
+    with closing(_connect(path)) as connection:
+        cursor = connection.execute("""
+            UPDATE units SET status = 'done', lease_until = NULL, result = ?
+            WHERE queue = ? AND unit = ? AND worker = ? AND status = 'leased'""",
+            (json.dumps(result), queue, unit, worker))
+        return cursor.rowcount > 0
+
+def fail(path, queue, unit, worker, error):
+    """
+    Marks an attempt at a unit as failed. The unit is leased again, unless it failed MAX_ATTEMPTS times.
+
+    Args:
+        path (str): The path of the queue database.
+        queue (str): The name of the queue.
+        unit (str): The unit id.
+        worker (str): The identifier of the worker.
+        error (str): The error, for the log of the enqueueing process.
+    """
+    with closing(_connect(path)) as connection:
+        connection.execute("""
+            UPDATE units SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = ?,
+                lease_until = NULL, error = ?
+            WHERE queue = ? AND unit = ? AND worker = ?""", (MAX_ATTEMPTS, worker, error, queue, unit, worker))
+
+def counts(path, queue):
+    """
+    Counts the units of a queue by status.
+
+    Args:
+        path (str): The path of the queue database.
+        queue (str): The name of the queue.
+
+    Returns:
+        dict: The number of units by status (pending, leased, done, failed).
+    """
+    with closing(_connect(path)) as connection:
+        return dict(connection.execute("SELECT status, COUNT(*) FROM units WHERE queue = ? GROUP BY status", (queue,)))
+
+def results(path, queue, units):
+    """
+    Returns the results of units.
+
+    Args:
+        path (str): The path of the queue database.
+        queue (str): The name of the queue.
+        units (list): The unit ids.
+
+    Returns:
+        dict: The result by unit id, for the units that are done.
+    """
+    with closing(_connect(path)) as connection:
+        rows = connection.execute("SELECT unit, result FROM units WHERE queue = ? AND status = 'done'", (queue,))
+        wanted = set(units)
+        return {unit: json.loads(result) for unit, result in rows if unit in wanted}
+
+def check_done(path, queue, units, logger):
+    """
+    Checks that units are done, logging the units that are not (failed, or still to do when the workers stopped).
+
+    Args:
+        path (str): The path of the queue database.
+        queue (str): The name of the queue.
+        units (list): The unit ids.
+        logger (logging.Logger): A logger instance used to log the units that are not done.
+
+    Returns:
+        bool: True if all units are done.
+    """
+    with closing(_connect(path)) as connection:
+        rows = connection.execute("SELECT unit, status, error FROM units WHERE queue = ?", (queue,))
+        status = {unit: (unit_status, error) for unit, unit_status, error in rows}
+    not_done = [unit for unit in units if status.get(unit, (None, None))[0] != "done"]
+    for unit in not_done:
+        unit_status, error = status.get(unit, ("missing", None))
+        logger.error(f"Unit {unit} of queue {queue} is not done ({unit_status}): {error}")
+    return not not_done
+
+def _has_work(path, queue, since):
+    """
+    Checks whether a queue has units to do, or units that were enqueued since a given time.
+    """
+    with closing(_connect(path)) as connection:
+        return connection.execute("""
+            SELECT COUNT(*) FROM units WHERE queue = ? AND (status IN ('pending', 'leased') OR enqueued >= ?)""",
+            (queue, since)).fetchone()[0] > 0
+
+def _work(path, queue, handler, logger, lease_seconds, worker):
+    """
+    Leases and works on units until the queue is drained; units leased by other workers are waited for, as their
+    leases may expire.
+    """
+    while True:
+        leased = lease(path, queue, worker, lease_seconds)
+        if leased is None:
+            if not counts(path, queue).get("leased"):
+                return
+            time.sleep(min(5, lease_seconds / 3))
+            continue
+        unit, payload = leased
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(lease_seconds / 3):
+                if not heartbeat(path, queue, unit, worker, lease_seconds):
+                    logger.warning(f"Lost the lease of {unit} in queue {queue}")
+                    return
+
+        beating = threading.Thread(target=beat, daemon=True)
+        beating.start()
+        try:
+            result = handler(unit, payload)
+        except SystemExit as e:
+            # The model calls exit on a persistent error or an exhausted token budget; the thread keeps working
+            logger.error(f"Exit with status {e.code} while working on {unit} from queue {queue}")
+            fail(path, queue, unit, worker, f"Exit with status {e.code}")
+        except Exception as e:
+            logger.error(f"Error while working on {unit} from queue {queue}: {e}")
+            fail(path, queue, unit, worker, str(e))
+        else:
+            if not complete(path, queue, unit, worker, result):
+                logger.warning(f"Discarding the result of {unit} in queue {queue}, its lease was taken over")
+        finally:
+            stop.set()
+            beating.join()
+
+def run_worker(path, queue, handler, logger, threads=1, lease_seconds=DEFAULT_LEASE_SECONDS, wait=False):
+    """
+    Works on the units of a queue until it is drained: no unit is pending, and no unit is leased by another worker.
+
+    Args:
+        path (str): The path of the queue database.
+        queue (str): The name of the queue.
+        handler (function): Called with the unit id and payload; returns the result of the unit (or None).
+        logger (logging.Logger): A logger instance used to log the progress and errors.
+        threads (int): The number of units to work on concurrently in this process.
+        lease_seconds (int): The duration of the leases.
+        wait (bool): Wait until units are enqueued (after this worker started, or still to be done), so workers can be
+            started before the enqueueing process.
+
+    Returns:
+        dict: The number of units by status after the queue is drained (see counts).
+    """
+    worker = worker_id()
+    logger.info(f"Worker {worker} started on queue {queue} in {path}")
+    started = time.time()
+    while wait and not _has_work(path, queue, started):
+        time.sleep(1)
+    workers = [threading.Thread(target=_work, args=(path, queue, handler, logger, lease_seconds, f"{worker}:{i}"))
+               for i in range(max(1, threads))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    status = counts(path, queue)
+    logger.info(f"Queue {queue} drained: {status}")
+    if status.get("failed"):
+        logger.error(f"{status['failed']} units of queue {queue} failed, see the error column in {path}")
+    return status